@@ -11,6 +11,7 @@ from typing import Optional, Callable, TYPE_CHECKING
 from dataclasses import dataclass
 from .connection_manager import ConnectionManager
 from .data_structures import TerminalType
+from .utils import tracing
 
 if TYPE_CHECKING:
     from .data_structures import StreamChunk
@@ -72,6 +73,10 @@ class CommandExecution:
         
         # 活跃性检测
         self.last_message_time = time.time()  # 最后收到消息的时间
+
+        # 追踪统计
+        self.first_message_time: Optional[float] = None
+        self.message_count = 0
         
     @property
     def execution_time(self) -> float:
@@ -80,6 +85,9 @@ class CommandExecution:
     def update_activity(self):
         """更新活跃性时间戳"""
         self.last_message_time = time.time()
+        self.message_count += 1
+        if self.first_message_time is None:
+            self.first_message_time = self.last_message_time
     
     def get_silence_duration(self) -> float:
         """获取静默时长"""
@@ -169,6 +177,17 @@ class CommandExecutor:
                     logger.error(f"发送错误 StreamChunk 失败: {callback_error}")
     
     async def execute_command(self, command: str, silence_timeout: float = 30.0) -> CommandResult:
+        """执行命令并等待结果（记录 executor.execute_command span）"""
+        with tracing.span("executor.execute_command", terminal_type=self.terminal_type.value,
+                          command_bytes=len(command)) as sp:
+            result = await self._execute_command(command, silence_timeout)
+            if sp is not None:
+                sp.set(success=result.success)
+                if result.error:
+                    sp.error = result.error
+            return result
+
+    async def _execute_command(self, command: str, silence_timeout: float = 30.0) -> CommandResult:
         """
         执行命令并等待结果
         
@@ -232,5 +251,12 @@ class CommandExecutor:
                 command, str(e), self.current_execution.execution_time if self.current_execution else 0.0
             )
         finally:
-            # 清理执行状态
+            # 记录首包延迟与消息数，清理执行状态
+            execution = self.current_execution
+            sp = tracing.current_span()
+            if execution and sp is not None:
+                sp.set(messages=execution.message_count,
+                       timeout=execution.timeout_occurred,
+                       first_output_ms=int((execution.first_message_time - execution.start_time) * 1000)
+                       if execution.first_message_time else None)
             self.current_execution = None
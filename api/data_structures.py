@@ -86,10 +86,12 @@ class MetadataBuilder:
         }
     
     @staticmethod
-    def for_tool_use(tool_name: str, raw_length: int, terminal_type: str) -> Dict[str, Any]:
+    def for_tool_use(tool_name: str, raw_length: int, terminal_type: str,
+                     mcp_server: str = "") -> Dict[str, Any]:
         """工具使用的元数据"""
         return {
             "tool_name": tool_name,
+            "mcp_server": mcp_server,
             "raw_length": raw_length,
             "terminal_type": terminal_type
         }
@@ -7,7 +7,7 @@ Message Processor - 统一数据流架构
 import logging
 import re
 import time
-from typing import Optional
+from typing import Optional, Tuple
 
 from .data_structures import StreamChunk, ChunkType, MetadataBuilder, TerminalType
 from .utils.ansi_formatter import ansi_formatter
@@ -20,6 +20,12 @@ ANSI_RE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 ALT_SCREEN_RE = re.compile(r'\x1b\[\?1049[hl]')
 OSC_LINK_RE = re.compile(r'\x1b]8;;.*?\x07(.*?)\x1b]8;;\x07', re.DOTALL)
 
+# 工具调用行：内置工具为 "🛠️  Using tool: fs_read"，MCP 工具为 "Using tool: query from mcp server victoriametrics"
+# 或带命名空间的 "victoriametrics___query"
+TOOL_NAME_RE = re.compile(r'Using tool:\s*([a-zA-Z_][\w\-.]*)', re.IGNORECASE)
+TOOL_NAME_FALLBACK_RE = re.compile(r'tool:\s*([a-zA-Z_][\w\-.]*)', re.IGNORECASE)
+MCP_SERVER_RE = re.compile(r'from\s+mcp\s+server:?\s*([a-zA-Z0-9_][\w\-.]*)', re.IGNORECASE)
+
 def _sanitize_tui(s: str) -> str:
     parts = []
     for line in s.split('\n'):
@@ -211,8 +217,8 @@ class MessageProcessor:
         if chunk_type == ChunkType.THINKING:
             return MetadataBuilder.for_thinking(len(raw_message), "qcli")
         elif chunk_type == ChunkType.TOOL_USE:
-            tool_name = self._extract_tool_name(raw_message)
-            return MetadataBuilder.for_tool_use(tool_name, len(raw_message), "qcli")
+            tool_name, mcp_server = self._extract_tool_info(clean_content)
+            return MetadataBuilder.for_tool_use(tool_name, len(raw_message), "qcli", mcp_server)
         elif chunk_type == ChunkType.CONTENT:
             return MetadataBuilder.for_content(
                 len(raw_message),
@@ -227,23 +233,16 @@ class MessageProcessor:
         else:
             return {"raw_length": len(raw_message), "terminal_type": "qcli"}
     
-    def _extract_tool_name(self, raw_message: str) -> str:
-        """从原始消息中提取工具名称"""
-        import re
-        
-        # 清理后再提取
-        cleaned, _ = ansi_formatter.parse_qcli_output(raw_message)
-        
-        # 提取工具名称的模式
-        patterns = [
-            r'Using tool:\s*([a-zA-Z_][a-zA-Z0-9_]*)',
-            r'🛠️\s*Using tool:\s*([a-zA-Z_][a-zA-Z0-9_]*)',
-            r'tool:\s*([a-zA-Z_][a-zA-Z0-9_]*)',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, cleaned, re.IGNORECASE)
-            if match:
-                return match.group(1)
-        
-        return "unknown_tool"
+    def _extract_tool_info(self, cleaned: str) -> Tuple[str, str]:
+        """从清理后的文本中提取 (工具名, MCP server)；内置工具的 server 为空"""
+        match = TOOL_NAME_RE.search(cleaned) or TOOL_NAME_FALLBACK_RE.search(cleaned)
+        if not match:
+            return "unknown_tool", ""
+        tool_name = match.group(1)
+        server = MCP_SERVER_RE.search(cleaned)
+        if server:
+            return tool_name, server.group(1)
+        if "___" in tool_name:
+            mcp_server, tool_name = tool_name.split("___", 1)
+            return tool_name, mcp_server
+        return tool_name, ""
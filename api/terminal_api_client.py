@@ -14,6 +14,7 @@ from .connection_manager import ConnectionManager
 from .command_executor import CommandExecutor
 from .message_processor import MessageProcessor
 from .data_structures import StreamChunk, ChunkType, TerminalType
+from .utils import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -249,7 +250,8 @@ class TerminalAPIClient:
         try:
             # 1. 检查并建立网络连接
             if not self.is_connected:
-                success = await self._connection_manager.connect()
+                with tracing.span("terminal.connect", host=self.host, port=self.port):
+                    success = await self._connection_manager.connect()
                 if not success:
                     self._set_state(TerminalBusinessState.ERROR)
                     logger.error("网络连接建立失败")
@@ -260,7 +262,8 @@ class TerminalAPIClient:
             # 2. 消费初始化消息（QCLI可能较慢），限时等待；超时也继续
             self._set_state(TerminalBusinessState.INITIALIZING)
             try:
-                await asyncio.wait_for(self._consume_initialization_messages(), timeout=self._init_ready_timeout_s)
+                with tracing.span("terminal.await_ready", timeout_s=self._init_ready_timeout_s):
+                    await asyncio.wait_for(self._consume_initialization_messages(), timeout=self._init_ready_timeout_s)
             except asyncio.TimeoutError:
                 logger.warning(f"初始化等待超时 {self._init_ready_timeout_s}s，继续进入就绪状态（宽松模式）")
             
@@ -307,6 +310,9 @@ class TerminalAPIClient:
         
         # 设置忙碌状态
         self._set_state(TerminalBusinessState.BUSY)
+        # 异步生成器跨 yield，不切换当前 span
+        stream_span = tracing.start_span("terminal.execute_command_stream", terminal_type=self.terminal_type.value)
+        chunk_count = 0
         
         try:
             # 使用简化的流式处理 - 基于 StreamChunk 回调
@@ -368,6 +374,7 @@ class TerminalAPIClient:
                     
                     # 转换为 API 格式并输出
                     api_chunk = chunk.to_api_format()
+                    chunk_count += 1
                     yield api_chunk
                     
                     # 如果是完成或错误块，结束流式输出
@@ -381,6 +388,9 @@ class TerminalAPIClient:
         finally:
             # 恢复空闲状态
             self._set_state(TerminalBusinessState.IDLE)
+            if stream_span is not None:
+                stream_span.set(chunks=chunk_count)
+                stream_span.finish()
     
     # 异步上下文管理器支持
     async def __aenter__(self):
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+轻量请求级追踪
+基于 contextvars 传递当前 trace/span，无第三方依赖；未开启 trace 时所有调用均为空操作。
+导出格式与 OpenTelemetry OTLP/JSON 的 Span 字段保持一致（每行一个 span）。
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+_TRACE: ContextVar[Optional["Trace"]] = ContextVar("q_trace", default=None)
+_SPAN: ContextVar[Optional["Span"]] = ContextVar("q_span", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return os.urandom(nbytes).hex()
+
+
+def _otlp_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _otlp_attrs(attrs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attrs.items() if v is not None]
+
+
+class Span:
+    """单个计时片段"""
+
+    def __init__(self, trace: "Trace", name: str, parent: Optional["Span"] = None,
+                 start: Optional[float] = None, **attrs: Any):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent else ""
+        self.start = time.time() if start is None else start
+        self.end: Optional[float] = None
+        self.attrs: Dict[str, Any] = dict(attrs)
+        self.events: List[Dict[str, Any]] = []
+        self.error = ""
+
+    @property
+    def duration_ms(self) -> int:
+        return int(((self.end or time.time()) - self.start) * 1000)
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def add_event(self, name: str, **attrs: Any) -> None:
+        self.events.append({"name": name, "time": time.time(), "attrs": attrs})
+
+    def finish(self, end: Optional[float] = None) -> None:
+        if self.end is None:
+            self.end = time.time() if end is None else end
+            self.trace.spans.append(self)
+
+    def to_otlp(self, service: str) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": "SPAN_KIND_INTERNAL",
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int((self.end or self.start) * 1e9)),
+            "attributes": _otlp_attrs(self.attrs),
+            "events": [{"name": e["name"], "timeUnixNano": str(int(e["time"] * 1e9)),
+                        "attributes": _otlp_attrs(e["attrs"])} for e in self.events],
+            "status": {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error
+                      else {"code": "STATUS_CODE_OK"},
+            "resource": {"service.name": service},
+        }
+
+
+class Trace:
+    """一次请求的全部 span（按结束顺序收集）"""
+
+    def __init__(self, name: str, **attrs: Any):
+        self.trace_id = _new_id(16)
+        self.spans: List[Span] = []
+        self.root = Span(self, name, **attrs)
+        self.exported = 0  # 已导出的 span 数；请求返回后才结束的 span（如连接排空）再次导出时只写新增部分
+
+    def subtree(self, root: Span) -> List[Span]:
+        ids = {root.span_id}
+        out: List[Span] = []
+        # spans 按结束顺序排列，子 span 总是先于父 span 结束，逆序遍历即可自上而下展开
+        for s in reversed(self.spans):
+            if s.parent_id in ids:
+                ids.add(s.span_id)
+                out.append(s)
+        return out
+
+    def phases_ms(self, root: Optional[Span] = None) -> Dict[str, int]:
+        """root 之下各阶段耗时（同名 span 累加，毫秒）。"""
+        phases: Dict[str, int] = {}
+        for s in reversed(self.subtree(root or self.root)):
+            phases[s.name] = phases.get(s.name, 0) + s.duration_ms
+        return phases
+
+    def to_otlp(self, service: str, start: int = 0, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        return [s.to_otlp(service) for s in self.spans[start:end]]
+
+
+def current_trace() -> Optional[Trace]:
+    return _TRACE.get()
+
+
+def current_span() -> Optional[Span]:
+    return _SPAN.get()
+
+
+@contextmanager
+def trace(name: str, **attrs: Any) -> Iterator[Trace]:
+    """开启一个新 trace，并将根 span 设为当前 span。"""
+    tr = Trace(name, **attrs)
+    t_token = _TRACE.set(tr)
+    s_token = _SPAN.set(tr.root)
+    try:
+        yield tr
+    except BaseException as e:
+        tr.root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        tr.root.finish()
+        _reset(_SPAN, s_token)
+        _reset(_TRACE, t_token)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """在当前 trace 下记录一个子 span；无 trace 时 yield None。"""
+    tr = _TRACE.get()
+    if tr is None:
+        yield None
+        return
+    sp = Span(tr, name, parent=_SPAN.get(), **attrs)
+    token = _SPAN.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        sp.finish()
+        _reset(_SPAN, token)
+
+
+def start_span(name: str, **attrs: Any) -> Optional[Span]:
+    """创建子 span 但不设为当前 span（用于异步生成器等跨 yield 的场景），需调用 finish()。"""
+    tr = _TRACE.get()
+    if tr is None:
+        return None
+    return Span(tr, name, parent=_SPAN.get(), **attrs)
+
+
+def record_span(name: str, start: float, end: Optional[float] = None, **attrs: Any) -> Optional[Span]:
+    """补记一个已知起止时间的子 span（如回显、工具调用这类从流事件推算出的阶段）。"""
+    sp = start_span(name, **attrs)
+    if sp is not None:
+        sp.start = start
+        sp.finish(end)
+    return sp
+
+
+def add_event(name: str, **attrs: Any) -> None:
+    sp = _SPAN.get()
+    if sp is not None and _TRACE.get() is not None:
+        sp.add_event(name, **attrs)
+
+
+def _reset(var: ContextVar, token) -> None:
+    try:
+        var.reset(token)
+    except ValueError:
+        # 在其它 Context 中结束（如异步生成器被回收），直接清空
+        var.set(None)
+
+
+class SpanFileExporter:
+    """按大小轮转的 JSONL span 文件（同步写，调用方可放到线程中执行）"""
+
+    def __init__(self, path: str, max_bytes: int = 20 * 1024 * 1024, backups: int = 5,
+                 service: str = "q-gateway"):
+        self.service = service
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._logger = logging.getLogger(f"{__name__}.export.{path}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                           backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    def export(self, tr: Trace, start: int = 0, end: Optional[int] = None) -> int:
+        spans = tr.to_otlp(self.service, start, end)
+        for s in spans:
+            self._logger.info(json.dumps(s, ensure_ascii=False, default=str))
+        return len(spans)
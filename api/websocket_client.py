@@ -14,6 +14,8 @@ from typing import Optional, Callable
 from dataclasses import dataclass
 from enum import Enum
 
+from .utils import tracing
+
 logger = logging.getLogger(__name__)
 
 
@@ -70,6 +72,10 @@ class TtydWebSocketClient:
         self._listen_task: Optional[asyncio.Task] = None
         self._should_stop = False
 
+        # 接收统计（供网关指标使用）
+        self.bytes_received = 0
+        self.messages_received = 0
+
         # 认证令牌
         self.auth_token = base64.b64encode(
             f"{username}:{password}".encode()).decode()
@@ -239,7 +245,8 @@ class TtydWebSocketClient:
 
             # ttyd协议：INPUT命令 = '0' + 数据
             message = '0' + command
-            await self.ws_connection.send(message)  # type: ignore
+            with tracing.span("ttyd.send", bytes=len(message), kind="command"):
+                await self.ws_connection.send(message)  # type: ignore
             logger.debug(f"发送命令 ({terminal_type}): {repr(command.strip())}")
             return True
 
@@ -259,7 +266,8 @@ class TtydWebSocketClient:
         try:
             # ttyd协议：INPUT命令 = '0' + 数据
             message = '0' + data
-            await self.ws_connection.send(message)  # type: ignore
+            with tracing.span("ttyd.send", bytes=len(message), kind="input"):
+                await self.ws_connection.send(message)  # type: ignore
             logger.debug(f"发送输入: {repr(data)}")
             return True
 
@@ -338,12 +346,15 @@ class TtydWebSocketClient:
         """处理接收到的消息"""
         try:
             # 处理不同类型的消息
+            self.messages_received += 1
             if isinstance(message, bytes):
                 # 二进制消息，解码为文本
+                self.bytes_received += len(message)
                 raw_data = message.decode('utf-8', errors='replace')
             else:
                 # 文本消息
                 raw_data = str(message)
+                self.bytes_received += len(raw_data.encode('utf-8', errors='replace'))
 
             # 解析ttyd协议消息
             if len(raw_data) > 0:
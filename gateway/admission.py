@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+准入队列：限制同时运行的分析数，超出部分按 severity 优先级排队。
+- 队列满时，高优先级请求挤掉最低优先级的排队者；否则直接拒绝
+- 排队超过 max_wait 秒拒绝
+- 拒绝时给出按平均处理时长估算的 Retry-After
+"""
+import asyncio
+import heapq
+import itertools
+import math
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+
+class AdmissionRejected(Exception):
+    """过载拒绝（由调用方转换为 429 + Retry-After）"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_priorities(spec: str) -> Dict[str, int]:
+    """解析 "critical=0,warning=2,default=2"，数值越小越优先。"""
+    prios: Dict[str, int] = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            prios[k.strip().lower()] = int(v.strip())
+        except ValueError:
+            continue
+    return prios
+
+
+class AdmissionQueue:
+    """按优先级排队的并发准入控制（单事件循环内使用）"""
+
+    def __init__(self, max_active: int, max_queue: int, max_wait: float,
+                 priorities: Optional[Dict[str, int]] = None, default_service_s: float = 30.0):
+        self.max_active = max(1, max_active)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.priorities = priorities or {}
+        self.active = 0
+        # 堆元素：[priority, seq, future]
+        self._heap: List[List[Any]] = []
+        self._seq = itertools.count()
+        self._service_ewma = default_service_s  # 平均单次分析耗时（指数平滑）
+        self.admitted = 0
+        self.rejected: Counter = Counter()
+
+    def priority(self, severity: str) -> int:
+        return self.priorities.get((severity or "").strip().lower(), self.priorities.get("default", 2))
+
+    def retry_after(self, ahead: int, slots: Optional[int] = None) -> int:
+        """前面还有 ahead 个请求、共 slots 个并行名额（默认 max_active）时的建议重试秒数。"""
+        rounds = (ahead + 1) / max(1, slots or self.max_active)
+        return max(1, math.ceil(rounds * self._service_ewma))
+
+    def reject(self, reason: str, ahead: int, slots: Optional[int] = None) -> AdmissionRejected:
+        """计数并构造拒绝异常；连接池等其它排队点也用它给出一致的 Retry-After。"""
+        self.rejected[reason] += 1
+        return AdmissionRejected(reason, self.retry_after(ahead, slots))
+
+    def _remove(self, entry: List[Any]) -> None:
+        try:
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+        except ValueError:
+            pass
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_active and self._heap:
+            _prio, _seq, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue
+            self.active += 1
+            fut.set_result(None)
+
+    async def acquire(self, severity: str) -> float:
+        """获取一个运行名额，返回排队秒数；过载时抛 AdmissionRejected。"""
+        loop = asyncio.get_running_loop()
+        if self.active < self.max_active and not self._heap:
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+        prio = self.priority(severity)
+        if len(self._heap) >= self.max_queue:
+            worst = max(self._heap, key=lambda e: (e[0], e[1])) if self._heap else None
+            if worst is None or worst[0] <= prio:
+                raise self.reject("queue full", len(self._heap))
+            # 挤掉最低优先级、最晚到达的排队者
+            self._remove(worst)
+            if not worst[2].done():
+                worst[2].set_exception(self.reject("preempted by higher severity", len(self._heap)))
+        fut = loop.create_future()
+        entry = [prio, next(self._seq), fut]
+        heapq.heappush(self._heap, entry)
+        t0 = loop.time()
+        try:
+            done, _ = await asyncio.wait({fut}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        if not done:
+            self._abandon(entry)
+            ahead = sum(1 for e in self._heap if e[0] <= prio)
+            raise self.reject("queue timeout", ahead)
+        fut.result()  # 被挤出时抛 AdmissionRejected
+        self.admitted += 1
+        return loop.time() - t0
+
+    def _abandon(self, entry: List[Any]) -> None:
+        fut = entry[2]
+        if fut.done():
+            # 已被放行但调用方放弃：归还名额
+            if not fut.cancelled() and fut.exception() is None:
+                self.release()
+            return
+        fut.cancel()
+        self._remove(entry)
+
+    def release(self, service_s: Optional[float] = None) -> None:
+        if self.active > 0:
+            self.active -= 1
+        if service_s is not None:
+            self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_s
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, severity: str) -> AsyncIterator[float]:
+        waited = await self.acquire(severity)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        try:
+            yield waited
+        finally:
+            self.release(loop.time() - t0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": len(self._heap),
+            "max_queue": self.max_queue,
+            "service_ewma_s": round(self._service_ewma, 2),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
@@ -1,19 +1,36 @@
-import os, sys, json, asyncio, time, re, subprocess, shutil, signal
-from asyncio import Lock
-from typing import List, Tuple
+import os, sys, json, asyncio, time, re, signal, subprocess, uuid
+from typing import Deque, List, Tuple
 from typing import Any, Dict, Optional
 from pathlib import Path
+from collections import Counter, OrderedDict, deque
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 # terminal-api-for-qcli client
 sys.path.append("/opt/terminal-api-for-qcli")
-from api import TerminalAPIClient
-from api.data_structures import TerminalType
+from api import TerminalAPIClient, TtydWebSocketClient
+from api.data_structures import StreamChunk, TerminalType
 from api.terminal_api_client import TerminalBusinessState
-
-from gateway.mapping import build_incident_key_from_alert, sop_id_from_incident_key
+from api.utils import tracing
+
+from gateway.async_writer import AppendWriter
+from gateway.echo_filter import EchoIndex, EchoIndexCache, PromptEchoDetector
+from gateway.grouping import WindowBatcher
+from gateway.json_scan import JsonResultScanner, find_result
+from gateway.metrics import Registry
+from gateway.mapping import alert_fingerprint, build_incident_key_from_alert, group_key_from_alert, sop_id_from_incident_key
+from gateway import job_store, purge
+from gateway.admission import AdmissionQueue, AdmissionRejected, parse_priorities
+from gateway import prompt_budget
+from gateway.prompt_cache import PromptPrefixCache, file_versions
+from gateway.purge import PurgeService
+from gateway.q_pids import PID_DIR, QPidRegistry, rss_bytes
+from gateway.result_cache import ResultCache, parse_ttls
+from gateway.sop_matcher import SopMatcher
+from gateway.sop_store import SopStore
+from gateway.sse import StreamRegistry, SSEStream
+from gateway.tool_timeline import ToolStats, ToolTimeline
 
 APP_NAME = os.getenv("APP_NAME", "q-gateway-json")
 HOST = os.getenv("QTTY_HOST", "127.0.0.1")
@@ -43,6 +60,22 @@ OFFLINE_FALLBACK = os.getenv("OFFLINE_FALLBACK", "1") not in ("0", "false", "Fal
 
 app = FastAPI(title=APP_NAME)
 
+# Prometheus 指标（GET /metrics）；实时状态类 gauge 在抓取时由 _collect_live_metrics 生成
+_METRICS = Registry()
+_M_ACQUIRE_WAIT = _METRICS.histogram("q_gateway_acquire_wait_seconds", "Time waiting for a pooled Q connection", ["sop_id"])
+_M_FIRST_CHUNK = _METRICS.histogram("q_gateway_first_chunk_seconds", "Time from prompt send to first non-echo content", ["sop_id"])
+_M_DURATION = _METRICS.histogram("q_gateway_analysis_duration_seconds", "Total _run_q_collect duration", ["sop_id", "outcome"])
+_M_TIMEOUTS = _METRICS.counter("q_gateway_timeouts_total", "Analyses that hit the overall timeout", ["sop_id"])
+_M_ECHO_DROPS = _METRICS.counter("q_gateway_echo_dropped_total", "Chunks dropped as prompt echo", ["sop_id"])
+_M_EARLY_RESULTS = _METRICS.counter("q_gateway_early_results_total", "Analyses finished as soon as the result JSON closed", ["sop_id"])
+_M_LOOP_LAG = _METRICS.histogram("q_gateway_event_loop_lag_seconds", "Event loop scheduling delay (blocking time)",
+                                 buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+_M_PROMPT_TOKENS = _METRICS.histogram("q_gateway_prompt_tokens", "Approximate prompt size in tokens", ["sop_id"],
+                                     buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+_M_TOOL_SECONDS = _METRICS.histogram("q_gateway_tool_call_seconds", "MCP/built-in tool call duration", ["server", "tool"],
+                                     buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+_M_REQUESTS = _METRICS.counter("q_gateway_analyses_total", "Analysis requests by result (ok/error/cached/coalesced/rejected)", ["result"])
+
 
 def _read_task_doc() -> str:
     if not TASK_DOC_PATH.exists():
@@ -52,144 +85,155 @@ def _read_task_doc() -> str:
         data = data[:TASK_DOC_BUDGET] + b"\n..."
     return data.decode("utf-8", "ignore").strip()
 
+# SOP 内存索引：启动时加载，目录变化时后台每 SOP_RELOAD_INTERVAL 秒检查并整体重建
+SOP_RELOAD_INTERVAL = float(os.getenv("SOP_RELOAD_INTERVAL", "5"))  # 0 表示只在启动及手动 reload 时加载
+_SOPS = SopStore(SOP_DIR)
+
 def _load_sop_text(sop_id: str) -> str:
-    for ext in ("md","txt","json"):
-        p = SOP_DIR / f"{sop_id}.{ext}"
-        if p.exists():
-            try:
-                return p.read_text(encoding="utf-8", errors="ignore").strip()
-            except Exception:
-                pass
-    for p in sorted(SOP_DIR.glob("*.jsonl")):
-        # 跳过映射记录文件，避免将其当作 SOP 正文命中
-        if p.name == "incident_sop_map.jsonl":
-            continue
-        try:
-            with p.open("r", encoding="utf-8", errors="ignore") as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith("#"):
-                        continue
-                    try:
-                        obj = json.loads(line)
-                    except Exception:
-                        continue
-                    if isinstance(obj, dict) and str(obj.get("sop_id","")) .strip() == sop_id:
-                        # 1) direct text fields
-                        for key in ("sop","content","text","body"):
-                            v = obj.get(key)
-                            if isinstance(v, str) and v.strip():
-                                return v.strip()
-                        # 2) assemble from structured fields
-                        parts2 = []
-                        title = obj.get("title") or obj.get("name")
-                        if isinstance(title, str) and title.strip():
-                            parts2.append(f"# {title.strip()}")
-                        if obj.get("priority"):
-                            parts2.append(f"Priority: {obj.get('priority')}")
-                        if obj.get("keys"):
-                            try:
-                                parts2.append("Keys: " + ", ".join(map(str, obj.get("keys") or [])))
-                            except Exception:
-                                pass
-                        def _section(h, arr):
-                            if isinstance(arr, list) and arr:
-                                lines = "\n".join([f"- {str(x)}" for x in arr])
-                                parts2.append(f"## {h}\n{lines}")
-                        _section("Commands", obj.get("command"))
-                        _section("Metrics", obj.get("metric"))
-                        _section("Logs", obj.get("log"))
-                        _section("Fix Actions", obj.get("fix_action"))
-                        if parts2:
-                            return "\n\n".join(parts2).strip()
-                        # 3) fallback: raw json
-                        try:
-                            return json.dumps(obj, ensure_ascii=False, indent=2)
-                        except Exception:
-                            return str(obj)
-        except Exception:
-            continue
-    return ""
+    return _SOPS.text(sop_id)
 
 from typing import Optional
 
-def _build_prompt(body: Dict[str, Any], sop_id: str, allow_tools: bool = True, boundary_id: Optional[str] = None) -> str:
-    parts = []
+# Prompt 预算（近似 token）：前缀（TASK/SOP/POLICY）在 PROMPT_TOKEN_BUDGET - PROMPT_ALERT_TOKENS 内按段落优先级裁剪，
+# 告警段使用紧凑 JSON 并去掉重复字段；0 表示不限制
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+PROMPT_ALERT_TOKENS = int(os.getenv("PROMPT_ALERT_TOKENS", "2000"))  # 为告警段预留
+PROMPT_COMPACT = os.getenv("PROMPT_COMPACT", "1") not in ("0", "false", "False")
+PROMPT_MAX_FIELD_CHARS = int(os.getenv("PROMPT_MAX_FIELD_CHARS", "2000"))  # 告警段超预算时单个字段的最大长度
+# 段落优先级（数字越大越先被裁剪）：按标题关键字匹配
+_TASK_SECTION_PRIORITY = [("output", 1), ("json format", 1), ("task", 1), ("start analysis", 4)]
+_SOP_SECTION_PRIORITY = [("command", 2), ("fix", 2), ("metric", 3), ("log", 4)]
+
+_RESPONSE_POLICY = """## RESPONSE POLICY
+- Do NOT repeat, quote, or paraphrase TASK/SOP/ALERT or any headings.
+- Do NOT output lines starting with '## TASK', '## SOP', '## ALERT', or '!>'.
+- Produce only new content required by the task.
+"""
+
+_NO_TOOL_POLICIES = ("""## TOOL POLICY
+- Do NOT call any tools or MCP servers in this turn.
+- Use ONLY SOP and ALERT JSON to produce output.
+- If data is missing, fill fields with null/empty; do not ask questions.""", """## OUTPUT SPEC
+Return ONLY one JSON object (no extra prose) with:
+incident_key, sop_id, severity, classification, impact, hypothesis,
+runbook_steps[], commands[], next_action""")
+
+def _compile_prompt_prefix(sop_id: str, allow_tools: bool) -> Tuple[str, Dict[str, Any]]:
+    """与告警无关的静态前缀：TASK / SOP / RESPONSE POLICY（禁用工具时另含 TOOL POLICY / OUTPUT SPEC），
+    超出前缀预算时按段落优先级裁剪 TASK/SOP（策略段不动）。"""
+    sections: List[prompt_budget.Section] = []
 
     task = _read_task_doc()
     if task:
-        parts.append("## TASK INSTRUCTIONS\n" + task)
+        sections += prompt_budget.sections_from_markdown(task, "## TASK INSTRUCTIONS", _TASK_SECTION_PRIORITY, 3, "task")
 
     sop_text = _load_sop_text(sop_id)
     if sop_text:
-        parts.append(f"## SOP ({sop_id})\n" + sop_text)
+        sections += prompt_budget.sections_from_markdown(sop_text, f"## SOP ({sop_id})", _SOP_SECTION_PRIORITY, 3, "sop")
 
     # 明确回显约束，避免模型复述提示词/ALERT 内容
-    parts.append("""## RESPONSE POLICY
-- Do NOT repeat, quote, or paraphrase TASK/SOP/ALERT or any headings.
-- Do NOT output lines starting with '## TASK', '## SOP', '## ALERT', or '!>'.
-- Produce only new content required by the task.
-""")
+    sections.append(prompt_budget.Section("response_policy", _RESPONSE_POLICY, priority=0, required=True))
 
     if not allow_tools:
-        parts.append("""## TOOL POLICY
-- Do NOT call any tools or MCP servers in this turn.
-- Use ONLY SOP and ALERT JSON to produce output.
-- If data is missing, fill fields with null/empty; do not ask questions.""")
-
-        parts.append("""## OUTPUT SPEC
-Return ONLY one JSON object (no extra prose) with:
-incident_key, sop_id, severity, classification, impact, hypothesis,
-runbook_steps[], commands[], next_action""")
+        for name, text in zip(("tool_policy", "output_spec"), _NO_TOOL_POLICIES):
+            sections.append(prompt_budget.Section(name, text, priority=0, required=True))
+
+    budget = max(1, PROMPT_TOKEN_BUDGET - PROMPT_ALERT_TOKENS) if PROMPT_TOKEN_BUDGET > 0 else 0
+    text, report = prompt_budget.fit_sections(sections, budget)
+    if report["dropped_sections"] or report["truncated_sections"]:
+        print(f"[prompt] prefix trimmed sop={sop_id} tokens={report['tokens_before']}->{report['tokens']} "
+              f"dropped={report['dropped_sections']} truncated={report['truncated_sections']}")
+    return text, report
+
+def _prompt_prefix_version(sop_id: str):
+    """前缀依赖的源版本：任务说明文件 + SOP 索引的 generation（索引重建即失效）。"""
+    return (file_versions([TASK_DOC_PATH]), _SOPS.generation)
+
+PROMPT_PREFIX_CHECK_INTERVAL = float(os.getenv("PROMPT_PREFIX_CHECK_INTERVAL", "1"))  # 任务说明 stat 检查间隔秒数
+_PROMPT_PREFIXES = PromptPrefixCache(_compile_prompt_prefix, _prompt_prefix_version,
+                                     check_interval=PROMPT_PREFIX_CHECK_INTERVAL)
+# 回显判定用的前缀索引（词集合、定长子串哈希）：按前缀 sha1 缓存，请求只处理告警段
+ECHO_INDEX_CACHE_MAX = int(os.getenv("ECHO_INDEX_CACHE_MAX", "32"))
+_ECHO_INDEXES = EchoIndexCache(ECHO_INDEX_CACHE_MAX)
+
+def _build_prompt_ex(body: Dict[str, Any], sop_id: str, allow_tools: bool = True,
+                     boundary_id: Optional[str] = None,
+                     prompt_sop_id: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+    """渲染 prompt 并返回大小统计（近似 token、字节、前缀 sha1、裁剪/去重情况）。
+    prompt_sop_id 为放进 prompt 的 SOP（规则匹配时与会话的 sop_id 不同），默认即 sop_id。"""
+    return _render_prompt(body, sop_id, allow_tools, boundary_id, prompt_sop_id)[:2]
+
+def _render_prompt(body: Dict[str, Any], sop_id: str, allow_tools: bool = True,
+                   boundary_id: Optional[str] = None,
+                   prompt_sop_id: Optional[str] = None) -> Tuple[str, Dict[str, Any], EchoIndex]:
+    """同 _build_prompt_ex，另返回前缀的回显索引（供 _q_collect 判定回显）。"""
+    prefix, cached = _PROMPT_PREFIXES.get(prompt_sop_id or sop_id, allow_tools)
+    tracing.add_event("prompt.prefix", sha1=prefix.sha1, bytes=prefix.nbytes, cached=cached)
+    parts = [prefix.text]
+    prefix_tokens = prefix.meta.get("tokens", 0)
+    remaining = max(0, PROMPT_TOKEN_BUDGET - prefix_tokens) if PROMPT_TOKEN_BUDGET > 0 else None
+    alert_stats: Dict[str, Any] = {"dropped_fields": 0, "truncated_fields": 0}
 
     if boundary_id:
         parts.append(f"## BOUNDARY\nBOUNDARY_ID: {boundary_id}")
 
-    if ALERT_JSON_PRETTY and isinstance(body.get("alert"), dict):
+    group = body.get("alerts")
+    if PROMPT_COMPACT:
+        payload, title = None, ""
+        if isinstance(group, list) and len(group) > 1:
+            payload = []
+            for a in group:
+                compacted, dropped = prompt_budget.compact_alert(a) if isinstance(a, dict) else (a, [])
+                payload.append(compacted)
+                alert_stats["dropped_fields"] += len(dropped)
+            title = (f"## ALERT GROUP ({len(group)} correlated alerts; analyze as one incident, "
+                     "cover every alert in the result)")
+        elif isinstance(body.get("alert"), dict):
+            payload, dropped = prompt_budget.compact_alert(body["alert"])
+            alert_stats["dropped_fields"] = len(dropped)
+            title = "## ALERT JSON"
+        if payload is not None:
+            text, rep = prompt_budget.alert_section(title, payload, True, remaining, PROMPT_MAX_FIELD_CHARS)
+            alert_stats["truncated_fields"] = rep["truncated_fields"]
+            parts.append(text)
+    elif isinstance(group, list) and len(group) > 1:
+        # 聚合组：多条相关告警合并为一次分析
+        parts.append(f"## ALERT GROUP ({len(group)} correlated alerts; analyze as one incident, "
+                     "cover every alert in the result)\n"
+                     + json.dumps(group, ensure_ascii=False, indent=2 if ALERT_JSON_PRETTY else None))
+    elif ALERT_JSON_PRETTY and isinstance(body.get("alert"), dict):
         parts.append("## ALERT JSON\n" + json.dumps(body["alert"], ensure_ascii=False, indent=2))
 
-    return "\n\n".join(parts).strip()
+    prompt = "\n\n".join(parts).strip()
+    dynamic_tokens = sum(prompt_budget.approx_tokens(p) for p in parts[1:])
+    stats = {
+        "tokens": prefix_tokens + dynamic_tokens,
+        "bytes": len(prompt.encode("utf-8")),
+        "budget": PROMPT_TOKEN_BUDGET,
+        "over_budget": PROMPT_TOKEN_BUDGET > 0 and prefix_tokens + dynamic_tokens > PROMPT_TOKEN_BUDGET,
+        "prefix": {"sha1": prefix.sha1, "bytes": prefix.nbytes, "tokens": prefix_tokens, "cached": cached,
+                   "dropped_sections": prefix.meta.get("dropped_sections", []),
+                   "truncated_sections": prefix.meta.get("truncated_sections", [])},
+        "alert": {"tokens": dynamic_tokens, **alert_stats},
+    }
+    _M_PROMPT_TOKENS.observe(stats["tokens"], sop_id=sop_id)
+    return prompt, stats, _ECHO_INDEXES.get(prefix.sha1, prefix.text)
 
-# 简单回显判定：丢弃明显与 Prompt 回显的片段（避免把大 Prompt 当输出返回）
-def _looks_like_prompt_echo(content: str, prompt: str) -> bool:
-    try:
-        if not content:
-            return False
-        c = (content or "").strip()
-        if not c:
-            return False
-        # 典型前缀：TASK / SOP / ALERT / !>
-        head = c[:64].lower()
-        if head.startswith("## task") or head.startswith("## sop") or head.startswith("## alert") or head.startswith("!>"):  # noqa: E501
-            return True
-        # 子串高度重合（短片段且完全出现在 prompt 中）
-        p = (prompt or "").lower()
-        cc = c.lower()
-        if len(cc) <= 256 and cc in p:
-            return True
-        # 基于 token 粗匹配的相似度
-        import re
-        words_c = set(re.findall(r"[a-z0-9_\-]+", cc))
-        words_p = set(re.findall(r"[a-z0-9_\-]+", p))
-        if words_c:
-            inter = len(words_c & words_p)
-            if inter / max(1, len(words_c)) >= 0.7 and len(cc) <= 1024:
-                return True
-        return False
-    except Exception:
-        return False
+def _build_prompt(body: Dict[str, Any], sop_id: str, allow_tools: bool = True, boundary_id: Optional[str] = None,
+                  prompt_sop_id: Optional[str] = None) -> str:
+    return _build_prompt_ex(body, sop_id, allow_tools, boundary_id, prompt_sop_id)[0]
+
+# 日志/映射等追加写统一交给后台批量写入，请求路径不做同步磁盘 I/O
+WRITER_MAX_QUEUE = int(os.getenv("WRITER_MAX_QUEUE", "10000"))
+WRITER_FLUSH_INTERVAL = float(os.getenv("WRITER_FLUSH_INTERVAL", "0.2"))
+_WRITER = AppendWriter(max_queue=WRITER_MAX_QUEUE, flush_interval=WRITER_FLUSH_INTERVAL)
+_PROMPT_LOG_DIR = Path(__file__).resolve().parents[1] / "logs"
 
 def _log_prompt(sop_id: str, prompt: str) -> None:
     try:
-        proj_dir = Path(__file__).resolve().parents[1]
-        log_dir = proj_dir / "logs"
-        log_dir.mkdir(parents=True, exist_ok=True)
-        log_file = log_dir / f"prompts_{sop_id}.log"
         ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        with log_file.open("a", encoding="utf-8") as f:
-            f.write(f"\n===== {ts} sop_id={sop_id} =====\n")
-            f.write(prompt)
-            f.write("\n")
+        _WRITER.append(_PROMPT_LOG_DIR / f"prompts_{sop_id}.log",
+                       f"\n===== {ts} sop_id={sop_id} =====\n{prompt}\n")
     except Exception:
         pass
 
@@ -206,8 +250,16 @@ def _looks_like_tool_unavailable(text: str) -> bool:
     return bool(_TOOL_FAIL_PAT.search(text or ""))
 
 # 进程/会话目录辅助
+_Q_PIDS = QPidRegistry(SESSION_ROOT)
+
+def _session_pids(dir_path: Path) -> list[int]:
+    """会话目录下存活的 q 进程：优先读 q_entry.sh 写的 .qpids 登记；旧版入口脚本启动的会话退回扫描 /proc。"""
+    if _Q_PIDS.has_registry(dir_path):
+        return _Q_PIDS.pids_for(dir_path)
+    return _pids_q_using_dir(dir_path)
+
 def _pids_q_using_dir(dir_path: Path) -> list[int]:
-    """找出 cwd==dir_path 的 q 进程 PID 列表"""
+    """找出 cwd==dir_path 的 q 进程 PID 列表（全量扫描 /proc）"""
     pids: list[int] = []
     try:
         for pid in os.listdir("/proc"):
@@ -227,116 +279,163 @@ def _pids_q_using_dir(dir_path: Path) -> list[int]:
         pass
     return pids
 
-def _purge_session_dir(sop_dir: Path) -> tuple[bool, str]:
-    """
-    安全删除会话目录：仅允许删除 SESSION_ROOT 下的子目录；
-    先 SIGTERM 优雅退出占用的 q 进程，最多等 5s；仍存活则 SIGKILL；最后 rm -rf。
-    """
-    try:
-        sop_dir = sop_dir.resolve()
-        root = SESSION_ROOT.resolve()
-        # 必须在 SESSION_ROOT 下，且不是根本身
-        sop_dir.relative_to(root)
-        if sop_dir == root:
-            return False, "refuse to delete SESSION_ROOT itself"
-        if not sop_dir.exists():
-            return True, "dir not found (already gone)"
-
-        pids = _pids_q_using_dir(sop_dir)
-        if pids:
-            for pid in pids:
-                try:
-                    os.kill(pid, signal.SIGTERM)
-                except Exception:
-                    pass
-            deadline = time.time() + 5.0
-            while time.time() < deadline:
-                alive = [pid for pid in pids if os.path.exists(f"/proc/{pid}")]
-                if not alive:
-                    break
-                time.sleep(0.2)
-            for pid in pids:
-                if os.path.exists(f"/proc/{pid}"):
-                    try:
-                        os.kill(pid, signal.SIGKILL)
-                    except Exception:
-                        pass
-
-        shutil.rmtree(sop_dir)
-        return True, "deleted"
-    except Exception as e:
-        return False, f"{type(e).__name__}: {e}"
+# 超时会话清理：后台终止 q 进程并删除会话目录，请求路径只登记任务（状态见 GET /purges/{purge_id}）
+PURGE_TERM_GRACE = float(os.getenv("PURGE_TERM_GRACE", "5"))  # SIGTERM 后等待退出的秒数，超时 SIGKILL
+_PURGER = PurgeService(SESSION_ROOT, _session_pids, term_grace_s=PURGE_TERM_GRACE)
 
 
+_INCIDENT_MAP_FILE = Path(__file__).resolve().parents[1] / "sop" / "incident_sop_map.jsonl"
+
 def _append_incident_sop_mapping(incident_key: Optional[str], sop_id: str) -> None:
     """将 incident_key 与 sop_id 的映射追加记录到 sop/incident_sop_map.jsonl（仅记录用途）。"""
     try:
         if not incident_key:
             return
-        proj_dir = Path(__file__).resolve().parents[1]
-        map_file = proj_dir / "sop" / "incident_sop_map.jsonl"
-        map_file.parent.mkdir(parents=True, exist_ok=True)
         rec = {
             "ts": int(time.time()),
             "incident_key": incident_key,
             "sop_id": sop_id,
         }
-        with map_file.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        _WRITER.append(_INCIDENT_MAP_FILE, json.dumps(rec, ensure_ascii=False) + "\n")
     except Exception:
         pass
 
 
 QTTY_MAX_CONN = int(os.getenv("QTTY_MAX_CONN", "20"))
-_GLOBAL_CONN = 0
-_GLOBAL_LOCK: Lock = Lock()
+_GLOBAL_CONN = 0  # 已占用的全局连接额度，仅经 _take_global/_return_global 增减
 INIT_WAIT = float(os.getenv("INIT_WAIT", "5"))  # 非阻塞初始化等待秒数
+# 每个 sop 池的连接数：QTTY_POOL_SIZE 为默认值，QTTY_POOL_SIZES 可按 sop 覆盖（格式 "sop_a=4,sop_b=1"）
+QTTY_POOL_SIZE = max(1, int(os.getenv("QTTY_POOL_SIZE", "3")))
+QTTY_ACQUIRE_TIMEOUT = float(os.getenv("QTTY_ACQUIRE_TIMEOUT", "300"))  # 排队等待连接的最长秒数
+# 单个 sop 池的排队上限：池已满且排队数达到上限，或按平均分析耗时估算的等待超过 QTTY_ACQUIRE_TIMEOUT 时
+# 立即拒绝（429 + Retry-After），不在池内排到超时
+QTTY_POOL_MAX_WAITERS = int(os.getenv("QTTY_POOL_MAX_WAITERS", "10"))
+
+
+def _parse_pool_sizes(spec: str) -> Dict[str, int]:
+    sizes: Dict[str, int] = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            sizes[k.strip()] = max(1, int(v.strip()))
+        except ValueError:
+            continue
+    return sizes
+
+_POOL_SIZE_OVERRIDES = _parse_pool_sizes(os.getenv("QTTY_POOL_SIZES", ""))
+
+
+def _pool_size_for(sop_id: str) -> int:
+    return _POOL_SIZE_OVERRIDES.get(sop_id, QTTY_POOL_SIZE)
+
+
+def _take_global() -> bool:
+    global _GLOBAL_CONN
+    if _GLOBAL_CONN < QTTY_MAX_CONN:
+        _GLOBAL_CONN += 1
+        return True
+    return False
+
+
+def _return_global() -> None:
+    global _GLOBAL_CONN
+    if _GLOBAL_CONN > 0:
+        _GLOBAL_CONN -= 1
 
 
 class _PooledClient:
-    def __init__(self, client: TerminalAPIClient):
+    def __init__(self, client: TerminalAPIClient, idx: int = 0):
         self.client = client
-        self.lock: Lock = Lock()
+        self.idx = idx
+        self.busy: bool = False
         self.last_used: float = 0.0
+        self.origin: str = "sop"  # "spare" 表示由通用备用会话绑定而来
+        self.pid: Optional[int] = None  # 对应的 q 进程（由 .qpids 登记推断，未知为 None）
+
+class _IdleLRU:
+    """跨所有 sop 池的空闲连接 LRU（按最近释放排序）：touch/remove/取最旧均为 O(1)。
+    取最旧时排除某个池：该池的空闲连接全在队头时需要跳过，最多跳过它的空闲数（不超过池大小），
+    与总连接数无关；该池占满全部空闲连接时按计数直接返回 None。"""
+    def __init__(self):
+        self._od: "OrderedDict[_PooledClient, _QPool]" = OrderedDict()
+        self._per_pool: Dict["_QPool", int] = {}
+
+    def touch(self, pc: "_PooledClient", pool: "_QPool") -> None:
+        if pc not in self._od:
+            self._per_pool[pool] = self._per_pool.get(pool, 0) + 1
+        self._od[pc] = pool
+        self._od.move_to_end(pc)
+
+    def remove(self, pc: "_PooledClient") -> None:
+        pool = self._od.pop(pc, None)
+        if pool is None:
+            return
+        n = self._per_pool.get(pool, 0) - 1
+        if n > 0:
+            self._per_pool[pool] = n
+        else:
+            self._per_pool.pop(pool, None)
+
+    def oldest(self, exclude: Optional["_QPool"] = None) -> Optional[Tuple["_PooledClient", "_QPool"]]:
+        if exclude is not None and self._per_pool.get(exclude, 0) >= len(self._od):
+            return None
+        for pc, pool in self._od.items():
+            if pool is not exclude:
+                return pc, pool
+        return None
+
+    def __len__(self) -> int:
+        return len(self._od)
+
+_IDLE_LRU = _IdleLRU()
+_EVICTIONS: Counter = Counter()  # 按原因统计的连接关闭次数（lru / idle_ttl）
+
 
 class _QPool:
-    def __init__(self, sop_id: str, size: int = 1):
+    """
+    单个 sop 的连接池：最多 size 条常驻连接。
+    等待者按 FIFO 排队（future 交接，无轮询）；连接创建单飞（同一时刻每池最多一个创建任务）。
+    """
+    def __init__(self, sop_id: str, size: int = 1, evictable: bool = True):
         self.sop_id = sop_id
-        self.size = 1  # 简化为单连接
+        self.size = max(1, size)
+        self.evictable = evictable  # 是否参与全局 LRU 淘汰与空闲回收
         self._clients: List[_PooledClient] = []
-
-    async def _ensure_client(self) -> bool:
-        """如无客户端则懒创建一个；达到全局上限时尝试淘汰一条空闲连接。"""
-        global _GLOBAL_CONN
-        if self._clients:
+        self._idle: Deque[_PooledClient] = deque()
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._create_task: Optional[asyncio.Task] = None
+        self._next_idx = 0
+        self.retired = False  # 会话目录被清理后不再使用，见 retire()
+        # 统计：累计获取次数/等待总时长/最大等待
+        self.acquires = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+
+    async def _reserve_global(self, allow_evict: bool = True) -> bool:
+        """占用一个全局连接额度；达到上限时尝试淘汰一条空闲连接。"""
+        if _take_global():
             return True
-        # 全局额度
-        acquired = False
-        async with _GLOBAL_LOCK:
-            if _GLOBAL_CONN < QTTY_MAX_CONN:
-                _GLOBAL_CONN += 1
-                acquired = True
-        if not acquired:
-            # 尝试淘汰任意空闲
-            evicted = await _evict_one_idle()
-            if not evicted:
-                return False
-            async with _GLOBAL_LOCK:
-                if _GLOBAL_CONN < QTTY_MAX_CONN:
-                    _GLOBAL_CONN += 1
-                    acquired = True
-        if not acquired:
+        if not allow_evict or not await _evict_one_idle(exclude=self):
             return False
-        # 创建并短等初始化
+        return _take_global()
+
+    async def _open_client(self, ready_timeout: Optional[float] = None) -> Optional[TerminalAPIClient]:
+        """创建并短等初始化；失败返回 None。ready_timeout 指定时等待 Q 提示符就绪（用于预热）。"""
         try:
             print(f"[pool] create sop={self.sop_id} host={HOST} port={PORT}")
             cli = TerminalAPIClient(
                 host=HOST, port=PORT, terminal_type=TerminalType.QCLI,
                 url_query={"arg": self.sop_id}
             )
+            init_wait = INIT_WAIT
+            if ready_timeout is not None:
+                cli._init_ready_timeout_s = ready_timeout
+                init_wait = ready_timeout + INIT_WAIT
             ok = False
             try:
-                ok = await asyncio.wait_for(cli.initialize(), timeout=INIT_WAIT)
+                ok = await asyncio.wait_for(cli.initialize(), timeout=init_wait)
             except asyncio.TimeoutError:
                 ok = False
             except Exception:
@@ -351,90 +450,457 @@ class _QPool:
                     print(f"[pool] fallback setup failed sop={self.sop_id} err={e2}")
                     ok = False
             if ok:
-                self._clients.append(_PooledClient(cli))
-                print(f"[pool] ready sop={self.sop_id} size=1")
-                return True
+                return cli
         except Exception as e:
             print(f"[pool] create error sop={self.sop_id} err={e}")
-        # 失败则回收全局额度
-        async with _GLOBAL_LOCK:
-            if _GLOBAL_CONN > 0:
-                _GLOBAL_CONN -= 1
-        return False
+        return None
+
+    async def _add_client(self, allow_evict: bool = True,
+                          ready_timeout: Optional[float] = None) -> Tuple[Optional[_PooledClient], str]:
+        """占额度并创建一条连接，加入池并交接给等待者；失败返回 (None, 原因)。
+        按需创建时优先绑定一条已初始化的通用备用会话（额度随连接转移）。"""
+        origin = "sop"
+        cli = None
+        pid = None
+        if self.sop_id != SPARE_SOP_ID:
+            await _PURGER.wait_for(SESSION_ROOT / self.sop_id)
+        if allow_evict and self.sop_id != SPARE_SOP_ID:
+            spare = await _bind_spare(self.sop_id)
+            if spare is not None:
+                cli, pid, origin = spare.client, spare.pid, "spare"
+        if cli is None:
+            if not await self._reserve_global(allow_evict=allow_evict):
+                return None, "global cap"
+            # 同一池的创建是单飞的：建连前后 .qpids 的差集即为本连接的 q 进程
+            session_dir = SESSION_ROOT / self.sop_id
+            before = set(await asyncio.to_thread(_Q_PIDS.pids_for, session_dir))
+            cli = await self._open_client(ready_timeout=ready_timeout)
+            if cli is None:
+                _return_global()
+                return None, "create failed"
+            new_pids = set(await asyncio.to_thread(_Q_PIDS.pids_for, session_dir)) - before
+            if len(new_pids) == 1:
+                pid = new_pids.pop()
+        pc = _PooledClient(cli, idx=self._next_idx)
+        pc.last_used = time.time()
+        pc.origin = origin
+        pc.pid = pid
+        self._next_idx += 1
+        self._clients.append(pc)
+        if self.retired:
+            # 创建期间本池已退役：关闭新连接，交还额度
+            await self.discard(pc)
+            return None, "retired"
+        print(f"[pool] ready sop={self.sop_id} idx={pc.idx} size={len(self._clients)}/{self.size} origin={origin}")
+        self._hand_off(pc)
+        return pc, ""
+
+    def _maybe_grow(self) -> None:
+        """有等待者且未满时启动（唯一的）创建任务。"""
+        if not self._waiters or len(self._clients) >= self.size:
+            return
+        if self._create_task is not None and not self._create_task.done():
+            return
+        self._create_task = asyncio.create_task(self._grow())
 
-    async def acquire(self) -> Tuple[_PooledClient, int]:
-        have = await self._ensure_client()
-        if not have:
-            raise HTTPException(503, "no available connection (global cap)")
-        pc = self._clients[0]
-        waited = 0
-        while pc.lock.locked():
-            await asyncio.sleep(0.01)
-            waited += 1
-            if waited > 30000:
-                raise HTTPException(503, "acquire timeout")
-        await pc.lock.acquire()
+    async def _grow(self) -> None:
+        pc = None
+        try:
+            pc, why = await self._add_client()
+            # 本池无任何连接时，等待者无法被服务，直接失败；全局额度用尽属于过载（429 + Retry-After）
+            if pc is None and not self._clients:
+                if why == "global cap":
+                    self._fail_waiters(_ADMISSION.reject("global cap", len(self._waiters), QTTY_MAX_CONN))
+                else:
+                    self._fail_waiters(HTTPException(503, f"no available connection ({why})"))
+        except Exception as e:
+            # 创建任务异常退出时不能让等待者一直等到超时
+            print(f"[pool] grow error sop={self.sop_id} err={e}")
+            if not self._clients:
+                self._fail_waiters(HTTPException(503, f"no available connection (create error: {e})"))
+        finally:
+            self._create_task = None
+            if pc is not None:
+                self._maybe_grow()
+
+    async def prewarm(self, n: int, ready_timeout: float) -> int:
+        """预热至少 n 条连接（不淘汰其它池），等待 Q 提示符就绪；返回新建数量。"""
+        target = min(n, self.size)
+        made = 0
+        while len(self._clients) < target:
+            # 与按需创建共用单飞任务，避免并发重复建连
+            if self._create_task is not None and not self._create_task.done():
+                await asyncio.shield(self._create_task)
+                continue
+            task = asyncio.create_task(self._add_client(allow_evict=False, ready_timeout=ready_timeout))
+            self._create_task = task
+            try:
+                pc, why = await asyncio.shield(task)
+            finally:
+                if self._create_task is task:
+                    self._create_task = None
+            if pc is None:
+                print(f"[prewarm] stop sop={self.sop_id} reason={why}")
+                break
+            made += 1
+        self._maybe_grow()
+        return made
+
+    def _fail_waiters(self, exc: Exception) -> None:
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def _hand_off(self, pc: _PooledClient) -> None:
+        """把空闲连接交给队首等待者；无人等待则放回空闲队列。"""
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                pc.busy = True
+                fut.set_result(pc)
+                return
+        self._put_idle(pc)
+
+    def _put_idle(self, pc: _PooledClient) -> None:
+        pc.busy = False
+        self._idle.append(pc)
+        if self.evictable:
+            _IDLE_LRU.touch(pc, self)
+
+    def _pop_idle(self) -> _PooledClient:
+        pc = self._idle.popleft()
+        _IDLE_LRU.remove(pc)
+        return pc
+
+    def _take(self, pc: _PooledClient, waited: float) -> Tuple[_PooledClient, float]:
+        pc.busy = True
         pc.last_used = time.time()
-        print(f"[pool] acquire sop={self.sop_id} idx=0")
-        return pc, 0
+        self.acquires += 1
+        self.wait_total_s += waited
+        self.wait_max_s = max(self.wait_max_s, waited)
+        _M_ACQUIRE_WAIT.observe(waited, sop_id=self.sop_id)
+        print(f"[pool] acquire sop={self.sop_id} idx={pc.idx} wait_ms={int(waited * 1000)}")
+        return pc, waited
+
+    async def acquire(self, timeout: Optional[float] = None) -> Tuple[_PooledClient, float]:
+        """获取一条连接，返回 (连接, 等待秒数)。池满排队过长、等待超时或全局额度用尽抛 AdmissionRejected，无法创建时抛 503。"""
+        if timeout is None:
+            timeout = QTTY_ACQUIRE_TIMEOUT
+        t0 = time.monotonic()
+        if self._idle and not self._waiters:
+            return self._take(self._pop_idle(), 0.0)
+        if len(self._clients) >= self.size:
+            ahead = len(self._waiters)
+            if ahead >= QTTY_POOL_MAX_WAITERS:
+                raise _ADMISSION.reject("pool queue full", ahead, self.size)
+            if _ADMISSION.retry_after(ahead, self.size) > timeout:
+                raise _ADMISSION.reject("pool wait too long", ahead, self.size)
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        self._maybe_grow()
+        try:
+            done, _ = await asyncio.wait({fut}, timeout=timeout)
+        except asyncio.CancelledError:
+            self._abandon(fut)
+            raise
+        if not done:
+            self._abandon(fut)
+            raise _ADMISSION.reject("pool wait timeout", len(self._waiters), self.size)
+        pc = fut.result()  # 可能抛出 _fail_waiters 设置的异常
+        return self._take(pc, time.monotonic() - t0)
+
+    def _abandon(self, fut: asyncio.Future) -> None:
+        """放弃等待：若连接已交接给本 future，则转交下一位，避免泄漏。"""
+        if fut.done():
+            if not fut.cancelled() and fut.exception() is None:
+                self._hand_off(fut.result())
+            return
+        fut.cancel()
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
 
     async def release(self, pc: _PooledClient):
-        if pc.lock.locked():
-            pc.lock.release()
-            print(f"[pool] release sop={self.sop_id}")
+        if pc.busy:
+            pc.last_used = time.time()
+            print(f"[pool] release sop={self.sop_id} idx={pc.idx}")
             # 连接保持常驻
+            self._hand_off(pc)
 
+    def _detach(self, pc: _PooledClient) -> bool:
+        """从池结构中移除连接（不关闭、不回收额度）。"""
+        _IDLE_LRU.remove(pc)
+        try:
+            self._clients.remove(pc)
+        except ValueError:
+            return False
+        try:
+            self._idle.remove(pc)
+        except ValueError:
+            pass
+        return True
 
-CTRL_C = b"\x03"
-ENTER  = b"\r"
-
-async def _evict_one_idle() -> bool:
-    """在所有 sop 池中淘汰一个空闲连接（LRU），释放全局额度。"""
-    global _GLOBAL_CONN
-    # 选择最久未使用且未加锁的连接
-    candidate: Tuple[str, int, _PooledClient] | None = None
-    oldest = float('inf')
-    for sop, pool in list(_SOP_POOLS.items()):
-        for idx, pc in enumerate(pool._clients):
-            if pc.lock.locked():
-                continue
-            lu = pc.last_used or 0.0
-            if lu < oldest:
-                oldest = lu
-                candidate = (sop, idx, pc)
-    if not candidate:
-        return False
-    sop, idx, pc = candidate
-    try:
-        # 关闭并移除
+    async def discard(self, pc: _PooledClient):
+        """关闭并移除损坏连接，回收全局额度；如有等待者则补建。"""
+        pc.busy = False
+        detached = self._detach(pc)
         try:
             await pc.client.shutdown()
         except Exception:
             pass
-        pool = _SOP_POOLS.get(sop)
-        if pool:
-            try:
-                pool._clients.pop(idx)
-            except Exception:
-                pass
-            # 如果该 sop 已无连接，删除池条目
-            if not pool._clients:
-                _SOP_POOLS.pop(sop, None)
-        # 回收全局额度
-        async with _GLOBAL_LOCK:
-            if _GLOBAL_CONN > 0:
-                _GLOBAL_CONN -= 1
-        return True
+        _reap_q_process(pc)
+        if detached:
+            _return_global()
+            print(f"[pool] discard sop={self.sop_id} idx={pc.idx}")
+        self._maybe_grow()
+
+    async def retire(self, exc: Exception) -> int:
+        """会话目录将被清理（其中的 q 进程全部终止）：从 _SOP_POOLS 摘除本池，之后的请求使用新池；
+        等待者以 exc 失败，全部连接（包括正在使用的）关闭并交还额度。返回关闭的连接数。"""
+        self.retired = True
+        if _SOP_POOLS.get(self.sop_id) is self:
+            _SOP_POOLS.pop(self.sop_id, None)
+        self._fail_waiters(exc)
+        clients = list(self._clients)
+        for pc in clients:
+            await self.discard(pc)
+        print(f"[pool] retire sop={self.sop_id} closed={len(clients)}")
+        return len(clients)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "clients": len(self._clients),
+            "idle": len(self._idle),
+            "busy": sum(1 for pc in self._clients if pc.busy),
+            "from_spare": sum(1 for pc in self._clients if pc.origin == "spare"),
+            "waiters": len(self._waiters),
+            "creating": self._create_task is not None,
+            "acquires": self.acquires,
+            "wait_avg_ms": int(self.wait_total_s * 1000 / self.acquires) if self.acquires else 0,
+            "wait_max_ms": int(self.wait_max_s * 1000),
+        }
+
+
+CTRL_C = b"\x03"
+ENTER  = b"\r"
+
+async def _close_idle(pool: _QPool, pc: _PooledClient, reason: str) -> None:
+    """关闭一条空闲连接并回收全局额度；池空且无人等待时移除池条目。"""
+    # 先摘除再关闭，避免关闭期间被再次借出
+    if not pool._detach(pc):
+        return
+    _return_global()
+    _EVICTIONS[reason] += 1
+    if not pool._clients and not pool._waiters and _SOP_POOLS.get(pool.sop_id) is pool:
+        _SOP_POOLS.pop(pool.sop_id, None)
+    idle_s = int(time.time() - (pc.last_used or 0.0))
+    print(f"[pool] evict sop={pool.sop_id} idx={pc.idx} reason={reason} idle_s={idle_s}")
+    try:
+        await pc.client.shutdown()
     except Exception:
+        pass
+    _reap_q_process(pc)
+
+# 连接关闭后 ttyd 会挂断 q；超过 Q_EXIT_GRACE 秒仍存活则 SIGTERM/SIGKILL，避免残留进程占用内存
+Q_EXIT_GRACE = float(os.getenv("Q_EXIT_GRACE", "10"))
+_Q_REAP_TASKS: set = set()
+
+
+async def _ensure_q_exited(pid: int) -> None:
+    if await purge.wait_exit(pid, Q_EXIT_GRACE):
+        return
+    for sig, grace in ((signal.SIGTERM, PURGE_TERM_GRACE), (signal.SIGKILL, 2.0)):
+        if not _Q_PIDS.is_running(pid):
+            return
+        print(f"[pool] q still running after close pid={pid} send={sig.name}")
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            return
+        if await purge.wait_exit(pid, grace):
+            return
+
+
+def _reap_q_process(pc: _PooledClient) -> None:
+    if pc.pid is None:
+        return
+    task = asyncio.create_task(_ensure_q_exited(pc.pid))
+    _Q_REAP_TASKS.add(task)
+    task.add_done_callback(_Q_REAP_TASKS.discard)
+
+
+async def _evict_one_idle(exclude: Optional[_QPool] = None) -> bool:
+    """淘汰全局 LRU 中最久未用的空闲连接，释放全局额度。"""
+    item = _IDLE_LRU.oldest(exclude=exclude)
+    if item is None:
         return False
+    pc, pool = item
+    await _close_idle(pool, pc, "lru")
+    return True
+
+
+# 空闲回收：关闭空闲超过 QTTY_IDLE_TTL 秒的连接（0 表示关闭），不占用请求路径
+QTTY_IDLE_TTL = float(os.getenv("QTTY_IDLE_TTL", "1800"))
+QTTY_REAP_INTERVAL = float(os.getenv("QTTY_REAP_INTERVAL", "30"))
+_REAPER_TASK: Optional[asyncio.Task] = None
+_SOP_RELOAD_TASK: Optional[asyncio.Task] = None
+
+
+async def _reap_idle_once() -> int:
+    cutoff = time.time() - QTTY_IDLE_TTL
+    closed = 0
+    while True:
+        item = _IDLE_LRU.oldest()
+        if item is None or item[0].last_used > cutoff:
+            break
+        await _close_idle(item[1], item[0], "idle_ttl")
+        closed += 1
+    if closed:
+        print(f"[reaper] closed={closed} idle_left={len(_IDLE_LRU)} global={_GLOBAL_CONN} evictions={dict(_EVICTIONS)}")
+    return closed
+
+
+async def _reaper_loop() -> None:
+    while True:
+        await asyncio.sleep(QTTY_REAP_INTERVAL)
+        try:
+            await _reap_idle_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[reaper] error err={e}")
 
 _SOP_POOLS: Dict[str, _QPool] = {}
 
 def _get_pool(sop_id: str) -> _QPool:
     if sop_id not in _SOP_POOLS:
-        _SOP_POOLS[sop_id] = _QPool(sop_id, size=3)
+        _SOP_POOLS[sop_id] = _QPool(sop_id, size=_pool_size_for(sop_id))
     return _SOP_POOLS[sop_id]
 
+
+# 通用备用会话：以 SPARE_SOP_ID 启动、不续接历史的 Q 会话（MCP 已加载），新 sop 首次建连时直接绑定一条。
+# q 进程的工作目录无法在运行中切换（--resume 的历史按工作目录保存），因此只绑定给还没有会话状态的 sop
+# （q-sessions/<sop_id> 不存在或为空，即从未有 q 在其中运行过）：绑定时把 .qpids 登记移过去
+# （清理与按 sop 统计能找到该进程，目录也随之非空）；这次会话的历史不会被之后以 --resume 启动的 sop 会话续接。
+SPARE_SOP_ID = "_spare"
+SPARE_POOL_SIZE = int(os.getenv("SPARE_POOL_SIZE", "2"))  # 0 表示关闭
+
+_SPARE_POOL = _QPool(SPARE_SOP_ID, size=max(1, SPARE_POOL_SIZE), evictable=False)
+_SPARE_REFILL_TASK: Optional[asyncio.Task] = None
+
+
+def _schedule_spare_refill() -> None:
+    """后台补足备用会话（单飞；不淘汰任何 sop 连接）。"""
+    global _SPARE_REFILL_TASK
+    if SPARE_POOL_SIZE <= 0:
+        return
+    if _SPARE_REFILL_TASK is not None and not _SPARE_REFILL_TASK.done():
+        return
+    _SPARE_REFILL_TASK = asyncio.create_task(_SPARE_POOL.prewarm(SPARE_POOL_SIZE, PREWARM_READY_TIMEOUT))
+
+
+def _has_session_state(session_dir: Path) -> bool:
+    try:
+        with os.scandir(session_dir) as it:
+            return any(True for _ in it)
+    except OSError:
+        return False
+
+
+async def _bind_spare(sop_id: str) -> Optional[_PooledClient]:
+    """取出一条空闲备用会话并绑定到 sop_id（返回已从备用池摘除的连接）；sop 已有会话状态或无可用时返回 None。"""
+    if SPARE_POOL_SIZE <= 0 or not _SPARE_POOL._idle:
+        return None
+    # 先摘下再检查目录：并发新建的其它池在 await 期间看不到这条备用会话，不会重复取出
+    pc = _SPARE_POOL._pop_idle()
+    session_dir = SESSION_ROOT / sop_id
+    if await asyncio.to_thread(_has_session_state, session_dir):
+        _SPARE_POOL._put_idle(pc)
+        return None
+    _SPARE_POOL._detach(pc)
+    _schedule_spare_refill()
+    moved = False
+    if pc.pid is not None:
+        moved = await asyncio.to_thread(_Q_PIDS.move, pc.pid, SESSION_ROOT / SPARE_SOP_ID, session_dir)
+    if not moved:
+        # 登记缺失时也留下 .qpids 目录，标记该 sop 已有会话
+        await asyncio.to_thread((session_dir / PID_DIR).mkdir, parents=True, exist_ok=True)
+    print(f"[spare] bind sop={sop_id} spare_idx={pc.idx} pid={pc.pid} pid_moved={moved}")
+    return pc
+
+
+# 启动/周期预热：按 incident_sop_map.jsonl 的历史频次，为热门 sop 预建 Q 会话（等待提示符就绪）
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", "3"))  # 0 表示关闭预热
+PREWARM_SHARE = float(os.getenv("PREWARM_SHARE", "0.5"))  # 预热最多占用 QTTY_MAX_CONN 的比例
+PREWARM_INTERVAL = int(os.getenv("PREWARM_INTERVAL", "600"))  # 周期预热间隔秒数，0 表示仅启动时执行
+PREWARM_WINDOW_HOURS = float(os.getenv("PREWARM_WINDOW_HOURS", "168"))  # 仅统计最近窗口内的映射记录
+PREWARM_READY_TIMEOUT = float(os.getenv("PREWARM_READY_TIMEOUT", "120"))  # 等待 MCP 初始化/提示符的秒数
+
+_PREWARM_TASK: Optional[asyncio.Task] = None
+
+
+def _rank_hot_sops(limit: int) -> List[Tuple[str, int]]:
+    """统计映射文件中各 sop_id 的出现次数，返回最热的 limit 个。"""
+    if limit <= 0 or not _INCIDENT_MAP_FILE.exists():
+        return []
+    cutoff = time.time() - PREWARM_WINDOW_HOURS * 3600 if PREWARM_WINDOW_HOURS > 0 else 0
+    counts: Counter = Counter()
+    try:
+        with _INCIDENT_MAP_FILE.open("r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                sop = str(rec.get("sop_id", "")).strip() if isinstance(rec, dict) else ""
+                if not sop or (cutoff and int(rec.get("ts", 0) or 0) < cutoff):
+                    continue
+                counts[sop] += 1
+    except Exception as e:
+        print(f"[prewarm] read map failed err={e}")
+    return counts.most_common(limit)
+
+
+async def _prewarm_once() -> Dict[str, Any]:
+    """为热门 sop 各预热一条连接，总量不超过 QTTY_MAX_CONN * PREWARM_SHARE。"""
+    budget = int(QTTY_MAX_CONN * PREWARM_SHARE)
+    hot = await asyncio.to_thread(_rank_hot_sops, PREWARM_TOP_N)
+    targets: List[str] = []
+    for sop_id, _hits in hot:
+        if budget <= 0:
+            break
+        budget -= 1
+        pool = _get_pool(sop_id)
+        if not pool._clients:
+            targets.append(sop_id)
+
+    async def _warm(sop_id: str) -> int:
+        await asyncio.to_thread((SESSION_ROOT / sop_id).mkdir, parents=True, exist_ok=True)
+        return await _get_pool(sop_id).prewarm(1, PREWARM_READY_TIMEOUT)
+
+    t0 = time.time()
+    made = await asyncio.gather(*[_warm(s) for s in targets], return_exceptions=True)
+    warmed = [s for s, m in zip(targets, made) if isinstance(m, int) and m > 0]
+    print(f"[prewarm] hot={[s for s, _ in hot]} warmed={warmed} took_ms={int((time.time() - t0) * 1000)}")
+    return {"hot": hot, "warmed": warmed}
+
+
+async def _prewarm_loop() -> None:
+    while True:
+        try:
+            await _prewarm_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[prewarm] error err={e}")
+        if PREWARM_INTERVAL <= 0:
+            return
+        await asyncio.sleep(PREWARM_INTERVAL)
+
 async def _send_stdin_any(client, data: bytes) -> None:
     cm = getattr(client, "_connection_manager", None)
     if cm and hasattr(cm, "send_stdin") and callable(cm.send_stdin):
@@ -464,23 +930,170 @@ async def _kick_q_ready(client) -> None:
     except Exception:
         pass
 
-async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[str, Any]:
+# 请求追踪：响应 timings.phases 只列出以下阶段（span 名 -> 阶段名），完整 span 树见 timings.spans 与 span 文件
+_TRACE_PHASES = (("acquire", "acquire"), ("kick_ready", "kick_ready"), ("ttyd.send", "send"), ("echo", "echo"),
+                 ("tool_use", "tool_use"), ("generate", "generate"), ("await_prompt", "await_prompt"))
+TRACE_SPANS_PATH = os.getenv("TRACE_SPANS_PATH", str(Path(__file__).resolve().parents[1] / "logs" / "spans.jsonl"))  # 空为关闭
+TRACE_SPANS_MAX_BYTES = int(os.getenv("TRACE_SPANS_MAX_BYTES", str(20 * 1024 * 1024)))
+TRACE_SPANS_BACKUPS = int(os.getenv("TRACE_SPANS_BACKUPS", "5"))
+_SPAN_EXPORTER: Optional[tracing.SpanFileExporter] = None
+
+
+def _collect_timings(tr: tracing.Trace, root: tracing.Span) -> Dict[str, Any]:
+    spans = sorted(tr.subtree(root), key=lambda s: s.start)
+    by_name = tr.phases_ms(root)
+    return {
+        "phases": {phase: by_name[name] for name, phase in _TRACE_PHASES if name in by_name},
+        "spans": [{"name": s.name, "start_ms": int((s.start - root.start) * 1000), "duration_ms": s.duration_ms}
+                  for s in spans],
+    }
+
+
+def _export_trace(tr: tracing.Trace) -> None:
+    """span 写文件放到线程池，不阻塞事件循环；只导出上次导出之后结束的 span（可重复调用）。"""
+    global _SPAN_EXPORTER
+    if not TRACE_SPANS_PATH:
+        return
+    start, end = tr.exported, len(tr.spans)
+    if start >= end:
+        return
+    tr.exported = end
+    try:
+        if _SPAN_EXPORTER is None:
+            _SPAN_EXPORTER = tracing.SpanFileExporter(TRACE_SPANS_PATH, TRACE_SPANS_MAX_BYTES,
+                                                      TRACE_SPANS_BACKUPS, service=APP_NAME)
+        asyncio.get_running_loop().run_in_executor(None, _SPAN_EXPORTER.export, tr, start, end)
+    except Exception as e:
+        print(f"[trace] export error: {e}")
+
+
+async def _run_q_collect(sop_id: str, text: str, timeout: int = None,
+                         echo_base: Optional[EchoIndex] = None) -> Dict[str, Any]:
+    """在 q.collect span 下执行一次分析，结果附带 timings（阶段耗时与 span 列表）。"""
+    with tracing.span("q.collect", sop_id=sop_id) as sp:
+        res = await _q_collect(sop_id, text, timeout, echo_base)
+        if sp is not None:
+            sp.set(ok=res.get("ok"))
+            if res.get("error"):
+                sp.error = res["error"]
+    tr = tracing.current_trace()
+    if sp is not None and tr is not None:
+        # trace_id 标明这些 span 属于哪个 trace：合并/聚合的跟随请求据此只做关联，不复制 span
+        res["timings"] = {"trace_id": tr.trace_id, **_collect_timings(tr, sp)}
+    return res
+
+
+# 结果提前返回：内容流中出现闭合且字段齐全的结果 JSON 即结束请求，不再等待尾部 !> 提示重绘；
+# 连接在后台继续读到 complete（最多 RESULT_DRAIN_TIMEOUT 秒）再归还连接池，超时或出错则丢弃
+EARLY_RESULT = os.getenv("EARLY_RESULT", "1") not in ("0", "false", "False")
+RESULT_REQUIRED_KEYS = tuple(k.strip() for k in os.getenv("RESULT_REQUIRED_KEYS", "root_cause,evidence,confidence").split(",")
+                             if k.strip())
+RESULT_DRAIN_TIMEOUT = float(os.getenv("RESULT_DRAIN_TIMEOUT", "10"))
+_DRAIN_TASKS: set = set()
+
+# 工具调用时间线：每次分析最多 TOOL_TIMELINE_MAX 次调用；跨请求的每工具耗时见 GET /admin/tools
+# events 只保留前 EVENTS_MAX 条（连续的 thinking 只留第一条），其余计入 events_dropped
+TOOL_TIMELINE_MAX = int(os.getenv("TOOL_TIMELINE_MAX", "64"))
+EVENTS_MAX = int(os.getenv("EVENTS_MAX", "200"))
+_TOOL_STATS = ToolStats(window=int(os.getenv("TOOL_STATS_WINDOW", "500")))
+
+
+async def _drain_after_result(pool: _QPool, pc: _PooledClient, inner_task: asyncio.Task, sop_id: str) -> None:
+    """请求返回后读完尾部输出再归还连接。期间结束的 span（drain 及客户端内部 span）在请求的 trace 导出之后产生，
+    排空结束时单独补导出（同一 trace_id）。"""
+    start = time.time()
+    clean = False
+    try:
+        with tracing.span("drain", sop_id=sop_id) as sp:
+            try:
+                await asyncio.wait_for(inner_task, timeout=RESULT_DRAIN_TIMEOUT)
+                clean = True
+            except asyncio.TimeoutError:
+                print(f"[collect] drain timeout sop={sop_id} after={RESULT_DRAIN_TIMEOUT}s")
+            except Exception as e:
+                print(f"[collect] drain error sop={sop_id} err={e}")
+            if sp is not None:
+                sp.set(clean=clean)
+    finally:
+        tr = tracing.current_trace()
+        if tr is not None:
+            _export_trace(tr)
+        if DEBUG_STREAM:
+            print(f"[collect] drained sop={sop_id} clean={clean} ms={int((time.time() - start) * 1000)}")
+        try:
+            if clean:
+                await pool.release(pc)
+            else:
+                await pool.discard(pc)
+        except Exception:
+            pass
+
+
+# prompt 中的示例输出格式段（到下一个 ## 标题为止）及其中 "root_cause" 的示例值
+_TEMPLATE_BLOCK_PAT = re.compile(r"required json format[^\n]*\n(.*?)(?=\n##\s|\Z)", re.IGNORECASE | re.DOTALL)
+_TEMPLATE_ROOT_CAUSE_PAT = re.compile(r'"root_cause"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+def _template_root_causes(prompt: str) -> set:
+    """REQUIRED JSON FORMAT 示例中 root_cause 的字面值（小写、去首尾空白）。"""
+    values = set()
+    for block in _TEMPLATE_BLOCK_PAT.finditer(prompt or ""):
+        for m in _TEMPLATE_ROOT_CAUSE_PAT.finditer(block.group(1)):
+            try:
+                value = json.loads(m.group(1))
+            except ValueError:
+                continue
+            if str(value).strip():
+                values.add(str(value).strip().lower())
+    return values
+
+def _template_rejector(prompt: str):
+    """prompt 中 REQUIRED JSON FORMAT 的示例对象同样字段齐全；root_cause 等于示例值的视为回显。"""
+    examples = _template_root_causes(prompt)
+
+    def _reject(obj: Dict[str, Any]) -> Optional[str]:
+        rc = str(obj.get("root_cause", "")).strip().lower()
+        return "root_cause is the template example" if rc and rc in examples else None
+    return _reject
+
+
+async def _q_collect(sop_id: str, text: str, timeout: int = None,
+                     echo_base: Optional[EchoIndex] = None) -> Dict[str, Any]:
     if timeout is None:
         timeout = Q_OVERALL_TIMEOUT
     out_chunks: List[str] = []
     events: List[Dict[str, Any]] = []
     stream_error_detected = False
     stream_error_message = ""
+    reject = _template_rejector(text or "")
+    scanner = JsonResultScanner(RESULT_REQUIRED_KEYS, reject=reject)
+    result_ready = asyncio.Event()
+    finished_early = False
+    timeline = ToolTimeline(time.time(), TOOL_TIMELINE_MAX)
+    events_dropped = 0
+
+    def _keep_event(chunk: Dict[str, Any]) -> None:
+        nonlocal events_dropped
+        t = str(chunk.get("type", "")).lower()
+        if t != "error" and (len(events) >= EVENTS_MAX or
+                             (t == "thinking" and events and str(events[-1].get("type", "")).lower() == "thinking")):
+            events_dropped += 1
+            return
+        events.append(chunk)
 
     print(f"[collect] start sop={sop_id} timeout={timeout}")
+    collect_start = time.time()
 
     pool = _get_pool(sop_id)
-    pc: _PooledClient
+    pc: Optional[_PooledClient] = None
+    acquire_wait_ms = 0
     should_reset_client = False
     try:
-        pc, _ = await pool.acquire()
+        with tracing.span("acquire", sop_id=sop_id):
+            pc, waited = await pool.acquire()
+        acquire_wait_ms = int(waited * 1000)
         # 进入可聊天态
-        await _kick_q_ready(pc.client)
+        with tracing.span("kick_ready"):
+            await _kick_q_ready(pc.client)
 
         async def _inner():
             dbg_count = 0
@@ -513,7 +1126,36 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
 
             try:
                 first_meaningful_seen = False
+                # 回显判定器：前缀索引已缓存时只处理告警段（直接构造）；否则在线程中整段预处理（大 prompt 需数十毫秒）
+                if echo_base is not None:
+                    echo = PromptEchoDetector(prompt, echo_base)
+                else:
+                    echo = await asyncio.to_thread(PromptEchoDetector, prompt)
+                send_ts = time.time()
+                # 流阶段推算：echo（发送到首个非回显输出）/ generate（内容输出）/ await_prompt（最后内容到 complete）；
+                # tool_use 由工具时间线在结束后补记
+                content_ts: Optional[float] = None
+                last_content_ts: Optional[float] = None
+                echo_recorded = False
+
+                def _result_closed(s: str, now_ts: float) -> bool:
+                    if not scanner.feed(s) or not EARLY_RESULT:
+                        return False
+                    tracing.record_span("generate", content_ts, now_ts)
+                    result_ready.set()
+                    return True
+
                 async for chunk in pc.client.send_message_stream(prompt_to_send, silence_timeout=float(timeout)):
+                    if result_ready.is_set():
+                        # 结果已返回：只读到 complete 为止（不再记录内容、事件与 span），随后归还连接
+                        if isinstance(chunk, dict):
+                            t = str(chunk.get("type", "")).lower()
+                            if t == "complete":
+                                break
+                            if t == "error":
+                                meta = chunk.get("metadata") or {}
+                                raise RuntimeError(meta.get("error_message") or meta.get("message") or "stream error")
+                        continue
                     if DEBUG_STREAM:
                         dbg_count += 1
                         if dbg_count % 50 == 1:
@@ -530,28 +1172,56 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
 
                     if isinstance(chunk, str):
                         s = chunk
-                        if not first_meaningful_seen and _looks_like_prompt_echo(s, prompt):
+                        if not first_meaningful_seen and echo.is_echo(s):
+                            _M_ECHO_DROPS.inc(sop_id=sop_id)
                             if DEBUG_STREAM:
                                 print(f"[echo-drop] str {len(s)}B")
                             continue
+                        if not first_meaningful_seen:
+                            _M_FIRST_CHUNK.observe(time.time() - send_ts, sop_id=sop_id)
+                        if not echo_recorded:
+                            tracing.record_span("echo", send_ts)
+                            echo_recorded = True
                         first_meaningful_seen = True
+                        now_ts = time.time()
+                        timeline.output(s, now_ts)
+                        content_ts = content_ts or now_ts
+                        last_content_ts = now_ts
                         out_chunks.append(s)
+                        _result_closed(s, now_ts)
                         continue
                     if isinstance(chunk, dict):
                         t = str(chunk.get("type", "")).lower()
                         if t in ("content", "text", "delta", "stdout"):
                             s = (chunk.get("content") or chunk.get("text") or chunk.get("data") or "")
                             if s:
-                                if not first_meaningful_seen and _looks_like_prompt_echo(s, prompt):
+                                if not first_meaningful_seen and echo.is_echo(s):
+                                    _M_ECHO_DROPS.inc(sop_id=sop_id)
                                     if DEBUG_STREAM:
                                         print(f"[echo-drop] dict {t} {len(s)}B")
                                     continue
+                                if not first_meaningful_seen:
+                                    _M_FIRST_CHUNK.observe(time.time() - send_ts, sop_id=sop_id)
+                                if not echo_recorded:
+                                    tracing.record_span("echo", send_ts)
+                                    echo_recorded = True
                                 first_meaningful_seen = True
+                                now_ts = time.time()
+                                timeline.output(s, now_ts)
+                                content_ts = content_ts or now_ts
+                                last_content_ts = now_ts
                                 out_chunks.append(s)
+                                _result_closed(s, now_ts)
                         elif t in ("thinking", "tool_use", "pending", "notification", "tool", "meta"):
-                            events.append(chunk)
+                            if not echo_recorded:
+                                tracing.record_span("echo", send_ts)
+                                echo_recorded = True
+                            if t in ("tool_use", "tool"):
+                                meta = chunk.get("metadata") or {}
+                                timeline.start(str(meta.get("tool_name", "")), str(meta.get("mcp_server", "")), time.time())
+                            _keep_event(chunk)
                         elif t == "error":
-                            events.append(chunk)
+                            _keep_event(chunk)
                             if not stream_error_detected:
                                 stream_error_detected = True
                                 meta = chunk.get("metadata", {}) if isinstance(chunk, dict) else {}
@@ -565,9 +1235,13 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
                                     print("[echo-drop] ignore early complete before content")
                                 continue
                             print(f"[collect] complete sop={sop_id} chunks={len(out_chunks)} events={len(events)}")
+                            now_ts = time.time()
+                            if content_ts is not None:
+                                tracing.record_span("generate", content_ts, last_content_ts)
+                                tracing.record_span("await_prompt", last_content_ts, now_ts)
                             break
                         else:
-                            events.append(chunk)
+                            _keep_event(chunk)
                     else:
                         try:
                             out_chunks.append(str(chunk))
@@ -576,13 +1250,41 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
             finally:
                 nanny_task.cancel()
 
-        await asyncio.wait_for(_inner(), timeout=timeout)
+        inner_task = asyncio.create_task(_inner())
+        early_wait = asyncio.create_task(result_ready.wait())
+        try:
+            done, _ = await asyncio.wait((inner_task, early_wait), timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+            if inner_task.done():
+                inner_task.result()
+            else:
+                finished_early = True
+        except BaseException:
+            inner_task.cancel()
+            await asyncio.wait((inner_task,))
+            raise
+        finally:
+            early_wait.cancel()
+        if finished_early:
+            # 连接交给后台读完尾部输出，本请求立即返回
+            print(f"[collect] early result sop={sop_id} chunks={len(out_chunks)} events={len(events)}")
+            _M_EARLY_RESULTS.inc(sop_id=sop_id)
+            drain = asyncio.create_task(_drain_after_result(pool, pc, inner_task, sop_id))
+            _DRAIN_TASKS.add(drain)
+            drain.add_done_callback(_DRAIN_TASKS.discard)
+            pc = None
         ok = True
         err = ""
+    except AdmissionRejected:
+        # 连接池过载：交给上层转换为 429 + Retry-After
+        raise
     except asyncio.TimeoutError:
         ok = False
         err = f"timeout after {timeout}s"
         print(f"[collect] timeout sop={sop_id} err={err}")
+        _M_TIMEOUTS.inc(sop_id=sop_id)
         should_reset_client = True
     except Exception as e:
         ok = False
@@ -590,29 +1292,25 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
         print(f"[collect] error sop={sop_id} err={e}")
         should_reset_client = True
     finally:
-        # 释放连接
-        try:
-            await pool.release(pc)  # 内部已有 release 打印，这里不重复
-        except Exception:
-            pass
-        # 若需要，主动关闭并移除损坏连接，避免下次复用坏状态
-        if should_reset_client:
+        # 释放连接；若需要，主动关闭并移除损坏连接，避免下次复用坏状态
+        if pc is not None:
             try:
-                await pc.client.shutdown()
-            except Exception:
-                pass
-            try:
-                if pool._clients and pool._clients[0] is pc:
-                    pool._clients.pop(0)
-            except Exception:
-                pass
-            try:
-                async with _GLOBAL_LOCK:
-                    if _GLOBAL_CONN > 0:
-                        _GLOBAL_CONN -= 1
+                if should_reset_client:
+                    await pool.discard(pc)
+                else:
+                    await pool.release(pc)  # 内部已有 release 打印，这里不重复
             except Exception:
                 pass
 
+    # 工具时间线：关闭未结束的调用，补记 tool_use span 并计入跨请求统计
+    timeline.finish(time.time(), None if ok else ("timeout" if err.startswith("timeout") else "error"))
+    for call in timeline.closed():
+        tracing.record_span("tool_use", call.start, call.end, tool=call.tool, server=call.server)
+        _TOOL_STATS.record(call)
+        _M_TOOL_SECONDS.observe(call.duration_s, server=call.server, tool=call.tool)
+    if events_dropped or timeline.dropped:
+        print(f"[collect] sop={sop_id} events_dropped={events_dropped} tool_calls_dropped={timeline.dropped}")
+
     # 若流中检测到 error 事件，则将最终结果标记为失败，并填充错误信息
     if stream_error_detected:
         ok = False
@@ -620,6 +1318,10 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
             err = stream_error_message
 
     output_text = "".join(out_chunks)
+    # 解析结果：优先用流式扫描得到的对象，否则在完整输出中兜底查找
+    result = scanner.result
+    if result is None and ok and not stream_error_detected:
+        result = find_result(output_text, RESULT_REQUIRED_KEYS, reject)
     # 清理残余的 TASK/SOP/ALERT 标头行（防御性处理）
     try:
         lines = [ln for ln in output_text.splitlines() if ln.strip() and not ln.strip().lower().startswith(("## task", "## sop", "## alert"))]
@@ -631,7 +1333,11 @@ async def _run_q_collect(sop_id: str, text: str, timeout: int = None) -> Dict[st
         ok = False
         err = err or "no model content (prompt echo filtered)"
 
-    return {"ok": ok, "output": output_text, "events": events, "error": err}
+    outcome = "ok" if ok else ("timeout" if err.startswith("timeout") else "error")
+    _M_DURATION.observe(time.time() - collect_start, sop_id=sop_id, outcome=outcome)
+    return {"ok": ok, "output": output_text, "result": result, "result_early": finished_early,
+            "tool_timeline": timeline.to_list(), "events": events, "events_dropped": events_dropped,
+            "error": err, "acquire_wait_ms": acquire_wait_ms}
 
 def _improve_json_readability(json_str: str) -> str:
     """Improve readability of JSON text by adding spaces"""
@@ -667,33 +1373,537 @@ def _require_sop_inputs(body: Dict[str, Any]) -> str:
         return sop_id_from_incident_key(ik)
     raise HTTPException(400, "alert{service,category,severity,region,title} is required")
 
-def _resolve_sop_id(body: Dict[str, Any]) -> str:
+# SOP 规则匹配：告警的 incident_key 哈希没有对应 SOP 时，按 SOP 记录中的 keys（cat:/sev:/svc:，支持 *）选择
+SOP_MATCH_RULES = os.getenv("SOP_MATCH_RULES", "1") not in ("0", "false", "False")
+_SOP_MATCHER: Optional[SopMatcher] = None
+
+def _sop_matcher() -> SopMatcher:
+    """按当前 SOP 索引编译的匹配器；索引重建（generation 变化）后首次使用时重新编译。"""
+    global _SOP_MATCHER
+    matcher = _SOP_MATCHER
+    if matcher is not None and matcher.generation == _SOPS.generation:
+        return matcher
+    generation = _SOPS.generation
+    matcher = SopMatcher(((e.sop_id, e.record) for e in _SOPS.entries()), generation=generation)
+    _SOP_MATCHER = matcher
+    return matcher
+
+def _resolve_sop(body: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """解析 sop_id，并返回选择依据（method: explicit / incident_key / rules / hash）。
+    sop_id 始终是会话身份（连接池键、q-sessions 目录）；规则匹配只决定 prompt 中使用哪个 SOP（prompt_sop_id）。"""
     if "sop_id" in body and str(body["sop_id"]).strip():
-        return str(body["sop_id"]).strip()
+        sop_id = str(body["sop_id"]).strip()
+        return sop_id, {"method": "explicit", "prompt_sop_id": sop_id}
     if "incident_key" in body and str(body["incident_key"]).strip():
-        return sop_id_from_incident_key(str(body["incident_key"]).strip())
+        sop_id = sop_id_from_incident_key(str(body["incident_key"]).strip())
+        return sop_id, {"method": "incident_key", "prompt_sop_id": sop_id}
     # fallback to alert path
-    return _require_sop_inputs(body)
+    sop_id = _require_sop_inputs(body)
+    found = _SOPS.get(sop_id) is not None
+    if found or not SOP_MATCH_RULES:
+        return sop_id, {"method": "hash", "prompt_sop_id": sop_id, "sop_found": found}
+    match = _sop_matcher().match(body["alert"])
+    if match is None:
+        return sop_id, {"method": "hash", "prompt_sop_id": sop_id, "sop_found": False}
+    match = dict(match)
+    return sop_id, {"method": "rules", "prompt_sop_id": match.pop("sop_id"), **match}
 
+def _resolve_sop_id(body: Dict[str, Any]) -> str:
+    return _resolve_sop(body)[0]
 
-@app.get("/healthz")
-def healthz():
-    return {"ok": True, "service": APP_NAME}
 
-@app.post("/ask")
-@app.post("/ask_json")
-async def ask_json(request: Request):
-    req_start = time.time()
+# 单飞合并：同一 sop/incident_key/告警指纹 的并发请求共享一次 _run_q_collect
+_INFLIGHT: Dict[str, asyncio.Task] = {}
+
+
+def _flight_key(body: Dict[str, Any], sop_id: str, incident_key: Optional[str]) -> str:
+    alert = body.get("alert")
+    fp = alert_fingerprint(alert if isinstance(alert, dict) else body)
+    return f"{sop_id}|{incident_key or ''}|{fp}"
+
+
+def _start_flight(key: str, coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _INFLIGHT[key] = task
+
+    def _done(_t: asyncio.Task, k: str = key) -> None:
+        if _INFLIGHT.get(k) is _t:
+            _INFLIGHT.pop(k, None)
+    task.add_done_callback(_done)
+    return task
+
+
+# 结果缓存：完成的分析按 (sop, incident_key, 告警指纹) 缓存，TTL 按 severity 区分
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") not in ("0", "false", "False")
+RESULT_CACHE_TTLS = parse_ttls(os.getenv("RESULT_CACHE_TTLS", "critical=120,high=300,warning=600,info=1800"),
+                               float(os.getenv("RESULT_CACHE_TTL", "300")))
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "")  # 为空则不持久化
+_RESULT_CACHE = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "512")),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttls=RESULT_CACHE_TTLS,
+    persist_path=Path(RESULT_CACHE_PATH) if RESULT_CACHE_PATH else None,
+)
+
+
+def _cache_bypass(request: Request) -> bool:
+    """X-Cache-Bypass: 1 或 Cache-Control: no-cache 时跳过读缓存（结果仍会写回）。"""
+    if request.headers.get("x-cache-bypass", "0") not in ("0", "false", "False", ""):
+        return True
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+
+def _alert_severity(body: Dict[str, Any]) -> str:
+    alert = body.get("alert")
+    if isinstance(alert, dict) and alert.get("severity"):
+        return str(alert["severity"])
+    return str(body.get("severity", "") or "")
+
+
+# 准入队列：限制同时运行的分析数，按 severity 优先级排队；过载返回 429 + Retry-After
+_ADMISSION = AdmissionQueue(
+    max_active=int(os.getenv("ADMISSION_MAX_ACTIVE", str(QTTY_MAX_CONN))),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "50")),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "120")),
+    priorities=parse_priorities(os.getenv("ADMISSION_PRIORITIES", "critical=0,high=1,warning=2,info=3,default=2")),
+    default_service_s=float(os.getenv("ADMISSION_SERVICE_ESTIMATE", "60")),
+)
+
+
+async def _admitted_collect(severity: str, sop_id: str, prompt: str, timeout: int,
+                            echo_base: Optional[EchoIndex] = None) -> Dict[str, Any]:
+    async with _ADMISSION.slot(severity) as waited:
+        res = await _run_q_collect(sop_id, prompt, timeout=timeout, echo_base=echo_base)
+    res["admission_wait_ms"] = int(waited * 1000)
+    return res
+
+
+# 时间窗聚合：窗口内同一 service/category/region 的不同告警合并成一次分析，结果分发给组内每条告警
+GROUP_WINDOW_SECONDS = float(os.getenv("GROUP_WINDOW_SECONDS", "0"))  # 0 表示关闭
+GROUP_MAX_SIZE = int(os.getenv("GROUP_MAX_SIZE", "20"))
+GROUP_BY = [f.strip() for f in os.getenv("GROUP_BY", "service,category,region").split(",") if f.strip()]
+
+
+def _group_key(body: Dict[str, Any]) -> Optional[str]:
+    alert = body.get("alert")
+    if GROUP_WINDOW_SECONDS <= 0 or not isinstance(alert, dict):
+        return None
+    return group_key_from_alert(alert, GROUP_BY)
+
+
+async def _run_group(key: str, members: List[Tuple[Dict[str, Any], str, str]]) -> Dict[str, Any]:
+    """以组内最高优先级告警为主（其 sop 会话执行、使用其 SOP），把全部告警放进同一个 prompt。"""
+    lead_body, lead_sop, lead_prompt_sop = min(members, key=lambda m: _ADMISSION.priority(_alert_severity(m[0])))
+    alerts: List[Dict[str, Any]] = []
+    seen = set()
+    for b, _sop, _prompt_sop in members:
+        fp = alert_fingerprint(b["alert"])
+        if fp not in seen:
+            seen.add(fp)
+            alerts.append(b["alert"])
+    group_body = dict(lead_body, alerts=alerts)
+    prompt, prompt_stats, echo_base = await asyncio.to_thread(_render_prompt, group_body, lead_sop, True, None,
+                                                              lead_prompt_sop)
+    _log_prompt(lead_sop, prompt)
+    print(f"[group] run key={key} alerts={len(alerts)} members={len(members)} sop={lead_sop}")
+    res = await _admitted_collect(_alert_severity(lead_body), lead_sop, prompt, Q_OVERALL_TIMEOUT, echo_base)
+    res["prompt_stats"] = prompt_stats
+    res["group"] = {"key": key, "size": len(alerts), "sop_id": lead_sop,
+                    "incident_keys": sorted({build_incident_key_from_alert(a) for a in alerts})}
+    return res
+
+_GROUPER = WindowBatcher(GROUP_WINDOW_SECONDS, GROUP_MAX_SIZE, _run_group)
+
+
+async def _collect_for(body: Dict[str, Any], sop_id: str, prompt_sop_id: str) -> Dict[str, Any]:
+    """单条分析；开启聚合且为 alert 请求时，进入时间窗分组。"""
+    key = _group_key(body)
+    if key is not None:
+        return await _GROUPER.submit(key, (body, sop_id, prompt_sop_id))
+    # 仅发送一次：允许工具
+    prompt, prompt_stats, echo_base = await asyncio.to_thread(_render_prompt, body, sop_id, True, None, prompt_sop_id)
+    _log_prompt(sop_id, prompt)
+    res = await _admitted_collect(_alert_severity(body), sop_id, prompt, Q_OVERALL_TIMEOUT, echo_base)
+    res["prompt_stats"] = prompt_stats
+    return res
+
+
+# 异步任务：POST /jobs 立即返回 job_id，状态与结果存 SQLite，重启后可查询并续跑未完成任务
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", str(Path(__file__).resolve().parents[1] / "logs" / "jobs.sqlite3")))
+JOBS_RETENTION_HOURS = float(os.getenv("JOBS_RETENTION_HOURS", "72"))
+JOBS_MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", "60"))  # 长轮询单次最长等待秒数
+_JOB_STORE: Optional[job_store.JobStore] = None
+_JOB_EVENTS: Dict[str, asyncio.Event] = {}
+_JOB_TASKS: set = set()
+
+
+def _jobs() -> job_store.JobStore:
+    global _JOB_STORE
+    if _JOB_STORE is None:
+        _JOB_STORE = job_store.JobStore(JOBS_DB_PATH)
+    return _JOB_STORE
+
+
+async def _run_job(job_id: str, body: Dict[str, Any], sop_id: str, ik: Optional[str],
+                   sop_match: Dict[str, Any]) -> None:
+    store = _jobs()
+    try:
+        await asyncio.to_thread(store.update, job_id, job_store.RUNNING)
+        out = await _analyze(body, sop_id, ik, sop_match)
+        status = job_store.DONE if out["ok"] else job_store.FAILED
+        await asyncio.to_thread(store.update, job_id, status, out, out.get("error") or None)
+    except AdmissionRejected as e:
+        await asyncio.to_thread(store.update, job_id, job_store.REJECTED, None,
+                                f"overloaded: {e.reason}; retry after {e.retry_after}s")
+    except asyncio.CancelledError:
+        # 进程退出：保持 running，重启后续跑
+        raise
+    except Exception as e:
+        await asyncio.to_thread(store.update, job_id, job_store.FAILED, None, f"{type(e).__name__}: {e}")
+    finally:
+        ev = _JOB_EVENTS.pop(job_id, None)
+        if ev is not None:
+            ev.set()
+        print(f"[jobs] finished job={job_id} sop={sop_id}")
+
+
+def _submit_job(job_id: str, body: Dict[str, Any], sop_id: str, ik: Optional[str],
+                sop_match: Dict[str, Any]) -> None:
+    _JOB_EVENTS[job_id] = asyncio.Event()
+    task = asyncio.create_task(_run_job(job_id, body, sop_id, ik, sop_match))
+    _JOB_TASKS.add(task)
+    task.add_done_callback(_JOB_TASKS.discard)
+
+
+async def _resume_jobs() -> None:
+    store = await asyncio.to_thread(_jobs)
+    if JOBS_RETENTION_HOURS > 0:
+        pruned = await asyncio.to_thread(store.prune, time.time() - JOBS_RETENTION_HOURS * 3600)
+        if pruned:
+            print(f"[jobs] pruned={pruned}")
+    for rec in await asyncio.to_thread(store.unfinished):
+        print(f"[jobs] resume job={rec['job_id']} sop={rec['sop_id']}")
+        # 会话身份沿用创建时的 sop_id；prompt 使用的 SOP 按当前索引重新选择
+        try:
+            _sop, how = _resolve_sop(rec["request"])
+        except HTTPException:
+            how = {"method": "stored", "prompt_sop_id": rec["sop_id"]}
+        _submit_job(rec["job_id"], rec["request"], rec["sop_id"], rec["incident_key"], how)
+
+
+# 事件循环阻塞监测：定时 sleep，实际唤醒延迟即为期间被同步代码占用的时间
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # 0 表示关闭
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.1"))
+_LOOP_LAG_TASK: Optional[asyncio.Task] = None
+_LOOP_LAG_MAX = 0.0
+
+
+async def _loop_lag_loop() -> None:
+    global _LOOP_LAG_MAX
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL)
+        _M_LOOP_LAG.observe(lag)
+        _LOOP_LAG_MAX = max(_LOOP_LAG_MAX, lag)
+        if lag >= LOOP_LAG_WARN:
+            print(f"[loop] blocked lag_ms={int(lag * 1000)}")
+
+
+async def _reload_sops(force: bool = False) -> bool:
+    changed = await asyncio.to_thread(_SOPS.reload, force)
+    if changed:
+        _PROMPT_PREFIXES.invalidate()
+        st = _SOPS.stats()
+        print(f"[sop] loaded generation={st['generation']} sops={st['sops']} bytes={st['bytes']} "
+              f"took_ms={st['load_ms']} errors={len(st['errors'])}")
+    return changed
+
+
+async def _sop_reload_loop():
+    while True:
+        await asyncio.sleep(SOP_RELOAD_INTERVAL)
+        try:
+            await _reload_sops()
+        except Exception as e:
+            print(f"[sop] reload failed err={e}")
+
+
+@app.on_event("startup")
+async def _start_background_tasks():
+    global _PREWARM_TASK, _REAPER_TASK, _LOOP_LAG_TASK, _SOP_RELOAD_TASK
+    try:
+        await _reload_sops(force=True)
+    except Exception as e:
+        print(f"[sop] load failed err={e}")
+    if SOP_RELOAD_INTERVAL > 0:
+        _SOP_RELOAD_TASK = asyncio.create_task(_sop_reload_loop())
+    if LOOP_LAG_INTERVAL > 0:
+        _LOOP_LAG_TASK = asyncio.create_task(_loop_lag_loop())
+    if PREWARM_TOP_N > 0:
+        _PREWARM_TASK = asyncio.create_task(_prewarm_loop())
+    _schedule_spare_refill()
+    if QTTY_IDLE_TTL > 0:
+        _REAPER_TASK = asyncio.create_task(_reaper_loop())
+    try:
+        await _resume_jobs()
+    except Exception as e:
+        print(f"[jobs] resume failed err={e}")
+    try:
+        n = await _PURGER.sweep_trash()
+        if n:
+            print(f"[purge] swept leftover trash entries={n}")
+    except Exception as e:
+        print(f"[purge] sweep failed err={e}")
+    if RESULT_CACHE_ENABLED and RESULT_CACHE_PATH:
+        try:
+            n = await asyncio.to_thread(_RESULT_CACHE.load)
+            print(f"[cache] loaded entries={n} path={RESULT_CACHE_PATH}")
+        except Exception as e:
+            print(f"[cache] load failed err={e}")
+
+@app.on_event("shutdown")
+async def _stop_background_tasks():
+    for task in (_PREWARM_TASK, _SPARE_REFILL_TASK, _REAPER_TASK, _LOOP_LAG_TASK, _SOP_RELOAD_TASK, *_JOB_TASKS,
+                 *_SSE_STREAMS.producers(), *_PURGER.tasks(), *_Q_REAP_TASKS,
+                 *_DRAIN_TASKS):
+        if task is not None:
+            task.cancel()
+    await _WRITER.close()
+    if RESULT_CACHE_ENABLED and RESULT_CACHE_PATH:
+        try:
+            n = await asyncio.to_thread(_RESULT_CACHE.save)
+            print(f"[cache] saved entries={n} path={RESULT_CACHE_PATH}")
+        except Exception as e:
+            print(f"[cache] save failed err={e}")
+
+def _collect_live_metrics():
+    """抓取时读取连接池/准入/缓存等实时状态。"""
+    yield ("q_gateway_global_connections", "gauge", "Connections holding a global slot (_GLOBAL_CONN)",
+           [({}, _GLOBAL_CONN)])
+    yield ("q_gateway_max_connections", "gauge", "Global connection cap (QTTY_MAX_CONN)", [({}, QTTY_MAX_CONN)])
+    pools = dict(_SOP_POOLS)
+    pools[SPARE_SOP_ID] = _SPARE_POOL
+    conns, waiters, sizes, rx_bytes, rx_msgs, rss = [], [], [], [], [], []
+    for sop, pool in pools.items():
+        st = pool.stats()
+        conns.append(({"sop_id": sop, "state": "idle"}, st["idle"]))
+        conns.append(({"sop_id": sop, "state": "busy"}, st["busy"]))
+        waiters.append(({"sop_id": sop}, st["waiters"]))
+        sizes.append(({"sop_id": sop}, pool.size))
+        for pc in list(pool._clients):
+            labels = {"sop_id": sop, "conn": str(pc.idx)}
+            if pc.pid is not None:
+                n = rss_bytes(pc.pid)
+                if n is not None:
+                    rss.append((labels, n))
+            ws = getattr(getattr(pc.client, "_connection_manager", None), "_client", None)
+            if ws is None:
+                continue
+            rx_bytes.append((labels, getattr(ws, "bytes_received", 0)))
+            rx_msgs.append((labels, getattr(ws, "messages_received", 0)))
+    yield ("q_gateway_pool_connections", "gauge", "Pooled connections per SOP by state", conns)
+    yield ("q_gateway_pool_waiters", "gauge", "Requests waiting for a connection per SOP", waiters)
+    yield ("q_gateway_pool_size", "gauge", "Configured pool size per SOP", sizes)
+    yield ("q_gateway_connection_received_bytes_total", "counter", "Bytes received from ttyd per connection", rx_bytes)
+    yield ("q_gateway_connection_received_messages_total", "counter", "ttyd messages received per connection", rx_msgs)
+    yield ("q_gateway_q_process_rss_bytes", "gauge", "Resident memory of the q process behind each connection", rss)
+    yield ("q_gateway_evictions_total", "counter", "Pooled connections closed by reason",
+           [({"reason": r}, n) for r, n in sorted(_EVICTIONS.items())])
+    adm = _ADMISSION.stats()
+    yield ("q_gateway_admission_active", "gauge", "Analyses currently admitted", [({}, adm["active"])])
+    yield ("q_gateway_admission_queued", "gauge", "Analyses waiting for admission", [({}, adm["queued"])])
+    yield ("q_gateway_admission_rejected_total", "counter", "Admission rejections by reason",
+           [({"reason": r}, n) for r, n in sorted(adm["rejected"].items())])
+    cache = _RESULT_CACHE.stats()
+    yield ("q_gateway_result_cache_entries", "gauge", "Entries in the result cache", [({}, cache["entries"])])
+    yield ("q_gateway_result_cache_hits_total", "counter", "Result cache hits", [({}, cache["hits"])])
+    yield ("q_gateway_result_cache_misses_total", "counter", "Result cache misses", [({}, cache["misses"])])
+    sops = _SOPS.stats()
+    yield ("q_gateway_sop_index_entries", "gauge", "SOPs in the in-memory index", [({}, sops["sops"])])
+    yield ("q_gateway_sop_index_generation", "gauge", "Times the SOP index has been (re)built", [({}, sops["generation"])])
+    pp = _PROMPT_PREFIXES.stats()
+    yield ("q_gateway_prompt_prefix_entries", "gauge", "Compiled prompt prefixes in cache", [({}, pp["entries"])])
+    yield ("q_gateway_prompt_prefix_lookups_total", "counter", "Prompt prefix cache lookups by result",
+           [({"result": "hit"}, pp["hits"]), ({"result": "miss"}, pp["misses"])])
+    yield ("q_gateway_prompt_prefix_recompiles_total", "counter", "Prompt prefixes recompiled after a source file changed",
+           [({}, pp["recompiles"])])
+    ei = _ECHO_INDEXES.stats()
+    yield ("q_gateway_echo_index_lookups_total", "counter", "Prompt prefix echo index lookups by result",
+           [({"result": "hit"}, ei["hits"]), ({"result": "miss"}, ei["misses"])])
+    yield ("q_gateway_inflight_analyses", "gauge", "Single-flight analyses in progress", [({}, len(_INFLIGHT))])
+    yield ("q_gateway_event_loop_lag_max_seconds", "gauge", "Largest event loop lag observed since start",
+           [({}, _LOOP_LAG_MAX)])
+    w = _WRITER.stats()
+    yield ("q_gateway_writer_queued", "gauge", "Records waiting in the background file writer", [({}, w["queued"])])
+    yield ("q_gateway_writer_dropped_total", "counter", "Records dropped because the writer queue was full",
+           [({}, w["dropped"])])
+    yield ("q_gateway_writer_bytes_total", "counter", "Bytes appended by the background file writer",
+           [({}, w["bytes_written"])])
+
+_METRICS.add_collector(_collect_live_metrics)
+
+
+@app.get("/metrics")
+async def metrics():
+    # 在事件循环中生成：采集器遍历的连接池/LRU 等结构只在循环内修改，放到线程池会与之并发
+    return PlainTextResponse(_METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/purges")
+def purges_recent(limit: int = 50):
+    return {"purges": _PURGER.recent(max(1, min(limit, 200)))}
+
+
+@app.get("/purges/{purge_id}")
+def purge_status(purge_id: str):
+    job = _PURGER.get(purge_id)
+    if job is None:
+        raise HTTPException(404, f"purge not found: {purge_id}")
+    return job.to_dict()
+
+
+@app.get("/admin/sops")
+async def admin_sops():
+    """SOP 索引概况与每个 SOP 的来源、渲染后字节数。"""
+    entries = sorted(_SOPS.entries(), key=lambda e: e.sop_id)
+    return {**_SOPS.stats(), "matcher": _sop_matcher().stats(), "items": [e.to_dict() for e in entries]}
+
+
+@app.post("/admin/sops/match")
+async def admin_sops_match(request: Request):
+    """试算：请求体为 {"alert": {...}}，返回将选中的 sop_id 与匹配说明（不执行分析）。"""
     try:
         body = await request.json()
     except Exception:
         raise HTTPException(400, "expect JSON body")
+    if not isinstance(body, dict) or not isinstance(body.get("alert"), dict):
+        raise HTTPException(400, "alert is required")
+    sop_id, how = _resolve_sop(body)
+    candidates = _sop_matcher().candidates(body["alert"])
+    return {"sop_id": sop_id, "sop_match": how,
+            "candidates": [{"sop_id": r.sop_id, "priority": r.priority, "specificity": r.specificity}
+                           for r in candidates]}
+
+
+@app.post("/admin/sops/reload")
+async def admin_sops_reload():
+    """立即重建 SOP 索引（不等后台检查周期）。"""
+    await _reload_sops(force=True)
+    return _SOPS.stats()
+
+
+@app.get("/admin/tools")
+async def admin_tools():
+    """跨请求的工具调用耗时：按 MCP server 汇总（含占全部工具耗时的比例）与按工具的次数、错误、分位数。"""
+    return _TOOL_STATS.snapshot()
+
+
+@app.get("/healthz")
+def healthz():
+    return {"ok": True, "service": APP_NAME}
+
+
+# 就绪探测：ttyd 握手（不发送初始化消息，ttyd 不会因此拉起 q）与 q 进程扫描结果缓存 READY_PROBE_TTL 秒
+READY_PROBE_TTL = float(os.getenv("READY_PROBE_TTL", "5"))
+READY_PROBE_TIMEOUT = float(os.getenv("READY_PROBE_TIMEOUT", "2"))
+READY_MIN_FREE = int(os.getenv("READY_MIN_FREE", "1"))  # 可立即服务新请求的最少连接数（空闲 + 未占用名额）
+_READY_PROBE: Dict[str, Any] = {"at": 0.0, "result": None}
+_READY_PROBE_TASK: Optional[asyncio.Task] = None
+
+
+async def _probe_ttyd() -> Dict[str, Any]:
+    import websockets
+    probe = TtydWebSocketClient(host=HOST, port=PORT)
+    t0 = time.time()
+    try:
+        ws = await asyncio.wait_for(
+            websockets.connect(probe.url, subprotocols=["tty"],
+                               additional_headers={"Authorization": f"Basic {probe.auth_token}"},
+                               open_timeout=READY_PROBE_TIMEOUT, ping_interval=None),
+            timeout=READY_PROBE_TIMEOUT)
+        await ws.close()
+        return {"ok": True, "latency_ms": int((time.time() - t0) * 1000), "error": ""}
+    except Exception as e:
+        return {"ok": False, "latency_ms": int((time.time() - t0) * 1000), "error": f"{type(e).__name__}: {e}"}
+
+
+def _count_q_processes() -> Dict[str, Any]:
+    """按会话目录（SESSION_ROOT 下的 sop_id）统计存活的 q 进程（读取 .qpids 登记，不扫描 /proc）。"""
+    by_sop = _Q_PIDS.counts()
+    return {"total": sum(by_sop.values()), "by_sop": by_sop}
+
+
+async def _run_ready_probe() -> Dict[str, Any]:
+    ttyd, procs = await asyncio.gather(_probe_ttyd(), asyncio.to_thread(_count_q_processes))
+    result = {"ttyd": ttyd, "q_processes": procs, "checked_at": time.time()}
+    _READY_PROBE.update(at=time.time(), result=result)
+    return result
+
+
+async def _ready_probe() -> Tuple[Dict[str, Any], bool]:
+    """返回 (探测结果, 是否来自缓存)；并发调用共享同一次探测。"""
+    global _READY_PROBE_TASK
+    if _READY_PROBE["result"] is not None and time.time() - _READY_PROBE["at"] < READY_PROBE_TTL:
+        return _READY_PROBE["result"], True
+    if _READY_PROBE_TASK is None or _READY_PROBE_TASK.done():
+        _READY_PROBE_TASK = asyncio.create_task(_run_ready_probe())
+    return await asyncio.shield(_READY_PROBE_TASK), False
+
+
+def _pool_readiness() -> Dict[str, Any]:
+    pools = dict(_SOP_POOLS)
+    if SPARE_POOL_SIZE > 0:
+        pools[SPARE_SOP_ID] = _SPARE_POOL
+    out: Dict[str, Any] = {}
+    idle_total = 0
+    for sop, pool in pools.items():
+        st = pool.stats()
+        states = Counter(getattr(pc.client.state, "value", str(pc.client.state)) for pc in list(pool._clients))
+        out[sop] = {"size": pool.size, "clients": st["clients"], "idle": st["idle"], "busy": st["busy"],
+                    "waiters": st["waiters"], "states": dict(states)}
+        idle_total += st["idle"]
+    return {"pools": out, "idle": idle_total}
+
+
+@app.get("/readyz")
+async def readyz():
+    """能否快速受理新分析：ttyd 可达、有空闲连接或剩余名额、准入队列未满；否则 503。"""
+    probe, cached = await _ready_probe()
+    pools = _pool_readiness()
+    free_slots = max(0, QTTY_MAX_CONN - _GLOBAL_CONN)
+    # 空闲连接可直接复用，或被 LRU 淘汰后为新 sop 腾出名额
+    free = free_slots + pools["idle"]
+    adm = _ADMISSION.stats()
+
+    reasons: List[str] = []
+    if not probe["ttyd"]["ok"]:
+        reasons.append(f"ttyd unreachable: {probe['ttyd']['error']}")
+    if free < READY_MIN_FREE:
+        reasons.append(f"no free capacity ({_GLOBAL_CONN}/{QTTY_MAX_CONN} connections, none idle)")
+    if adm["max_queue"] > 0 and adm["queued"] >= adm["max_queue"]:
+        reasons.append(f"admission queue full ({adm['queued']}/{adm['max_queue']})")
+
+    body = {
+        "ready": not reasons,
+        "reasons": reasons,
+        "service": APP_NAME,
+        "ttyd": dict(probe["ttyd"], cached=cached, checked_at=probe["checked_at"]),
+        "capacity": {"max_conn": QTTY_MAX_CONN, "global_conn": _GLOBAL_CONN, "free_slots": free_slots,
+                     "idle": pools["idle"], "free": free},
+        "pools": pools["pools"],
+        "q_processes": probe["q_processes"],
+        "admission": adm,
+    }
+    return JSONResponse(body, status_code=200 if not reasons else 503)
 
+def _prepare_analysis(body: Dict[str, Any]) -> Tuple[str, Optional[str], Dict[str, Any]]:
+    """校验请求体，解析 sop_id、incident_key 与 SOP 选择依据（sop_match），并记录映射。"""
     # 不允许传 text（只接受 alert / sop_id / incident_key）
     if "text" in body and str(body["text"]).strip():
         raise HTTPException(400, "text is not allowed; provide alert/sop_id/incident_key only")
 
-    sop_id = _resolve_sop_id(body)
+    sop_id, sop_match = _resolve_sop(body)
     (SESSION_ROOT / sop_id).mkdir(parents=True, exist_ok=True)
 
     # 记录 incident_key 与 sop_id 的映射（若存在 incident_key）
@@ -704,23 +1914,96 @@ async def ask_json(request: Request):
         except Exception:
             ik = None
     _append_incident_sop_mapping(ik, sop_id)
+    return sop_id, ik, sop_match
 
+
+async def _analyze(body: Dict[str, Any], sop_id: str, ik: Optional[str], sop_match: Dict[str, Any],
+                   bypass: bool = False, req_start: Optional[float] = None) -> Dict[str, Any]:
+    """执行一次分析（缓存 -> 单飞合并 -> 准入 -> Q），返回响应体（含 timings）；过载时抛 AdmissionRejected。"""
+    if req_start is None:
+        req_start = time.time()
+    try:
+        with tracing.trace("analyze", sop_id=sop_id, incident_key=ik or "") as tr:
+            out = await _analyze_once(body, sop_id, ik, sop_match.get("prompt_sop_id") or sop_id, bypass, req_start)
+            collect = out.get("timings") or {}
+            # 合并的跟随者/聚合组的非领头成员：Q 阶段的 span 属于另一个 trace，只记录关联，不复制
+            linked = collect.get("trace_id") if collect.get("trace_id") not in (None, tr.trace_id) else None
+            tr.root.set(ok=out["ok"], cached=out["cached"], coalesced=out["coalesced"], linked_trace_id=linked)
+    finally:
+        _export_trace(tr)
+    own = tr.phases_ms()
+    phases = {"cache_lookup": own.get("cache_lookup", 0)}
+    out = dict(out)
+    if linked:
+        phases["coalesced_wait"] = own.get("coalesced_wait", 0)
+        out["timings"] = {"trace_id": tr.trace_id, "linked_trace_id": linked, "total_ms": out["total_ms"],
+                          "phases": phases, "spans": []}
+    else:
+        phases["admission_wait"] = out.get("admission_wait_ms", 0)
+        phases.update(collect.get("phases", {}))
+        out["timings"] = {"trace_id": tr.trace_id, "total_ms": out["total_ms"], "phases": phases,
+                          "spans": collect.get("spans", [])}
+    out["sop_match"] = sop_match
+    return out
+
+
+async def _analyze_once(body: Dict[str, Any], sop_id: str, ik: Optional[str], prompt_sop_id: str,
+                        bypass: bool, req_start: float) -> Dict[str, Any]:
     attempts = []
     sop_used = sop_id
 
-    # 仅发送一次：允许工具
-    prompt = _build_prompt(body, sop_id, allow_tools=True)
-    _log_prompt(sop_id, prompt)
+    flight = _flight_key(body, sop_id, ik)
+    if RESULT_CACHE_ENABLED and not bypass:
+        with tracing.span("cache_lookup"):
+            hit = _RESULT_CACHE.get(flight)
+        if hit is not None:
+            cached_out, age_s = hit
+            out = dict(cached_out)
+            out.pop("timings", None)
+            out.update({"cached": True, "cache_age_ms": int(age_s * 1000), "coalesced": False,
+                        "total_ms": int((time.time() - req_start) * 1000)})
+            print(f"[ask_json] cache hit sop={sop_id} age_ms={out['cache_age_ms']}")
+            _M_REQUESTS.inc(result="cached")
+            return out
+
+    # 相同告警的并发请求合并为一次分析；领头请求断开不影响其它等待者（shield）
+    task = _INFLIGHT.get(flight)
+    coalesced = task is not None
     t0 = time.time()
-    res = await _run_q_collect(sop_id, prompt, timeout=Q_OVERALL_TIMEOUT)
-    attempts.append({"allow_tools": True, "took_ms": int((time.time()-t0)*1000), "ok": res.get("ok", False)})
+    if task is None:
+        task = _start_flight(flight, _collect_for(body, sop_id, prompt_sop_id))
+    else:
+        print(f"[ask_json] coalesced sop={sop_id} key={flight}")
+    try:
+        if coalesced:
+            # 跟随者只记录等待领头分析的时长，并以 linked_trace_id 关联领头请求的 trace
+            with tracing.span("coalesced_wait", flight=flight) as sp:
+                res = await asyncio.shield(task)
+                if sp is not None:
+                    sp.set(linked_trace_id=(res.get("timings") or {}).get("trace_id", ""))
+        else:
+            res = await asyncio.shield(task)
+    except AdmissionRejected as e:
+        print(f"[ask_json] rejected sop={sop_id} reason={e.reason} retry_after={e.retry_after}")
+        _M_REQUESTS.inc(result="rejected")
+        raise
+    attempts.append({"allow_tools": True, "took_ms": int((time.time()-t0)*1000), "ok": res.get("ok", False),
+                     "admission_wait_ms": res.get("admission_wait_ms", 0),
+                     "acquire_wait_ms": res.get("acquire_wait_ms", 0)})
 
     # 超时清理：若本次请求以超时失败，尝试安全删除本次使用的会话目录
     purged_on_timeout = False
     purge_reason = ""
-    if PURGE_ON_TIMEOUT and (not res.get("ok")) and ("timeout" in (res.get("error", "").lower())):
-        ok_del, why = _purge_session_dir(SESSION_ROOT / sop_used)
-        purged_on_timeout, purge_reason = ok_del, why
+    purge_id = ""
+    if PURGE_ON_TIMEOUT and not coalesced and not res.get("group") and (not res.get("ok")) and ("timeout" in (res.get("error", "").lower())):
+        # 清理会终止目录中的全部 q 进程：先让该 sop 的连接池退役，避免池中留下指向已终止进程的连接
+        pool = _SOP_POOLS.get(sop_used)
+        if pool is not None:
+            await pool.retire(HTTPException(503, f"session purged after timeout: {sop_used}"))
+        job = _PURGER.request(SESSION_ROOT / sop_used)
+        purge_id = job.id
+        purged_on_timeout = job.status not in (purge.FAILED, purge.REJECTED)
+        purge_reason = job.reason or "scheduled"
 
     total_ms = int((time.time() - req_start) * 1000)
     out = {
@@ -728,7 +2011,11 @@ async def ask_json(request: Request):
         "sop_id": sop_id,
         "sop_used": sop_used,
         "output": res.get("output", ""),
+        "result": res.get("result"),
+        "result_early": res.get("result_early", False),
+        "tool_timeline": res.get("tool_timeline", []),
         "events": res.get("events", []),
+        "events_dropped": res.get("events_dropped", 0),
         "error": res.get("error", ""),
         "retried_with_tools": False,
         "fell_back_offline": False,
@@ -736,16 +2023,284 @@ async def ask_json(request: Request):
         "retry_wait_seconds": 0,
         "purged_on_timeout": purged_on_timeout,
         "purge_reason": purge_reason,
+        "purge_id": purge_id,
+        "admission_wait_ms": res.get("admission_wait_ms", 0),
+        "acquire_wait_ms": res.get("acquire_wait_ms", 0),
+        "coalesced": coalesced,
+        "group": res.get("group"),
+        "prompt_stats": res.get("prompt_stats"),
+        "cached": False,
         "total_ms": total_ms,
+        "timings": res.get("timings"),
     }
+    _M_REQUESTS.inc(result="coalesced" if coalesced else ("ok" if out["ok"] else "error"))
+    if RESULT_CACHE_ENABLED and out["ok"] and not coalesced:
+        _RESULT_CACHE.put(flight, out, _RESULT_CACHE.ttl_for(_alert_severity(body)))
     try:
         print(f"[ask_json] done sop={sop_id} ok={out['ok']} total_ms={total_ms} attempts_ms={[a.get('took_ms') for a in attempts]}")
     except Exception:
         pass
+    return out
+
+
+def _overloaded(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(429, f"overloaded: {e.reason}", headers={"Retry-After": str(e.retry_after)})
+
+
+@app.post("/ask")
+@app.post("/ask_json")
+async def ask_json(request: Request):
+    req_start = time.time()
+    try:
+        body = await request.json()
+    except Exception:
+        raise HTTPException(400, "expect JSON body")
+
+    sop_id, ik, sop_match = _prepare_analysis(body)
+    try:
+        out = await _analyze(body, sop_id, ik, sop_match, bypass=_cache_bypass(request), req_start=req_start)
+    except AdmissionRejected as e:
+        raise _overloaded(e)
     return JSONResponse(out, status_code=200 if out["ok"] else 504)
 
 
+# 批量分析：一次请求提交多条告警，按 incident_key 去重，有界并发，按完成顺序以 NDJSON 流式返回
+ASK_BATCH_MAX = int(os.getenv("ASK_BATCH_MAX", "200"))
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "4"))
+
+
+def _batch_item_body(item: Any) -> Dict[str, Any]:
+    """批量元素既可以是裸 alert，也可以是与 /ask_json 相同的请求体。"""
+    if isinstance(item, dict) and any(k in item for k in ("alert", "sop_id", "incident_key")):
+        return item
+    return {"alert": item}
+
+
+@app.post("/ask_batch")
+async def ask_batch(request: Request):
+    try:
+        body = await request.json()
+    except Exception:
+        raise HTTPException(400, "expect JSON body")
+    items = body.get("alerts") if isinstance(body, dict) else body
+    if not isinstance(items, list) or not items:
+        raise HTTPException(400, "alerts[] is required")
+    if len(items) > ASK_BATCH_MAX:
+        raise HTTPException(413, f"too many alerts: {len(items)} > {ASK_BATCH_MAX}")
+    bypass = _cache_bypass(request)
+
+    # 解析与去重：同一 incident_key（无则 sop_id）只分析一次
+    groups: Dict[str, List[int]] = {}
+    prepared: Dict[str, Tuple[Dict[str, Any], str, Optional[str], Dict[str, Any]]] = {}
+    errors: List[Dict[str, Any]] = []
+    for i, item in enumerate(items):
+        item_body = _batch_item_body(item)
+        try:
+            sop_id, ik, sop_match = _prepare_analysis(item_body)
+        except HTTPException as e:
+            errors.append({"type": "result", "index": i, "status": e.status_code, "ok": False, "error": e.detail})
+            continue
+        key = ik or sop_id
+        if key not in groups:
+            groups[key] = []
+            prepared[key] = (item_body, sop_id, ik, sop_match)
+        groups[key].append(i)
+
+    sem = asyncio.Semaphore(max(1, ASK_BATCH_CONCURRENCY))
+
+    async def _one(key: str) -> Tuple[str, int, Dict[str, Any]]:
+        item_body, sop_id, ik, sop_match = prepared[key]
+        async with sem:
+            try:
+                out = await _analyze(item_body, sop_id, ik, sop_match, bypass=bypass)
+                return key, (200 if out["ok"] else 504), out
+            except AdmissionRejected as e:
+                return key, 429, {"ok": False, "sop_id": sop_id, "error": f"overloaded: {e.reason}",
+                                  "retry_after": e.retry_after}
+            except Exception as e:
+                return key, 500, {"ok": False, "sop_id": sop_id, "error": f"{type(e).__name__}: {e}"}
+
+    async def _gen():
+        t0 = time.time()
+        for line in errors:
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        tasks = [asyncio.create_task(_one(k)) for k in groups]
+        ok_count = 0
+        try:
+            for fut in asyncio.as_completed(tasks):
+                key, status, out = await fut
+                ok_count += 1 if status == 200 else 0
+                first = groups[key][0]
+                for idx in groups[key]:
+                    line = {"type": "result", "index": idx, "incident_key": prepared[key][2],
+                            "sop_id": prepared[key][1], "status": status, "ok": bool(out.get("ok")),
+                            "dedup_of": first if idx != first else None, "result": out}
+                    yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+        finally:
+            for t in tasks:
+                t.cancel()
+        summary = {"type": "summary", "alerts": len(items), "analyses": len(groups), "ok": ok_count,
+                   "invalid": len(errors), "total_ms": int((time.time() - t0) * 1000)}
+        print(f"[ask_batch] done {summary}")
+        yield json.dumps(summary) + "\n"
+
+    return StreamingResponse(_gen(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs")
+async def create_job(request: Request):
+    try:
+        body = await request.json()
+    except Exception:
+        raise HTTPException(400, "expect JSON body")
+
+    sop_id, ik, sop_match = _prepare_analysis(body)
+    job_id = uuid.uuid4().hex
+    await asyncio.to_thread(_jobs().create, job_id, sop_id, ik, body)
+    _submit_job(job_id, body, sop_id, ik, sop_match)
+    print(f"[jobs] created job={job_id} sop={sop_id}")
+    return JSONResponse({
+        "job_id": job_id,
+        "status": job_store.QUEUED,
+        "sop_id": sop_id,
+        "incident_key": ik,
+        "links": {"self": f"/jobs/{job_id}", "wait": f"/jobs/{job_id}/wait"},
+    }, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    rec = await asyncio.to_thread(_jobs().get, job_id)
+    if rec is None:
+        raise HTTPException(404, f"job not found: {job_id}")
+    return rec
+
+
+@app.get("/jobs/{job_id}/wait")
+async def wait_job(job_id: str, timeout: float = 30.0):
+    """长轮询：任务结束或等待 timeout 秒（不超过 JOBS_MAX_WAIT）后返回当前状态。"""
+    ev = _JOB_EVENTS.get(job_id)
+    if ev is not None:
+        try:
+            await asyncio.wait_for(ev.wait(), timeout=max(0.0, min(timeout, JOBS_MAX_WAIT)))
+        except asyncio.TimeoutError:
+            pass
+    rec = await asyncio.to_thread(_jobs().get, job_id)
+    if rec is None:
+        raise HTTPException(404, f"job not found: {job_id}")
+    return rec
+
+
 # 流式接口：边收边回，避免链路读超时
+# SSE 模式（Accept: text/event-stream）：Q 输出在后台写入重放缓冲，断线后 GET /call_stream/{stream_id}
+# 带 Last-Event-ID 续传；无事件期间每 SSE_PING_SECONDS 秒发送心跳，避免代理切断长时间的工具调用阶段
+SSE_PING_SECONDS = float(os.getenv("SSE_PING_SECONDS", "10"))
+SSE_REPLAY_TTL = float(os.getenv("SSE_REPLAY_TTL", "300"))  # 流结束后重放缓冲保留秒数
+SSE_REPLAY_MAX_EVENTS = int(os.getenv("SSE_REPLAY_MAX_EVENTS", "2000"))
+_SSE_STREAMS = StreamRegistry(ttl_s=SSE_REPLAY_TTL, max_events=SSE_REPLAY_MAX_EVENTS)
+_SSE_EVENT_TYPES = {"thinking": "thinking", "tool_use": "tool_use", "tool": "tool_use",
+                    "content": "content", "complete": "complete", "error": "error"}
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _wants_sse(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "").lower()
+
+
+def _last_event_id(request: Request) -> int:
+    raw = request.headers.get("last-event-id") or request.query_params.get("last_event_id") or "0"
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        raise HTTPException(400, f"invalid Last-Event-ID: {raw}")
+
+
+async def _sse_produce(stream: SSEStream, sop_id: str, prompt: str, severity: str = "") -> None:
+    """在后台消费 Q 的结构化流并写入 stream；与客户端连接的生命周期无关。与 /ask_json 共用准入队列。"""
+    pool = _get_pool(sop_id)
+    pc: Optional[_PooledClient] = None
+    should_reset_client = False
+    start_ts = time.time()
+
+    async def _pump() -> Optional[str]:
+        async for ch in pc.client.send_message_stream(prompt, silence_timeout=float(STREAM_OVERALL_TIMEOUT)):
+            if not isinstance(ch, dict):
+                continue
+            ev = _SSE_EVENT_TYPES.get(str(ch.get("type", "")).lower())
+            if ev is None:
+                continue
+            stream.publish(ev, ch)
+            if ev in ("complete", "error"):
+                return ev
+        return None
+
+    try:
+        async with _ADMISSION.slot(severity):
+            pc, _ = await pool.acquire()
+            last = await asyncio.wait_for(_pump(), timeout=STREAM_OVERALL_TIMEOUT)
+        if last is None:
+            stream.publish("complete", {"content": "", "type": "complete", "metadata": {"reason": "stream ended"},
+                                        "timestamp": time.time()})
+    except asyncio.CancelledError:
+        should_reset_client = True
+        raise
+    except Exception as e:
+        should_reset_client = True
+        if isinstance(e, asyncio.TimeoutError):
+            msg, kind = f"timeout after {STREAM_OVERALL_TIMEOUT}s", "timeout"
+        elif isinstance(e, AdmissionRejected):
+            msg, kind = f"overloaded: {e.reason}; retry after {e.retry_after}s", "overloaded"
+        elif isinstance(e, HTTPException):
+            msg, kind = str(e.detail), "unavailable"
+        else:
+            msg, kind = f"{type(e).__name__}: {e}", "gateway_error"
+        stream.publish("error", StreamChunk.create_error(msg, TerminalType.QCLI.value, kind).to_api_format())
+    finally:
+        stream.close()
+        if pc is not None:
+            try:
+                if should_reset_client:
+                    await pool.discard(pc)
+                else:
+                    await pool.release(pc)
+            except Exception:
+                pass
+        print(f"[stream] done sop={sop_id} stream={stream.stream_id} "
+              f"elapsed_ms={int((time.time() - start_ts) * 1000)}")
+
+
+def _stream_key(body: Dict[str, Any]) -> str:
+    ik = str(body.get("incident_key", "")).strip()
+    if not ik and isinstance(body.get("alert"), dict):
+        try:
+            ik = build_incident_key_from_alert(body["alert"])
+        except Exception:
+            ik = ""
+    return ik
+
+
+def _start_stream(body: Dict[str, Any], sop_id: str, prompt: str) -> SSEStream:
+    stream = _SSE_STREAMS.create(key=_stream_key(body))
+    stream.producer = asyncio.create_task(_sse_produce(stream, sop_id, prompt, _alert_severity(body)))
+    print(f"[stream] start sop={sop_id} stream={stream.stream_id} key={stream.key}")
+    return stream
+
+
+def _sse_response(stream: SSEStream, last_event_id: int = 0) -> StreamingResponse:
+    headers = dict(_SSE_HEADERS)
+    headers["X-Stream-Id"] = stream.stream_id
+    return StreamingResponse(stream.follow(last_event_id, SSE_PING_SECONDS),
+                             media_type="text/event-stream", headers=headers)
+
+
+@app.get("/call_stream/{stream_id}")
+async def call_stream_resume(stream_id: str, request: Request):
+    stream = _SSE_STREAMS.get(stream_id)
+    if stream is None:
+        raise HTTPException(404, f"stream not found or expired: {stream_id}")
+    return _sse_response(stream, _last_event_id(request))
+
+
 @app.post("/call_stream")
 async def call_stream(request: Request):
     try:
@@ -753,19 +2308,34 @@ async def call_stream(request: Request):
     except Exception:
         raise HTTPException(400, "expect JSON body")
 
-    sop_id = _resolve_sop_id(body)
+    sop_id, sop_match = _resolve_sop(body)
     (SESSION_ROOT / sop_id).mkdir(parents=True, exist_ok=True)
 
-    prompt = _build_prompt(body, sop_id, allow_tools=True)
+    prompt = await asyncio.to_thread(_build_prompt, body, sop_id, True, None, sop_match["prompt_sop_id"])
     _log_prompt(sop_id, prompt)
 
+    if _wants_sse(request):
+        return _sse_response(_start_stream(body, sop_id, prompt))
+
+    # 纯文本流：响应头发出前拿到准入名额与连接，过载仍以 429 + Retry-After 返回
+    pool = _get_pool(sop_id)
+    _start_ts = time.time()
+    try:
+        await _ADMISSION.acquire(_alert_severity(body))
+    except AdmissionRejected as e:
+        raise _overloaded(e)
+    admitted_ts = time.time()
+    try:
+        pc, _ = await pool.acquire()
+    except BaseException as e:
+        _ADMISSION.release()
+        if isinstance(e, AdmissionRejected):
+            raise _overloaded(e)
+        raise
+
     async def _gen():
-        pool = _get_pool(sop_id)
-        pc: _PooledClient
-        _start_ts = time.time()
         try:
-            pc, _ = await pool.acquire()
-
+            yield ""
             # 发送并消费结构化流；收到 complete 退出
             first_chunk_time = None
 
@@ -789,11 +2359,127 @@ async def call_stream(request: Request):
                 await pool.release(pc)
             except Exception:
                 pass
+            _ADMISSION.release(time.time() - admitted_ts)
             try:
                 elapsed_ms = int((time.time() - _start_ts) * 1000)
                 print(f"[call_stream] done sop={sop_id} elapsed_ms={elapsed_ms}")
             except Exception:
                 pass
 
-    return StreamingResponse(_gen(), media_type="text/plain; charset=utf-8")
+    # 先推进到 try 内：响应未开始发送就断开时，生成器被回收也会经 finally 归还连接与名额
+    gen = _gen()
+    await gen.asend(None)
+    return StreamingResponse(gen, media_type="text/plain; charset=utf-8")
+
+
+# WebSocket 复用：一条连接订阅多条分析流，下行帧带 request_id 区分
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "50"))
+WS_OUTBOX_MAX = int(os.getenv("WS_OUTBOX_MAX", "1000"))  # 单连接待发送帧上限：数据帧满时等待，控制帧满时丢弃
+
+
+@app.websocket("/ws")
+async def ws_stream(websocket: WebSocket):
+    """
+    上行（JSON）：
+      {"op":"analyze","request_id":"r1", ...与 /call_stream 相同的请求体}  发起分析并订阅
+      {"op":"subscribe","request_id":"r2","stream_id"|"incident_key":..., "last_event_id":0}  订阅已有流
+      {"op":"unsubscribe","request_id":"r1"}
+    下行：{"request_id","stream_id","id","event","chunk"}，chunk 为 StreamChunk.to_api_format()；
+      控制帧 {"op":"subscribed"|"ended"|"error", "request_id", ...}
+    接收循环只以 put_nowait 投递控制帧，待发送帧已满（客户端不读）时丢弃并计数，不阻塞接收；
+    数据帧由各订阅的转发任务等待投递，跟不上时由重放缓冲的 reset 事件告知缺口。
+    """
+    await websocket.accept()
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=max(1, WS_OUTBOX_MAX))
+    subs: Dict[str, asyncio.Task] = {}
+    dropped = 0
+
+    async def _writer() -> None:
+        try:
+            while True:
+                await websocket.send_json(await outbox.get())
+        except Exception:
+            # 连接已断开：由接收循环收尾
+            pass
+
+    async def _forward(rid: str, stream: SSEStream, last_id: int) -> None:
+        try:
+            async for eid, event, data in stream.events(last_id):
+                await outbox.put({"request_id": rid, "stream_id": stream.stream_id, "id": eid,
+                                  "event": event, "chunk": data})
+            await outbox.put({"op": "ended", "request_id": rid, "stream_id": stream.stream_id})
+        finally:
+            if subs.get(rid) is asyncio.current_task():
+                subs.pop(rid, None)
+
+    def _control(frame: Dict[str, Any]) -> None:
+        nonlocal dropped
+        try:
+            outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            dropped += 1
+
+    async def _error(rid: str, detail: str) -> None:
+        _control({"op": "error", "request_id": rid, "error": detail})
+
+    async def _handle(msg: Dict[str, Any]) -> None:
+        op = str(msg.pop("op", "")).lower()
+        rid = str(msg.pop("request_id", "") or uuid.uuid4().hex[:8])
+        if op == "unsubscribe":
+            task = subs.pop(rid, None)
+            if task is not None:
+                task.cancel()
+            return
+        if op not in ("analyze", "subscribe"):
+            return await _error(rid, f"unknown op: {op}")
+        if rid in subs:
+            return await _error(rid, f"request_id already subscribed: {rid}")
+        if len(subs) >= WS_MAX_SUBSCRIPTIONS:
+            return await _error(rid, f"too many subscriptions (max {WS_MAX_SUBSCRIPTIONS})")
+        try:
+            last_id = max(0, int(msg.pop("last_event_id", 0) or 0))
+        except (TypeError, ValueError):
+            return await _error(rid, "invalid last_event_id")
+        if op == "subscribe":
+            stream = None
+            if msg.get("stream_id"):
+                stream = _SSE_STREAMS.get(str(msg["stream_id"]))
+            elif msg.get("incident_key"):
+                stream = _SSE_STREAMS.latest(str(msg["incident_key"]).strip())
+            if stream is None:
+                return await _error(rid, "stream not found or expired")
+        else:
+            try:
+                sop_id, sop_match = _resolve_sop(msg)
+                (SESSION_ROOT / sop_id).mkdir(parents=True, exist_ok=True)
+                prompt = await asyncio.to_thread(_build_prompt, msg, sop_id, True, None, sop_match["prompt_sop_id"])
+            except HTTPException as e:
+                return await _error(rid, str(e.detail))
+            _log_prompt(sop_id, prompt)
+            stream = _start_stream(msg, sop_id, prompt)
+        _control({"op": "subscribed", "request_id": rid, "stream_id": stream.stream_id,
+                  "incident_key": stream.key})
+        subs[rid] = asyncio.create_task(_forward(rid, stream, last_id))
+
+    writer = asyncio.create_task(_writer())
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            try:
+                msg = json.loads(raw)
+                if not isinstance(msg, dict):
+                    raise ValueError("expect JSON object")
+            except ValueError as e:
+                await _error("", f"invalid message: {e}")
+                continue
+            await _handle(msg)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # 只取消本连接的订阅；分析流继续在后台运行，可重新订阅
+        for task in list(subs.values()):
+            task.cancel()
+        writer.cancel()
+        if dropped:
+            print(f"[ws] outbox full, dropped {dropped} control frames")
 
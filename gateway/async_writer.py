@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+后台批量追加写：请求路径只把 (文件, 文本) 放入内存队列，后台任务按批合并后在线程中写盘，
+避免 prompt 日志、映射记录等同步 I/O 阻塞事件循环。
+- 队列满时丢弃并计数（日志类数据，不反压请求）
+- 无运行中的事件循环时（脚本/测试）直接同步写
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _append_batch(batch: List[Tuple[Path, str]]) -> int:
+    """同一文件的多条记录合并为一次写入；返回写入字节数（UTF-8 编码后）。"""
+    by_path: "OrderedDict[Path, List[str]]" = OrderedDict()
+    for path, text in batch:
+        by_path.setdefault(path, []).append(text)
+    written = 0
+    for path, parts in by_path.items():
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = "".join(parts).encode("utf-8")
+            with path.open("ab") as f:
+                f.write(data)
+            written += len(data)
+        except Exception as e:
+            print(f"[writer] append failed path={path} err={e}")
+    return written
+
+
+class AppendWriter:
+    """单事件循环内使用的后台追加写队列"""
+
+    def __init__(self, max_queue: int = 10000, max_batch: int = 256, flush_interval: float = 0.2):
+        self.max_queue = max(1, max_queue)
+        self.max_batch = max(1, max_batch)
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.batches = 0
+        self.bytes_written = 0
+        self.flush_seconds = 0.0
+
+    def append(self, path: Path, text: str) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.bytes_written += _append_batch([(path, text)])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((path, text))
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _ensure_started(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            # 攒一小段时间，合并同批次写入
+            await asyncio.sleep(self.flush_interval)
+            batch = [first]
+            stop = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[Tuple[Path, str]]) -> None:
+        t0 = time.time()
+        self.bytes_written += await asyncio.to_thread(_append_batch, batch)
+        self.batches += 1
+        self.flush_seconds += time.time() - t0
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """写出队列中剩余记录后停止后台任务（超时则放弃剩余记录）；队列满时等待停止标记入队也计入超时。"""
+        if self._task is None or self._task.done():
+            return
+        deadline = time.time() + timeout
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(None), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"[writer] close timeout, dropping {self._queue.qsize()} queued records")
+                self._task.cancel()
+                self._task = None
+                return
+        try:
+            await asyncio.wait_for(self._task, timeout=max(0.0, deadline - time.time()))
+        except Exception as e:
+            print(f"[writer] close error: {type(e).__name__}: {e}")
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "bytes_written": self.bytes_written,
+            "flush_seconds": round(self.flush_seconds, 3),
+        }
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Prompt 回显判定：Q 会在终端回显整段 prompt，首个有效输出之前的片段需要丢弃。
+prompt 预处理（小写、词集合、定长子串哈希集合）分两部分：静态前缀的 EchoIndex 随前缀缓存只构建一次，
+每个请求只处理前缀之后的告警段；之后每个片段的判定耗时只与片段长度相关。
+判定规则与原 _looks_like_prompt_echo 一致：
+1) 以 ## TASK / ## SOP / ## ALERT / !> 开头
+2) 不超过 256 字符且是 prompt 的子串（>= SHINGLE 字符时用全部定长子串命中来判定）
+3) 不超过 1024 字符且 70% 以上的词出现在 prompt 中
+"""
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Set
+
+_WORD = re.compile(r"[a-z0-9_\-]+")
+_ECHO_HEADS = ("## task", "## sop", "## alert", "!>")
+SHINGLE = 8  # 子串哈希的窗口长度（字符）
+MAX_SUBSTRING_CHARS = 256
+MAX_SIMILAR_CHARS = 1024
+SIMILARITY = 0.7
+
+
+def _shingles(p: str, start: int = 0) -> Set[int]:
+    k = SHINGLE
+    return {hash(p[i:i + k]) for i in range(start, len(p) - k + 1)}
+
+
+class EchoIndex:
+    """一段 prompt 文本（通常是缓存的静态前缀）的预处理结果"""
+    __slots__ = ("text", "words", "shingles")
+
+    def __init__(self, text: str):
+        self.text = (text or "").lower()
+        self.words: FrozenSet[str] = frozenset(_WORD.findall(self.text))
+        self.shingles: FrozenSet[int] = frozenset(_shingles(self.text))
+
+
+class EchoIndexCache:
+    """按前缀 sha1 缓存 EchoIndex（相同前缀文本共用一份），最多 max_entries 个，LRU 淘汰；线程安全"""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, EchoIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, text: str) -> EchoIndex:
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return index
+        index = EchoIndex(text)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class PromptEchoDetector:
+    """单个请求内使用：构造时预处理 prompt，is_echo(chunk) 判定片段是否为回显。
+    base 为 prompt 前缀的 EchoIndex 时只处理其后的部分（含跨越边界的定长子串）；前缀对不上则整段处理。"""
+
+    def __init__(self, prompt: str, base: Optional[EchoIndex] = None):
+        p = (prompt or "").lower()
+        self._prompt = p
+        n = len(base.text) if base is not None else 0
+        # 前缀必须原样出现在开头，且边界两侧不能同为词字符（否则词集合会不同）
+        if n and not (p.startswith(base.text) and not (_WORD.match(p[n - 1:n]) and _WORD.match(p[n:n + 1]))):
+            base, n = None, 0
+        tail = p[n:]
+        words = set(_WORD.findall(tail))
+        shingles = _shingles(p, max(0, n - SHINGLE + 1))
+        if base is not None:
+            self._words = (base.words, words)
+            self._shingles = (base.shingles, shingles)
+        else:
+            self._words = (words,)
+            self._shingles = (shingles,)
+
+    def _is_substring(self, cc: str) -> bool:
+        if len(cc) < SHINGLE:
+            # 短片段直接查找（预先小写的 prompt，C 层子串搜索）
+            return cc in self._prompt
+        k = SHINGLE
+        # 片段的每个定长子串都出现在 prompt 中即视为子串（长度 >= k 时等价判定的近似）
+        if len(self._shingles) == 1:
+            only = self._shingles[0]
+            return all(hash(cc[i:i + k]) in only for i in range(len(cc) - k + 1))
+        head, tail = self._shingles
+        return all(h in tail or h in head for h in (hash(cc[i:i + k]) for i in range(len(cc) - k + 1)))
+
+    def _known_words(self, words_c: Set[str]) -> int:
+        if len(self._words) == 1:
+            return len(words_c & self._words[0])
+        head, tail = self._words
+        return len(words_c & head) + len((words_c - head) & tail)
+
+    def is_echo(self, content: str) -> bool:
+        try:
+            if not content:
+                return False
+            c = content.strip()
+            if not c:
+                return False
+            # 典型前缀：TASK / SOP / ALERT / !>
+            if c[:64].lower().startswith(_ECHO_HEADS):
+                return True
+            cc = c.lower()
+            # 子串高度重合（短片段且完全出现在 prompt 中）
+            if len(cc) <= MAX_SUBSTRING_CHARS and self._is_substring(cc):
+                return True
+            # 基于 token 粗匹配的相似度
+            if len(cc) <= MAX_SIMILAR_CHARS:
+                words_c = set(_WORD.findall(cc))
+                if words_c and self._known_words(words_c) / len(words_c) >= SIMILARITY:
+                    return True
+            return False
+        except Exception:
+            return False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+时间窗告警聚合：同一分组键的告警在窗口内攒批，窗口到期（或达到上限）后整体交给 runner 执行一次，
+结果分发给组内每个提交者。
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class _Pending:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.futures: List[asyncio.Future] = []
+        self.timer: Optional[asyncio.Task] = None
+
+
+class WindowBatcher:
+    """按 key 攒批的执行器（单事件循环内使用）"""
+
+    def __init__(self, window_s: float, max_size: int,
+                 runner: Callable[[str, List[Any]], Awaitable[Any]]):
+        self.window_s = window_s
+        self.max_size = max(1, max_size)
+        self.runner = runner
+        self._pending: Dict[str, _Pending] = {}
+        self._running: set = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, key: str, item: Any) -> Any:
+        """加入 key 对应的当前窗口，等待该批执行结果。"""
+        g = self._pending.get(key)
+        if g is None:
+            g = _Pending()
+            self._pending[key] = g
+            g.timer = asyncio.create_task(self._flush_later(key, g))
+        fut = asyncio.get_running_loop().create_future()
+        g.items.append(item)
+        g.futures.append(fut)
+        if len(g.items) >= self.max_size:
+            self._flush(key, g)
+        # 提交者取消不影响同组其它告警
+        return await asyncio.shield(fut)
+
+    async def _flush_later(self, key: str, g: _Pending) -> None:
+        await asyncio.sleep(self.window_s)
+        self._flush(key, g)
+
+    def _flush(self, key: str, g: _Pending) -> None:
+        if self._pending.get(key) is not g:
+            return
+        del self._pending[key]
+        if g.timer is not None and g.timer is not asyncio.current_task():
+            g.timer.cancel()
+        task = asyncio.create_task(self._run(key, g))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, key: str, g: _Pending) -> None:
+        self.batches += 1
+        self.items += len(g.items)
+        try:
+            result = await self.runner(key, g.items)
+        except BaseException as e:
+            for fut in g.futures:
+                if not fut.done():
+                    fut.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for fut in g.futures:
+            if not fut.done():
+                fut.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"open_windows": len(self._pending), "running": len(self._running),
+                "batches": self.batches, "items": self.items}
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+异步任务存储：SQLite 持久化任务状态与结果，网关重启后仍可查询。
+方法均为同步阻塞调用，网关侧通过 asyncio.to_thread 使用。
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+REJECTED = "rejected"
+FINAL_STATES = (DONE, FAILED, REJECTED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    sop_id TEXT,
+    incident_key TEXT,
+    request TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(updated_at);
+"""
+
+
+class JobStore:
+    """基于 SQLite 的任务表（单连接 + 线程锁）"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    def create(self, job_id: str, sop_id: str, incident_key: Optional[str], request: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, sop_id, incident_key, request, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, sop_id, incident_key, json.dumps(request, ensure_ascii=False), now, now),
+            )
+            self._conn.commit()
+
+    def update(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = COALESCE(?, result), error = COALESCE(?, error), "
+                "updated_at = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                 error, time.time(), job_id),
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "sop_id": row["sop_id"],
+            "incident_key": row["incident_key"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"] or "",
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """上次进程未完成（queued/running）的任务，用于重启后恢复执行。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, sop_id, incident_key, request FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                (QUEUED, RUNNING),
+            ).fetchall()
+        return [{"job_id": r["id"], "sop_id": r["sop_id"], "incident_key": r["incident_key"],
+                 "request": json.loads(r["request"] or "{}")} for r in rows]
+
+    def prune(self, older_than: float) -> int:
+        """删除 older_than 之前结束的任务。"""
+        with self._lock:
+            cur = self._conn.execute(
+                f"DELETE FROM jobs WHERE updated_at < ? AND status IN ({','.join('?' * len(FINAL_STATES))})",
+                (older_than, *FINAL_STATES),
+            )
+            self._conn.commit()
+        return cur.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+增量 JSON 结果扫描：逐片段喂入模型输出，跟踪 '{' 栈与字符串/转义状态（只在括号内跟踪字符串，
+括号外的终端噪声不影响状态）。每当一个对象闭合且包含全部必需字段名时尝试解析，
+通过校验即为分析结果——即使外层有噪声中的孤立 '{' 尚未闭合。
+- 单个候选超过 max_chars 仍未闭合时从其起点后一位重扫，避免无界缓冲
+- find_result：对完整文本逐个 '{' 用 raw_decode 兜底查找（流结束时使用）
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+DEFAULT_REQUIRED_KEYS = ("root_cause", "evidence", "confidence")
+_DECODER = json.JSONDecoder()
+
+
+def validate_result(obj: Dict[str, Any], required: Sequence[str]) -> Optional[str]:
+    """返回不合格原因；合格返回 None。"""
+    missing = [k for k in required if k not in obj]
+    if missing:
+        return f"missing {','.join(missing)}"
+    if "root_cause" in required and not (isinstance(obj.get("root_cause"), str) and obj["root_cause"].strip()):
+        return "root_cause must be a non-empty string"
+    if "evidence" in required and not isinstance(obj.get("evidence"), list):
+        return "evidence must be a list"
+    if "confidence" in required:
+        try:
+            c = float(obj.get("confidence"))
+        except (TypeError, ValueError):
+            return "confidence must be a number"
+        if not 0.0 <= c <= 1.0:
+            return "confidence out of range"
+    return None
+
+
+def find_result(text: str, required: Sequence[str] = DEFAULT_REQUIRED_KEYS,
+                reject: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None) -> Optional[Dict[str, Any]]:
+    """在完整文本中查找第一个合格的结果对象。"""
+    i = text.find("{")
+    while i >= 0:
+        try:
+            obj, _end = _DECODER.raw_decode(text, i)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict) and validate_result(obj, required) is None and (reject is None or reject(obj) is None):
+            return obj
+        i = text.find("{", i + 1)
+    return None
+
+
+class JsonResultScanner:
+    """单个请求内使用；feed() 在首次得到合格结果时返回 True"""
+
+    def __init__(self, required: Sequence[str] = DEFAULT_REQUIRED_KEYS, max_chars: int = 512 * 1024,
+                 reject: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None):
+        self.required = tuple(required)
+        self.max_chars = max_chars
+        self.reject = reject  # 额外校验（如识别回显的模板对象），返回原因即拒绝
+        self.result: Optional[Dict[str, Any]] = None
+        self.rejected: List[str] = []
+        self._markers = tuple(f'"{k}"' for k in self.required)
+        self._buf = ""
+        self._pos = 0
+        self._stack: List[int] = []  # 未闭合 '{' 在 _buf 中的位置
+        self._in_str = False
+        self._esc = False
+
+    def feed(self, text: str) -> bool:
+        if self.result is not None or not text:
+            return False
+        self._buf += text
+        return self._scan()
+
+    def _reset(self, pos: int) -> None:
+        self._pos = pos
+        self._stack = []
+        self._in_str = False
+        self._esc = False
+
+    def _scan(self) -> bool:
+        buf = self._buf
+        i = self._pos
+        n = len(buf)
+        stack = self._stack
+        while i < n:
+            if not stack:
+                j = buf.find("{", i)
+                if j < 0:
+                    i = n
+                    break
+                i = j
+            ch = buf[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                stack.append(i)
+            elif ch == "}":
+                start = stack.pop()
+                candidate = buf[start:i + 1]
+                if all(m in candidate for m in self._markers) and self._accept(candidate):
+                    return True
+            i += 1
+            if stack and i - stack[0] > self.max_chars:
+                self._reset(stack[0] + 1)
+                stack = self._stack
+                i = self._pos
+        # 只保留最早未闭合 '{' 之后的内容
+        keep = stack[0] if stack else i
+        if keep > 0:
+            self._buf = buf[keep:]
+            self._stack = [p - keep for p in stack]
+            i -= keep
+        self._pos = i
+        return False
+
+    def _accept(self, candidate: str) -> bool:
+        try:
+            obj = json.loads(candidate)
+        except ValueError:
+            return False
+        if not isinstance(obj, dict):
+            return False
+        reason = validate_result(obj, self.required)
+        if reason is None and self.reject is not None:
+            reason = self.reject(obj)
+        if reason is not None:
+            if len(self.rejected) < 10:
+                self.rejected.append(reason)
+            return False
+        self.result = obj
+        return True
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import re
+import json
 import hashlib
 
 
@@ -50,3 +51,29 @@ def sop_id_from_incident_key(incident_key: str) -> str:
     code = zlib.crc32(base.encode("utf-8")) % 1_000_000
     return f"{code:06d}"
 
+
+
+# 指纹计算时忽略的易变字段（重发/多源推送时这些值会变化，但属于同一告警）
+VOLATILE_ALERT_KEYS = frozenset({
+    "startsat", "endsat", "starts_at", "ends_at", "timestamp", "ts", "fired_at", "firedat",
+    "updated_at", "updatedat", "generatorurl", "fingerprint", "current_value", "value",
+})
+
+
+def _strip_volatile(obj):
+    if isinstance(obj, dict):
+        return {k: _strip_volatile(v) for k, v in obj.items() if str(k).lower() not in VOLATILE_ALERT_KEYS}
+    if isinstance(obj, list):
+        return [_strip_volatile(v) for v in obj]
+    return obj
+
+
+def alert_fingerprint(alert: dict) -> str:
+    """告警指纹：去除易变字段后按键排序序列化，取 sha1 前 16 位。"""
+    canon = json.dumps(_strip_volatile(alert or {}), ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(canon.encode("utf-8")).hexdigest()[:16]
+
+
+def group_key_from_alert(alert: dict, fields) -> str:
+    """按指定字段（如 service/category/region）生成告警聚合分组键。"""
+    return "|".join(_slug(str(alert.get(f, ""))) for f in fields)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Prompt 预算与压缩：按近似 token 数（而非字节截断）控制 prompt 大小
+- approx_tokens：ASCII 约 4 字符 1 token，非 ASCII（中文等）约 1 字符 1 token
+- compact_alert：去掉 metadata 中与顶层重复或同义重复的字段、空值，输出紧凑 JSON
+- fit_sections：按 markdown 标题切段，超预算时按优先级丢弃段落，仍超出再按行截断；未超预算时原文不变
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# 同义字段组：组内任一字段取值相同即视为重复
+_SYNONYMS = (
+    frozenset({"title", "alert_name", "alertname", "name"}),
+    frozenset({"service", "service_name"}),
+)
+_TRIM_MARK = "\n...(trimmed)"
+_HEADING = re.compile(r"(?m)^(?=#{1,3} )")
+
+
+def approx_tokens(text: str) -> int:
+    if not text:
+        return 0
+    ascii_len = len(text.encode("ascii", "ignore"))
+    return (ascii_len + 3) // 4 + (len(text) - ascii_len)
+
+
+def _empty(v: Any) -> bool:
+    return v is None or v == "" or v == [] or v == {}
+
+
+def _same(a: Any, b: Any) -> bool:
+    return str(a).strip().lower() == str(b).strip().lower()
+
+
+def compact_alert(alert: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """返回 (压缩后的告警, 被去掉的字段路径)；不修改原对象。"""
+    dropped: List[str] = []
+    out: Dict[str, Any] = {}
+    for k, v in alert.items():
+        if k == "metadata":
+            continue
+        if _empty(v):
+            dropped.append(k)
+            continue
+        out[k] = v
+    meta = alert.get("metadata")
+    if isinstance(meta, dict):
+        kept: Dict[str, Any] = {}
+        for k, v in meta.items():
+            if _empty(v):
+                dropped.append(f"metadata.{k}")
+                continue
+            if k in out and _same(out[k], v):
+                dropped.append(f"metadata.{k}")
+                continue
+            group = next((g for g in _SYNONYMS if k in g), None)
+            if group is not None and any(_same(src[g_k], v) for src in (out, kept)
+                                         for g_k in group if g_k in src):
+                dropped.append(f"metadata.{k}")
+                continue
+            kept[k] = v
+        if kept:
+            out["metadata"] = kept
+    elif "metadata" in alert and not _empty(meta):
+        out["metadata"] = meta
+    return out, dropped
+
+
+def to_json(obj: Any, compact: bool = True) -> str:
+    if compact:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+    return json.dumps(obj, ensure_ascii=False, indent=2, default=str)
+
+
+def truncate_strings(obj: Any, max_chars: int) -> Tuple[Any, int]:
+    """把超长字符串截断到 max_chars；返回 (新对象, 截断的字段数)。"""
+    if isinstance(obj, str):
+        return (obj[:max_chars] + "...", 1) if len(obj) > max_chars else (obj, 0)
+    if isinstance(obj, dict):
+        n = 0
+        out = {}
+        for k, v in obj.items():
+            out[k], c = truncate_strings(v, max_chars)
+            n += c
+        return out, n
+    if isinstance(obj, list):
+        n = 0
+        out_l = []
+        for v in obj:
+            nv, c = truncate_strings(v, max_chars)
+            out_l.append(nv)
+            n += c
+        return out_l, n
+    return obj, 0
+
+
+class Section:
+    """prompt 中的一段；priority 越小越重要（0 为策略段，不丢弃也不截断），required 的段落不会被丢弃。
+    joiner 为与前一段之间的分隔（markdown 内部各段为 ""，保持原文）；
+    markdown 切出的段带 strip_tail，作为块的最后一段时去掉尾部空行（块尾段被裁剪时会出现）。"""
+    __slots__ = ("name", "text", "priority", "required", "joiner", "strip_tail", "order")
+
+    def __init__(self, name: str, text: str, priority: int = 5, required: bool = False, joiner: str = "\n\n",
+                 strip_tail: bool = False):
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.required = required
+        self.joiner = joiner
+        self.strip_tail = strip_tail
+        self.order = 0
+
+
+def join_sections(sections: List[Section]) -> str:
+    out = ""
+    for i, s in enumerate(sections):
+        if i and s.joiner:
+            if sections[i - 1].strip_tail:
+                out = out.rstrip("\n")
+            out += s.joiner
+        out += s.text
+    return out
+
+
+def split_markdown(text: str) -> List[Tuple[str, str]]:
+    """按 #/##/### 标题切段，返回 (标题, 原文)；各段原文按顺序拼接即为原文。"""
+    out = []
+    for chunk in _HEADING.split(text):
+        if not chunk:
+            continue
+        first = chunk.split("\n", 1)[0]
+        out.append((first.lstrip("#").strip() if first.startswith("#") else "", chunk))
+    return out
+
+
+def _truncate_lines(text: str, over: int) -> str:
+    tail = "\n" if text.endswith("\n") else ""
+    lines = text.rstrip("\n").split("\n")
+    while len(lines) > 1 and over > 0:
+        over -= approx_tokens(lines.pop()) + 1
+    return "\n".join(lines) + _TRIM_MARK + tail
+
+
+def fit_sections(sections: List[Section], budget: int) -> Tuple[str, Dict[str, Any]]:
+    """在 budget（近似 token）内拼接段落；返回 (文本, 报告)。budget<=0 表示不限制。"""
+    for i, s in enumerate(sections):
+        s.order = i
+    kept = list(sections)
+    before = approx_tokens(join_sections(kept))
+    dropped: List[str] = []
+    truncated: List[str] = []
+    if budget > 0 and before > budget:
+        # 先丢优先级最低、位置最靠后的可选段
+        for s in sorted((s for s in kept if not s.required and s.priority > 0),
+                        key=lambda s: (-s.priority, -s.order)):
+            if approx_tokens(join_sections(kept)) <= budget:
+                break
+            kept.remove(s)
+            dropped.append(s.name)
+        # 仍超出：按行截断剩余段中最不重要且最大的段（每段最多截一次）
+        while approx_tokens(join_sections(kept)) > budget:
+            candidates = [s for s in kept if s.priority > 0 and s.name not in truncated]
+            if not candidates:
+                break
+            s = max(candidates, key=lambda s: (s.priority, approx_tokens(s.text)))
+            s.text = _truncate_lines(s.text, approx_tokens(join_sections(kept)) - budget)
+            truncated.append(s.name)
+    text = join_sections(kept)
+    report = {"tokens_before": before, "tokens": approx_tokens(text), "budget": budget,
+              "dropped_sections": dropped, "truncated_sections": truncated}
+    return text, report
+
+
+def section_priority(name: str, rules: List[Tuple[str, int]], default: int) -> int:
+    low = name.lower()
+    for kw, prio in rules:
+        if kw in low:
+            return prio
+    return default
+
+
+def sections_from_markdown(text: str, header: str, rules: List[Tuple[str, int]], default: int,
+                           label: str) -> List[Section]:
+    """把一段 markdown 切成 Section；header 加在第一段前（如 "## SOP (xxx)"），该段只截断不丢弃。
+    标题前的引言段优先级为 1。"""
+    out: List[Section] = []
+    for i, (name, chunk) in enumerate(split_markdown(text)):
+        prio = section_priority(name, rules, default) if name else 1
+        if i == 0:
+            out.append(Section(f"{label}:{name or 'intro'}", f"{header}\n{chunk}", prio, required=True,
+                               strip_tail=True))
+        else:
+            out.append(Section(f"{label}:{name}", chunk, prio, joiner="", strip_tail=True))
+    return out
+
+
+def alert_section(title: str, payload: Any, compact: bool, remaining: Optional[int],
+                  max_field_chars: int) -> Tuple[str, Dict[str, Any]]:
+    """渲染告警段；compact 时超出剩余预算再截断超长字段值。"""
+    text = f"{title}\n{to_json(payload, compact)}"
+    report: Dict[str, Any] = {"truncated_fields": 0}
+    if compact and remaining is not None and approx_tokens(text) > remaining and max_field_chars > 0:
+        payload, n = truncate_strings(payload, max_field_chars)
+        text = f"{title}\n{to_json(payload, compact)}"
+        report["truncated_fields"] = n
+    return text, report
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Prompt 静态前缀缓存：TASK / SOP / 各类 POLICY 段对同一 (sop_id, allow_tools) 不变，
+编译一次后缓存可直接发送的文本及其 sha1、字节数，请求路径只渲染告警段。
+- 失效：每个条目记录源文件版本（mtime_ns + size），读取时最多每 check_interval 秒 stat 一次
+- 线程安全：_build_prompt 在线程中执行
+"""
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+def file_versions(paths: Iterable[Path]) -> Tuple[Tuple[str, int, int], ...]:
+    """源文件版本签名；不存在的文件记为 (path, 0, -1)，出现/删除同样会使缓存失效。"""
+    out = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            out.append((str(p), st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append((str(p), 0, -1))
+    return tuple(out)
+
+
+class CompiledPrefix:
+    __slots__ = ("text", "sha1", "nbytes", "version", "meta", "compiled_at", "checked_at", "hits")
+
+    def __init__(self, text: str, version: Hashable, meta: Optional[Dict[str, Any]] = None):
+        self.text = text
+        self.meta = meta or {}
+        data = text.encode("utf-8")
+        self.sha1 = hashlib.sha1(data).hexdigest()
+        self.nbytes = len(data)
+        self.version = version
+        self.compiled_at = time.time()
+        self.checked_at = self.compiled_at
+        self.hits = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"sha1": self.sha1, "bytes": self.nbytes, "compiled_at": self.compiled_at, "hits": self.hits,
+                **self.meta}
+
+
+class PromptPrefixCache:
+    """compile_fn(sop_id, allow_tools) 生成前缀文本（或 (文本, 附加信息)），version_fn(sop_id) 返回其依赖源的版本签名"""
+
+    def __init__(self, compile_fn: Callable[[str, bool], Any], version_fn: Callable[[str], Hashable],
+                 check_interval: float = 1.0, max_entries: int = 1024):
+        self.compile_fn = compile_fn
+        self.version_fn = version_fn
+        self.check_interval = check_interval
+        self.max_entries = max(1, max_entries)
+        self._entries: Dict[Tuple[str, bool], CompiledPrefix] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recompiles = 0
+
+    def get(self, sop_id: str, allow_tools: bool = True) -> Tuple[CompiledPrefix, bool]:
+        """返回 (前缀, 是否命中缓存)。"""
+        key = (sop_id, bool(allow_tools))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry.checked_at < self.check_interval:
+                return self._hit(entry), True
+            version = self.version_fn(sop_id)
+            if version == entry.version:
+                entry.checked_at = now
+                return self._hit(entry), True
+        else:
+            version = self.version_fn(sop_id)
+        compiled = self.compile_fn(sop_id, allow_tools)
+        text, meta = compiled if isinstance(compiled, tuple) else (compiled, None)
+        fresh = CompiledPrefix(text, version, meta)
+        with self._lock:
+            self.misses += 1
+            if entry is not None:
+                self.recompiles += 1
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # 简单淘汰最早编译的条目
+                oldest = min(self._entries, key=lambda k: self._entries[k].compiled_at)
+                del self._entries[oldest]
+            self._entries[key] = fresh
+        return fresh, False
+
+    def _hit(self, entry: CompiledPrefix) -> CompiledPrefix:
+        with self._lock:
+            self.hits += 1
+            entry.hits += 1
+        return entry
+
+    def invalidate(self, sop_id: Optional[str] = None) -> int:
+        with self._lock:
+            keys = [k for k in self._entries if sop_id is None or k[0] == sop_id]
+            for k in keys:
+                del self._entries[k]
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e.nbytes for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recompiles": self.recompiles,
+            }
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+异步会话目录清理：请求路径只登记任务并立即返回，后台完成
+1) SIGTERM 占用目录的 q 进程，异步等待退出（pidfd，不支持时轮询 /proc），超时 SIGKILL
+2) 目录改名到回收站（同一文件系统，瞬间完成，原路径可立即重建）
+3) 线程中 rmtree 回收站目录
+状态通过 get()/recent() 查询。
+"""
+import asyncio
+import os
+import shutil
+import signal
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+PENDING = "pending"
+TERMINATING = "terminating"
+REMOVING = "removing"
+DONE = "done"
+FAILED = "failed"
+REJECTED = "rejected"
+FINAL_STATES = (DONE, FAILED, REJECTED)
+
+
+class PurgeJob:
+    def __init__(self, path: Path):
+        self.id = uuid.uuid4().hex[:12]
+        self.path = path
+        self.status = PENDING
+        self.reason = ""
+        self.pids: List[int] = []
+        self.killed: List[int] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def finish(self, status: str, reason: str) -> None:
+        self.status = status
+        self.reason = reason
+        self.finished_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "purge_id": self.id,
+            "path": str(self.path),
+            "status": self.status,
+            "reason": self.reason,
+            "pids": self.pids,
+            "killed": self.killed,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "took_ms": int(((self.finished_at or time.time()) - self.created_at) * 1000),
+        }
+
+
+def _alive(pid: int) -> bool:
+    return os.path.exists(f"/proc/{pid}")
+
+
+async def wait_exit(pid: int, timeout: float, poll_s: float = 0.1) -> bool:
+    """异步等待进程退出；返回是否已退出。"""
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        fut = loop.create_future()
+
+        def _ready() -> None:
+            if not fut.done():
+                fut.set_result(None)
+        try:
+            loop.add_reader(fd, _ready)
+            try:
+                await asyncio.wait_for(fut, timeout=timeout)
+                return True
+            except asyncio.TimeoutError:
+                return not _alive(pid)
+            finally:
+                loop.remove_reader(fd)
+        finally:
+            os.close(fd)
+    deadline = loop.time() + timeout
+    while _alive(pid):
+        if loop.time() >= deadline:
+            return False
+        await asyncio.sleep(poll_s)
+    return True
+
+
+class PurgeService:
+    """后台会话目录清理（单事件循环内使用）"""
+
+    def __init__(self, root: Path, find_pids: Callable[[Path], List[int]],
+                 term_grace_s: float = 5.0, kill_grace_s: float = 2.0, keep: int = 200):
+        self.root = root
+        self.trash = root / ".trash"
+        self.find_pids = find_pids
+        self.term_grace_s = term_grace_s
+        self.kill_grace_s = kill_grace_s
+        self.keep = keep
+        self._jobs: "OrderedDict[str, PurgeJob]" = OrderedDict()
+        self._by_path: Dict[Path, PurgeJob] = {}
+
+    def request(self, path: Path) -> PurgeJob:
+        """登记清理任务并立即返回；同一目录已有进行中的任务时直接复用。"""
+        path = path.resolve()
+        running = self._by_path.get(path)
+        if running is not None and running.status not in FINAL_STATES:
+            return running
+        job = PurgeJob(path)
+        self._remember(job)
+        root = self.root.resolve()
+        try:
+            path.relative_to(root)
+        except ValueError:
+            job.finish(REJECTED, "not under SESSION_ROOT")
+            return job
+        if path == root or path.parent != root or path.name.startswith("."):
+            job.finish(REJECTED, "refuse to delete SESSION_ROOT itself or non-session dir")
+            return job
+        self._by_path[path] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def wait_for(self, path: Path) -> None:
+        """等待该目录进行中的清理任务结束（在目录中启动新会话前调用，避免新进程被一并清理）。"""
+        job = self._by_path.get(path.resolve())
+        if job is not None and job.task is not None and not job.task.done():
+            await asyncio.wait({job.task})
+
+    def _remember(self, job: PurgeJob) -> None:
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.keep:
+            _, old = self._jobs.popitem(last=False)
+            if self._by_path.get(old.path) is old:
+                self._by_path.pop(old.path, None)
+
+    async def _run(self, job: PurgeJob) -> None:
+        try:
+            if not job.path.exists():
+                job.finish(DONE, "dir not found (already gone)")
+                return
+            job.status = TERMINATING
+            job.pids = await asyncio.to_thread(self.find_pids, job.path)
+            await self._terminate(job)
+            job.status = REMOVING
+            trash_path = await asyncio.to_thread(self._move_to_trash, job.path)
+            await asyncio.to_thread(shutil.rmtree, trash_path, True)
+            job.finish(DONE, "deleted" + (f" (killed {job.killed})" if job.killed else ""))
+        except asyncio.CancelledError:
+            job.finish(FAILED, "cancelled")
+            raise
+        except Exception as e:
+            job.finish(FAILED, f"{type(e).__name__}: {e}")
+        finally:
+            print(f"[purge] {job.status} path={job.path} reason={job.reason} took_ms={job.to_dict()['took_ms']}")
+
+    async def _terminate(self, job: PurgeJob) -> None:
+        for pid in job.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        exited = await asyncio.gather(*[wait_exit(pid, self.term_grace_s) for pid in job.pids])
+        stubborn = [pid for pid, ok in zip(job.pids, exited) if not ok]
+        for pid in stubborn:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                job.killed.append(pid)
+            except ProcessLookupError:
+                pass
+        if stubborn:
+            await asyncio.gather(*[wait_exit(pid, self.kill_grace_s) for pid in stubborn])
+
+    def _move_to_trash(self, path: Path) -> Path:
+        self.trash.mkdir(parents=True, exist_ok=True)
+        target = self.trash / f"{path.name}.{int(time.time())}.{uuid.uuid4().hex[:6]}"
+        os.rename(path, target)
+        return target
+
+    async def sweep_trash(self) -> int:
+        """清理上次进程遗留的回收站目录（启动时调用）。"""
+        if not self.trash.exists():
+            return 0
+        leftovers = [p for p in self.trash.iterdir()]
+        for p in leftovers:
+            await asyncio.to_thread(shutil.rmtree, p, True)
+        return len(leftovers)
+
+    def get(self, purge_id: str) -> Optional[PurgeJob]:
+        return self._jobs.get(purge_id)
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return [j.to_dict() for j in list(self._jobs.values())[-limit:]][::-1]
+
+    def tasks(self) -> List[asyncio.Task]:
+        return [j.task for j in self._jobs.values() if j.task is not None and not j.task.done()]
@@ -20,6 +20,10 @@ cd "$SESSION_DIR"
 touch .q_rw_test || { echo "CWD is read-only: $PWD" >&2; exit 30; }
 rm -f .q_rw_test || true
 
+# 登记 PID（exec 后即为 q 的 PID）与启动时间，网关据此按会话目录查找 q 进程，无需扫描 /proc
+mkdir -p .qpids
+echo "$$ $(cut -d' ' -f22 /proc/$$/stat 2>/dev/null || echo 0)" > ".qpids/$$" || true
+
 # 选择 Q 可执行文件（可被环境 Q_CMD 覆盖）
 Q_CMD="${Q_CMD:-}"
 if [ -z "$Q_CMD" ]; then
@@ -42,5 +46,10 @@ Q_ENTRY_LOG_FILE="$LOG_DIR/q_entry.log"
 echo "[q_entry] sop_id=$SOP_ID session_dir=$SESSION_DIR q_cmd=$Q_CMD" >> "$Q_ENTRY_LOG_FILE"
 
 # 启动会话（交互模式、工具信任、自动续会话）
-exec "$Q_CMD" chat --trust-all-tools --resume
+# 通用备用会话（_spare）不续接历史，网关只把它绑定给还没有会话目录的 sop，并把 .qpids 登记移到该 sop 目录
+Q_ARGS=(chat --trust-all-tools)
+if [ "$SOP_ID" != "_spare" ]; then
+  Q_ARGS+=(--resume)
+fi
+exec "$Q_CMD" "${Q_ARGS[@]}"
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+q 进程登记表：q_entry.sh 在 exec q 之前把自身 PID（exec 后不变）与启动时间写入
+q-sessions/<sop_id>/.qpids/<pid>，网关按会话目录直接读取，无需扫描整个 /proc。
+启动时间（/proc/<pid>/stat 第 22 列）用于识别 PID 复用；失效的登记文件读取时顺手删除。
+"""
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+PID_DIR = ".qpids"
+
+
+def proc_starttime(pid: int) -> Optional[str]:
+    """进程启动时间（自开机起的 clock ticks）；进程不存在返回 None。"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read().decode("utf-8", "ignore")
+    except OSError:
+        return None
+    # comm 可能含空格，从最后一个 ')' 之后按空格切分：state 为第 3 列
+    fields = stat[stat.rfind(")") + 2:].split()
+    return fields[19] if len(fields) > 19 else None
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class QPidRegistry:
+    """按会话目录查询存活的 q 进程（同步方法，调用方可放到线程中执行）"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._starttime: Dict[int, str] = {}
+
+    def has_registry(self, session_dir: Path) -> bool:
+        return (session_dir / PID_DIR).is_dir()
+
+    def pids_for(self, session_dir: Path) -> List[int]:
+        pid_dir = session_dir / PID_DIR
+        try:
+            names = os.listdir(pid_dir)
+        except OSError:
+            return []
+        pids: List[int] = []
+        for name in names:
+            if not name.isdigit():
+                continue
+            pid = int(name)
+            path = pid_dir / name
+            try:
+                recorded = path.read_text().split()
+            except OSError:
+                continue
+            start = recorded[1] if len(recorded) > 1 else "0"
+            current = proc_starttime(pid)
+            if current is None or (start != "0" and current != start):
+                # 进程已退出或 PID 已被复用
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+                self._starttime.pop(pid, None)
+                continue
+            self._starttime[pid] = current
+            pids.append(pid)
+        return sorted(pids)
+
+    def move(self, pid: int, src_dir: Path, dst_dir: Path) -> bool:
+        """把 pid 的登记从 src_dir 移到 dst_dir（备用会话绑定到 sop 后，按 sop 目录清理/统计）。"""
+        dst = dst_dir / PID_DIR
+        try:
+            dst.mkdir(parents=True, exist_ok=True)
+            os.replace(src_dir / PID_DIR / str(pid), dst / str(pid))
+            return True
+        except OSError:
+            return False
+
+    def is_running(self, pid: int) -> bool:
+        """pid 是否仍是登记时的那个进程。"""
+        start = self._starttime.get(pid)
+        current = proc_starttime(pid)
+        return current is not None and (start is None or current == start)
+
+    def counts(self) -> Dict[str, int]:
+        """各会话目录的存活 q 进程数。"""
+        out: Dict[str, int] = {}
+        try:
+            entries = [e for e in os.scandir(self.root) if e.is_dir() and not e.name.startswith(".")]
+        except OSError:
+            return out
+        for e in entries:
+            n = len(self.pids_for(Path(e.path)))
+            if n:
+                out[e.name] = n
+        return out
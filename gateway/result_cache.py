@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+分析结果缓存：按 key（incident_key + 告警指纹）缓存已完成的分析结果。
+- 按 severity 设置 TTL
+- LRU，同时限制条目数与近似字节数
+- 可选持久化（JSONL 快照，启动加载、关闭写出）
+"""
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+
+def parse_ttls(spec: str, default: float) -> Dict[str, float]:
+    """解析 "critical=120,warning=600,default=300" 形式的 TTL 配置。"""
+    ttls: Dict[str, float] = {"default": default}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        k, v = item.split("=", 1)
+        try:
+            ttls[k.strip().lower()] = float(v.strip())
+        except ValueError:
+            continue
+    return ttls
+
+
+class ResultCache:
+    """带 TTL 的 LRU 结果缓存（单事件循环内使用，无需加锁）"""
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 32 * 1024 * 1024,
+                 ttls: Optional[Dict[str, float]] = None, persist_path: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = ttls or {"default": 300.0}
+        self.persist_path = persist_path
+        # key -> (expires_at, created_at, size, value)
+        self._od: "OrderedDict[str, Tuple[float, float, int, Dict[str, Any]]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, severity: str) -> float:
+        return self.ttls.get((severity or "").strip().lower(), self.ttls.get("default", 0.0))
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """命中返回 (value, 已缓存秒数)，过期或不存在返回 None。"""
+        item = self._od.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, created_at, _size, value = item
+        now = time.time()
+        if expires_at <= now:
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._od.move_to_end(key)
+        self.hits += 1
+        return value, now - created_at
+
+    def put(self, key: str, value: Dict[str, Any], ttl: float) -> None:
+        if ttl <= 0:
+            return
+        try:
+            size = len(json.dumps(value, ensure_ascii=False, default=str))
+        except Exception:
+            return
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        now = time.time()
+        self._od[key] = (now + ttl, now, size, value)
+        self._bytes += size
+        while self._od and (len(self._od) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._od)))
+
+    def _drop(self, key: str) -> None:
+        item = self._od.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._od), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+    def load(self) -> int:
+        """从快照加载未过期条目（同步，供线程中调用）。"""
+        if not self.persist_path or not self.persist_path.exists():
+            return 0
+        now = time.time()
+        n = 0
+        with self.persist_path.open("r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    expires_at = float(rec["expires_at"])
+                    if expires_at <= now:
+                        continue
+                    value = rec["value"]
+                    size = len(json.dumps(value, ensure_ascii=False, default=str))
+                    self._drop(rec["key"])
+                    self._od[rec["key"]] = (expires_at, float(rec.get("created_at", now)), size, value)
+                    self._bytes += size
+                    n += 1
+                except Exception:
+                    continue
+        while self._od and (len(self._od) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._od)))
+        return n
+
+    def save(self) -> int:
+        """将未过期条目写出到快照（先写临时文件再原子替换）。"""
+        if not self.persist_path:
+            return 0
+        now = time.time()
+        items = [(k, v) for k, v in list(self._od.items()) if v[0] > now]
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.persist_path.with_suffix(self.persist_path.suffix + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for key, (expires_at, created_at, _size, value) in items:
+                f.write(json.dumps({"key": key, "expires_at": expires_at, "created_at": created_at,
+                                    "value": value}, ensure_ascii=False, default=str) + "\n")
+        tmp.replace(self.persist_path)
+        return len(items)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+SOP 规则匹配：把 SOP 记录中的 keys（如 cat:cpu、sev:*、svc:omada-*）编译成按维度的索引
+- 精确值：哈希表 value -> 规则列表
+- 前缀通配（omada-*）：字符前缀树，沿告警取值逐字符下行收集规则
+- 其它通配（含中间 *）：单独列表，用 fnmatch 兜底
+- 任意值（*）不建索引，视为该维度不受约束（否则每次匹配都要遍历全部 sev:* 规则）
+匹配时按维度累计命中数，命中全部受约束维度的规则即为候选；按 priority、具体程度、加载顺序选出最佳。
+"""
+import fnmatch
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# keys 中的维度缩写 -> 告警字段
+DIM_FIELDS = {"cat": "category", "sev": "severity", "svc": "service"}
+# 告警字段缺失时的备选（metadata 中的同义字段）
+_FALLBACK_FIELDS = {"service": ("service_name",), "severity": ("severity",), "category": ("category",)}
+
+PRIORITY_RANK = {"critical": 0, "p0": 0, "highest": 0, "high": 1, "p1": 1,
+                 "middle": 2, "medium": 2, "p2": 2, "low": 3, "p3": 3}
+_UNKNOWN_PRIORITY = 9
+
+_EXACT, _PREFIX, _ANY, _GLOB = "exact", "prefix", "any", "glob"
+_IDS = ""  # 前缀树节点中保存规则列表的键（不会与单字符子节点冲突）
+
+
+def _norm(v: Any) -> str:
+    return str(v if v is not None else "").strip().lower()
+
+
+def alert_value(alert: Dict[str, Any], dim: str) -> str:
+    field = DIM_FIELDS.get(dim, dim)
+    v = _norm(alert.get(field))
+    if not v:
+        meta = alert.get("metadata") if isinstance(alert.get("metadata"), dict) else {}
+        for name in (field,) + _FALLBACK_FIELDS.get(field, ()):
+            v = _norm(meta.get(name))
+            if v:
+                break
+    return v
+
+
+class _Rule:
+    __slots__ = ("idx", "sop_id", "priority", "rank", "conds", "need", "specificity")
+
+    def __init__(self, idx: int, sop_id: str, priority: str, conds: Dict[str, Tuple[str, str, str]]):
+        self.idx = idx
+        self.sop_id = sop_id
+        self.priority = priority
+        self.rank = PRIORITY_RANK.get(_norm(priority), _UNKNOWN_PRIORITY)
+        self.conds = conds  # dim -> (kind, pattern, 原始 key)
+        self.need = sum(1 for kind, _pat, _key in conds.values() if kind != _ANY)  # 需命中的维度数
+        spec = 0
+        for kind, pat, _key in conds.values():
+            if kind == _EXACT:
+                spec += 1000
+            elif kind in (_PREFIX, _GLOB):
+                spec += 100 + len(pat.replace("*", ""))
+        self.specificity = spec
+
+    def sort_key(self) -> Tuple[int, int, int]:
+        return (self.rank, -self.specificity, self.idx)
+
+
+class _DimIndex:
+    def __init__(self):
+        self.exact: Dict[str, List[int]] = {}
+        self.trie: Dict[str, Any] = {}
+        self.globs: List[Tuple[str, int]] = []
+
+    def add(self, kind: str, pat: str, idx: int) -> None:
+        if kind == _EXACT:
+            self.exact.setdefault(pat, []).append(idx)
+        elif kind == _PREFIX:
+            node = self.trie
+            for ch in pat:
+                node = node.setdefault(ch, {})
+            node.setdefault(_IDS, []).append(idx)
+        else:
+            self.globs.append((pat, idx))
+
+    def lookup(self, value: str) -> Iterable[int]:
+        if not value:
+            return
+        yield from self.exact.get(value, ())
+        node = self.trie
+        for ch in value:
+            node = node.get(ch)
+            if node is None:
+                break
+            yield from node.get(_IDS, ())
+        for pat, idx in self.globs:
+            if fnmatch.fnmatchcase(value, pat):
+                yield idx
+
+
+def parse_key(key: str) -> Optional[Tuple[str, str, str]]:
+    """"svc:omada-*" -> ("svc", "prefix", "omada-")；无法解析返回 None。"""
+    if not isinstance(key, str) or ":" not in key:
+        return None
+    dim, pat = key.split(":", 1)
+    dim, pat = _norm(dim), _norm(pat)
+    if not dim or not pat:
+        return None
+    if pat == "*":
+        return dim, _ANY, ""
+    if "*" not in pat and "?" not in pat:
+        return dim, _EXACT, pat
+    if pat.endswith("*") and "*" not in pat[:-1] and "?" not in pat:
+        return dim, _PREFIX, pat[:-1]
+    return dim, _GLOB, pat
+
+
+class SopMatcher:
+    """由 SOP 记录编译的只读匹配索引（构建后不再修改，可跨线程读取）"""
+
+    def __init__(self, records: Iterable[Tuple[str, Dict[str, Any]]], generation: int = 0):
+        self.generation = generation
+        self.rules: List[_Rule] = []
+        self.dims: Dict[str, _DimIndex] = {}
+        self.always: List[int] = []  # 所有维度均为 * 的规则
+        self.skipped = 0
+        for sop_id, record in records:
+            keys = record.get("keys") if isinstance(record, dict) else None
+            if not isinstance(keys, list) or not keys:
+                continue
+            conds: Dict[str, Tuple[str, str, str]] = {}
+            for k in keys:
+                parsed = parse_key(k)
+                if parsed is None:
+                    continue
+                dim, kind, pat = parsed
+                conds[dim] = (kind, pat, k.strip())  # 同维度重复时以后者为准
+            if not conds:
+                self.skipped += 1
+                continue
+            rule = _Rule(len(self.rules), sop_id, str(record.get("priority") or ""), conds)
+            self.rules.append(rule)
+            if rule.need == 0:
+                self.always.append(rule.idx)
+            for dim, (kind, pat, _key) in conds.items():
+                if kind != _ANY:
+                    self.dims.setdefault(dim, _DimIndex()).add(kind, pat, rule.idx)
+
+    def candidates(self, alert: Dict[str, Any]) -> List[_Rule]:
+        """命中全部受约束维度的规则，按优先级排序。"""
+        hits: Dict[int, int] = {}
+        for dim, index in self.dims.items():
+            for idx in index.lookup(alert_value(alert, dim)):
+                hits[idx] = hits.get(idx, 0) + 1
+        matched = [self.rules[i] for i, n in hits.items() if n == self.rules[i].need]
+        matched.extend(self.rules[i] for i in self.always)
+        matched.sort(key=_Rule.sort_key)
+        return matched
+
+    def match(self, alert: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """返回最佳 SOP 及匹配说明；无命中返回 None。"""
+        t0 = time.perf_counter()
+        matched = self.candidates(alert)
+        if not matched:
+            return None
+        best = matched[0]
+        return {
+            "sop_id": best.sop_id,
+            "priority": best.priority,
+            "matched_keys": {dim: {"key": key, "kind": kind, "value": alert_value(alert, dim)}
+                             for dim, (kind, _pat, key) in best.conds.items()},
+            "specificity": best.specificity,
+            "candidates": len(matched),
+            "runners_up": [r.sop_id for r in matched[1:4]],
+            "took_us": int((time.perf_counter() - t0) * 1e6),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {"generation": self.generation, "rules": len(self.rules), "indexed_dims": sorted(self.dims),
+                "skipped": self.skipped}
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+SOP 内存索引：启动时一次性加载 SOP_DIR，按 sop_id 保存预渲染好的正文，请求路径只做字典查找。
+- 来源：{sop_id}.md/txt/json 单文件（优先级 md > txt > json，覆盖 JSONL），以及 *.jsonl 中的记录（同 id 以先出现者为准）
+- 热加载：目录下文件的 mtime/大小变化时在后台重建索引，整体替换引用（读者不会看到半成品）
+- generation 每次重建递增，供下游缓存判定失效
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# sop 目录下的映射记录文件，每次请求都会追加，不属于 SOP
+MAPPING_FILE = "incident_sop_map.jsonl"
+_DIRECT_EXTS = ("md", "txt", "json")
+
+
+def render_record(obj: Dict[str, Any]) -> str:
+    """把一条 JSONL SOP 记录渲染为 prompt 中的 markdown 正文。"""
+    # 1) direct text fields
+    for key in ("sop", "content", "text", "body"):
+        v = obj.get(key)
+        if isinstance(v, str) and v.strip():
+            return v.strip()
+    # 2) assemble from structured fields
+    parts = []
+    title = obj.get("title") or obj.get("name")
+    if isinstance(title, str) and title.strip():
+        parts.append(f"# {title.strip()}")
+    if obj.get("priority"):
+        parts.append(f"Priority: {obj.get('priority')}")
+    if obj.get("keys"):
+        try:
+            parts.append("Keys: " + ", ".join(map(str, obj.get("keys") or [])))
+        except Exception:
+            pass
+
+    def _section(h, arr):
+        if isinstance(arr, list) and arr:
+            lines = "\n".join([f"- {str(x)}" for x in arr])
+            parts.append(f"## {h}\n{lines}")
+    _section("Commands", obj.get("command"))
+    _section("Metrics", obj.get("metric"))
+    _section("Logs", obj.get("log"))
+    _section("Fix Actions", obj.get("fix_action"))
+    if parts:
+        return "\n\n".join(parts).strip()
+    # 3) fallback: raw json
+    try:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    except Exception:
+        return str(obj)
+
+
+class SopEntry:
+    __slots__ = ("sop_id", "text", "source", "line", "record", "nbytes")
+
+    def __init__(self, sop_id: str, text: str, source: Path, line: int = 0,
+                 record: Optional[Dict[str, Any]] = None):
+        self.sop_id = sop_id
+        self.text = text
+        self.source = source
+        self.line = line
+        self.record = record or {}
+        self.nbytes = len(text.encode("utf-8"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "sop_id": self.sop_id,
+            "source": self.source.name,
+            "line": self.line or None,
+            "bytes": self.nbytes,
+            "title": self.record.get("title") or self.record.get("name"),
+            "priority": self.record.get("priority"),
+            "keys": self.record.get("keys"),
+        }
+
+
+def _dir_version(sop_dir: Path) -> Tuple[Tuple[str, int, int], ...]:
+    out = []
+    try:
+        entries = list(os.scandir(sop_dir))
+    except OSError:
+        return ()
+    for e in entries:
+        if e.name == MAPPING_FILE or not e.is_file():
+            continue
+        if e.name.rsplit(".", 1)[-1] not in _DIRECT_EXTS + ("jsonl",):
+            continue
+        try:
+            st = e.stat()
+        except OSError:
+            continue
+        out.append((e.name, st.st_mtime_ns, st.st_size))
+    return tuple(sorted(out))
+
+
+def _iter_jsonl(path: Path) -> Iterable[Tuple[int, Dict[str, Any]]]:
+    with path.open("r", encoding="utf-8", errors="ignore") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                obj = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(obj, dict):
+                yield lineno, obj
+
+
+def build_index(sop_dir: Path) -> Tuple[Dict[str, SopEntry], List[str]]:
+    """扫描目录构建 sop_id -> SopEntry；返回 (索引, 读取失败的文件及原因)。"""
+    index: Dict[str, SopEntry] = {}
+    errors: List[str] = []
+    for p in sorted(sop_dir.glob("*.jsonl")):
+        if p.name == MAPPING_FILE:
+            continue
+        try:
+            for lineno, obj in _iter_jsonl(p):
+                sop_id = str(obj.get("sop_id", "")).strip()
+                if sop_id and sop_id not in index:
+                    index[sop_id] = SopEntry(sop_id, render_record(obj), p, lineno, obj)
+        except Exception as e:
+            errors.append(f"{p.name}: {type(e).__name__}: {e}")
+    # 单文件 SOP 覆盖 JSONL；同名多扩展名时 md > txt > json
+    for ext in reversed(_DIRECT_EXTS):
+        for p in sorted(sop_dir.glob(f"*.{ext}")):
+            try:
+                text = p.read_text(encoding="utf-8", errors="ignore").strip()
+            except Exception as e:
+                errors.append(f"{p.name}: {type(e).__name__}: {e}")
+                continue
+            if text:
+                index[p.stem] = SopEntry(p.stem, text, p)
+    return index, errors
+
+
+class SopStore:
+    """线程安全的 SOP 索引（读无锁，重建串行）"""
+
+    def __init__(self, sop_dir: Path):
+        self.sop_dir = sop_dir
+        self._index: Dict[str, SopEntry] = {}
+        self._version: Optional[Tuple] = None
+        self._reload_lock = threading.Lock()
+        self.generation = 0
+        self.loaded_at = 0.0
+        self.load_ms = 0
+        self.errors: List[str] = []
+
+    def reload(self, force: bool = False) -> bool:
+        """目录有变化（或 force）时重建索引；返回是否重建。同步执行，可放到线程中。"""
+        with self._reload_lock:
+            version = _dir_version(self.sop_dir)
+            if not force and version == self._version:
+                return False
+            t0 = time.time()
+            index, errors = build_index(self.sop_dir)
+            self._index = index
+            self._version = version
+            self.errors = errors
+            self.generation += 1
+            self.loaded_at = time.time()
+            self.load_ms = int((self.loaded_at - t0) * 1000)
+        return True
+
+    def _ensure_loaded(self) -> Dict[str, SopEntry]:
+        if self._version is None:
+            self.reload()
+        return self._index
+
+    def get(self, sop_id: str) -> Optional[SopEntry]:
+        return self._ensure_loaded().get(sop_id)
+
+    def text(self, sop_id: str) -> str:
+        entry = self.get(sop_id)
+        return entry.text if entry is not None else ""
+
+    def entries(self) -> List[SopEntry]:
+        return list(self._ensure_loaded().values())
+
+    def stats(self) -> Dict[str, Any]:
+        index = self._index
+        return {
+            "sop_dir": str(self.sop_dir),
+            "generation": self.generation,
+            "loaded_at": self.loaded_at,
+            "load_ms": self.load_ms,
+            "sops": len(index),
+            "bytes": sum(e.nbytes for e in index.values()),
+            "errors": self.errors,
+        }
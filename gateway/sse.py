@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+流式事件与重放缓冲：生产者（Q 会话）与客户端连接解耦，事件按递增 id 缓存，
+客户端断线后带 Last-Event-ID 重连即可从断点继续。
+- SSE：follow() 输出 SSE 文本，空闲期间按间隔发送心跳注释行
+- WebSocket：events() 输出原始事件，由网关按 request_id 复用到同一连接
+- 断点早于缓冲中最早的事件（中间事件已被挤出）时先输出一条 reset 事件，告知客户端有缺口
+"""
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+
+def format_event(event_id: int, event: str, data: Any) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, default=str)
+    lines = [f"id: {event_id}", f"event: {event}"]
+    lines.extend(f"data: {line}" for line in payload.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def format_ping() -> str:
+    return f": ping {int(time.time())}\n\n"
+
+
+class SSEStream:
+    """单个请求的事件缓冲（单事件循环内使用）"""
+
+    def __init__(self, stream_id: str, max_events: int = 2000, key: str = ""):
+        self.stream_id = stream_id
+        self.key = key  # 订阅用的业务键（incident_key），可为空
+        self.created_at = time.time()
+        # (id, event, data)
+        self._events: Deque[Tuple[int, str, Any]] = deque(maxlen=max(1, max_events))
+        self._next_id = 1
+        self._changed = asyncio.Event()
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.producer: Optional[asyncio.Task] = None
+
+    def publish(self, event: str, data: Any) -> int:
+        eid = self._next_id
+        self._next_id += 1
+        self._events.append((eid, event, data))
+        self._wake()
+        return eid
+
+    def oldest_id(self) -> int:
+        """缓冲中最早事件的 id；缓冲为空时为下一个事件的 id"""
+        return self._events[0][0] if self._events else self._next_id
+
+    def close(self) -> None:
+        if not self.done:
+            self.done = True
+            self.finished_at = time.time()
+            self._wake()
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def events(self, last_event_id: int = 0,
+                     idle_s: float = 0) -> AsyncIterator[Optional[Tuple[int, str, Any]]]:
+        """从 last_event_id 之后输出 (id, event, data)（先重放缓冲，再跟随新事件），流结束后返回；
+        idle_s > 0 时空闲满 idle_s 秒输出一次 None。
+        cursor 之后的事件已被挤出缓冲时先输出 (oldest - 1, "reset", {...})，再从最早的缓冲事件继续。"""
+        cursor = last_event_id
+        while True:
+            oldest = self.oldest_id()
+            if oldest > cursor + 1:
+                yield (oldest - 1, "reset", {"reason": "replay_gap", "last_event_id": cursor,
+                                             "oldest_event_id": oldest, "missed": oldest - 1 - cursor})
+                cursor = oldest - 1
+            pending = [e for e in list(self._events) if e[0] > cursor]
+            for e in pending:
+                cursor = e[0]
+                yield e
+            if self.done:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=idle_s if idle_s > 0 else None)
+            except asyncio.TimeoutError:
+                yield None
+
+    async def follow(self, last_event_id: int = 0, ping_s: float = 10.0) -> AsyncIterator[str]:
+        """SSE 文本输出，空闲时发送心跳。"""
+        async for e in self.events(last_event_id, ping_s):
+            yield format_ping() if e is None else format_event(*e)
+
+
+class StreamRegistry:
+    """按 stream_id 保存 SSE 流；结束超过 ttl 秒的流在创建新流时清理"""
+
+    def __init__(self, ttl_s: float = 300.0, max_events: int = 2000):
+        self.ttl_s = ttl_s
+        self.max_events = max_events
+        self._streams: Dict[str, SSEStream] = {}
+
+    def create(self, key: str = "") -> SSEStream:
+        self.prune()
+        stream = SSEStream(uuid.uuid4().hex, self.max_events, key)
+        self._streams[stream.stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> Optional[SSEStream]:
+        return self._streams.get(stream_id)
+
+    def latest(self, key: str) -> Optional[SSEStream]:
+        """key 对应的最新一条流（优先进行中的）。"""
+        matches = [s for s in self._streams.values() if key and s.key == key]
+        if not matches:
+            return None
+        return max(matches, key=lambda s: (not s.done, s.created_at))
+
+    def prune(self) -> int:
+        cutoff = time.time() - self.ttl_s
+        stale = [sid for sid, s in self._streams.items() if s.done and (s.finished_at or 0) < cutoff]
+        for sid in stale:
+            del self._streams[sid]
+        return len(stale)
+
+    def producers(self) -> List[asyncio.Task]:
+        return [s.producer for s in self._streams.values() if s.producer is not None and not s.producer.done()]
+
+    def stats(self) -> Dict[str, int]:
+        live = sum(1 for s in self._streams.values() if not s.done)
+        return {"streams": len(self._streams), "live": live}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+MCP 工具调用时间线：从 Q 的结构化流整理出每次工具调用的工具名、MCP server、起止时间与耗时，
+ToolStats 跨请求按 (server, tool) 聚合耗时，用于判断哪个后端拖慢了分析。
+- 开始：tool_use 事件（metadata 中的 tool_name / mcp_server）
+- 结束：工具执行输出中的 "Completed in 1.23s" / "failed after 0.5s"（同时记下 Q 自报的耗时）；
+  没有该标记时以下一次工具调用或流结束为准（end_by 为 next_tool / stream_end）
+- server 归一：elasticsearch_mcp_server -> elasticsearch；use_aws 按输出中的 Service name 细分（如 cloudwatch）
+"""
+import re
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+_DONE = re.compile(r"(completed in|failed after)\s*([0-9]+(?:\.[0-9]+)?)\s*(ms|s)\b", re.IGNORECASE)
+_AWS_SERVICE = re.compile(r"service name:\s*([a-z0-9\-]+)", re.IGNORECASE)
+# server 名中包含关键字即归一为对应后端
+_SERVER_ALIASES = (("victoria", "victoriametrics"), ("elastic", "elasticsearch"), ("opensearch", "elasticsearch"),
+                   ("cloudwatch", "cloudwatch"))
+BUILTIN = "builtin"
+
+
+def canonical_server(server: str, tool: str = "") -> str:
+    low = (server or "").strip().lower()
+    if not low:
+        return "aws" if tool == "use_aws" else BUILTIN
+    for kw, name in _SERVER_ALIASES:
+        if kw in low:
+            return name
+    return low
+
+
+def split_tool(tool_name: str, server: str = "") -> Tuple[str, str]:
+    """("victoriametrics___query", "") -> ("query", "victoriametrics")"""
+    tool = (tool_name or "").strip() or "unknown_tool"
+    if "___" in tool:
+        prefix, tool = tool.split("___", 1)
+        server = server or prefix
+    return tool, canonical_server(server, tool)
+
+
+class ToolCall:
+    __slots__ = ("tool", "server", "start", "end", "reported_s", "status", "end_by")
+
+    def __init__(self, tool: str, server: str, start: float):
+        self.tool = tool
+        self.server = server
+        self.start = start
+        self.end: Optional[float] = None
+        self.reported_s: Optional[float] = None
+        self.status = "ok"
+        self.end_by = ""
+
+    @property
+    def duration_s(self) -> float:
+        return max(0.0, (self.end or self.start) - self.start)
+
+    def to_dict(self, t0: float) -> Dict[str, Any]:
+        d = {"tool": self.tool, "server": self.server, "start": round(self.start, 3),
+             "end": round(self.end, 3) if self.end is not None else None,
+             "start_ms": int((self.start - t0) * 1000), "duration_ms": int(self.duration_s * 1000),
+             "status": self.status, "end_by": self.end_by}
+        if self.reported_s is not None:
+            d["reported_ms"] = int(self.reported_s * 1000)
+        return d
+
+
+class ToolTimeline:
+    """单次分析内使用；最多记录 max_calls 次调用，其余只计数"""
+
+    def __init__(self, t0: float, max_calls: int = 64):
+        self.t0 = t0
+        self.max_calls = max_calls
+        self.calls: List[ToolCall] = []
+        self.dropped = 0
+        self._open: Optional[ToolCall] = None
+        self._output_seen = False
+
+    def start(self, tool_name: str, server: str, ts: float) -> None:
+        tool, srv = split_tool(tool_name, server)
+        cur = self._open
+        # 同一调用的重绘会重复产生 tool_use 事件：尚无执行输出时视为同一次
+        if cur is not None and not self._output_seen and (cur.tool, cur.server) == (tool, srv):
+            return
+        self._close(ts, "next_tool")
+        if len(self.calls) >= self.max_calls:
+            self.dropped += 1
+            return
+        self._open = ToolCall(tool, srv, ts)
+        self._output_seen = False
+        self.calls.append(self._open)
+
+    def output(self, text: str, ts: float) -> None:
+        """工具执行期间的内容片段：识别结束标记与 use_aws 的目标服务"""
+        cur = self._open
+        if cur is None or not text:
+            return
+        self._output_seen = True
+        if cur.server == "aws":
+            m = _AWS_SERVICE.search(text)
+            if m:
+                cur.server = canonical_server(m.group(1))
+        m = _DONE.search(text)
+        if m:
+            value = float(m.group(2))
+            cur.reported_s = value / 1000.0 if m.group(3).lower() == "ms" else value
+            if m.group(1).lower().startswith("failed"):
+                cur.status = "error"
+            self._close(ts, "marker")
+
+    def finish(self, ts: float, status: Optional[str] = None) -> None:
+        """流结束（或提前返回/超时）时关闭未结束的调用；status 覆盖其状态（如 timeout）"""
+        cur = self._open
+        self._close(ts, "stream_end")
+        if cur is not None and status:
+            cur.status = status
+
+    def _close(self, ts: float, end_by: str) -> None:
+        cur = self._open
+        if cur is None:
+            return
+        cur.end = ts
+        cur.end_by = end_by
+        self._open = None
+
+    def closed(self) -> List[ToolCall]:
+        return [c for c in self.calls if c.end is not None]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return [c.to_dict(self.t0) for c in self.calls]
+
+
+def _pct(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+class _Agg:
+    __slots__ = ("count", "errors", "total_s", "max_s", "recent")
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+
+class ToolStats:
+    """跨请求的每工具耗时：累计次数/错误/总耗时/最大值，分位数基于最近 window 次"""
+
+    def __init__(self, window: int = 500, max_tools: int = 256):
+        self.window = max(1, window)
+        self.max_tools = max(1, max_tools)
+        self._aggs: Dict[Tuple[str, str], _Agg] = {}
+        self._lock = threading.Lock()
+        self.overflow = 0
+
+    def record(self, call: ToolCall) -> None:
+        key = (call.server, call.tool)
+        d = call.duration_s
+        with self._lock:
+            agg = self._aggs.get(key)
+            if agg is None:
+                if len(self._aggs) >= self.max_tools:
+                    self.overflow += 1
+                    return
+                agg = self._aggs[key] = _Agg(self.window)
+            agg.count += 1
+            agg.errors += call.status != "ok"
+            agg.total_s += d
+            agg.max_s = max(agg.max_s, d)
+            agg.recent.append(d)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            items = [(k, a.count, a.errors, a.total_s, a.max_s, sorted(a.recent)) for k, a in self._aggs.items()]
+            overflow = self.overflow
+        grand = sum(total for _k, _n, _e, total, _m, _r in items) or 0.0
+        tools = []
+        servers: Dict[str, Dict[str, Any]] = {}
+        for (server, tool), n, errors, total, mx, recent in items:
+            tools.append({"server": server, "tool": tool, "calls": n, "errors": errors,
+                          "total_ms": int(total * 1000), "avg_ms": int(total * 1000 / n) if n else 0,
+                          "p50_ms": int(_pct(recent, 0.5) * 1000), "p95_ms": int(_pct(recent, 0.95) * 1000),
+                          "max_ms": int(mx * 1000)})
+            s = servers.setdefault(server, {"server": server, "calls": 0, "errors": 0, "total_ms": 0})
+            s["calls"] += n
+            s["errors"] += errors
+            s["total_ms"] += int(total * 1000)
+        for s in servers.values():
+            s["share"] = round(s["total_ms"] / (grand * 1000), 3) if grand else 0.0
+        tools.sort(key=lambda t: -t["total_ms"])
+        return {"servers": sorted(servers.values(), key=lambda s: -s["total_ms"]), "tools": tools,
+                "window": self.window, "overflow": overflow}
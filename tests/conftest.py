@@ -0,0 +1,84 @@
+import asyncio
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# 测试直接导入 gateway/api 包（网关以 uvicorn gateway.app:app 在仓库根目录运行）
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# gateway.app 在导入时读取环境变量：使用仓库内的 SOP/任务说明，关闭备用会话、预热与 span 文件，
+# 会话目录与任务库放到临时目录，避免测试写入仓库
+_TMP = Path(tempfile.mkdtemp(prefix="q-gateway-tests-"))
+atexit.register(shutil.rmtree, _TMP, True)
+for _k, _v in {
+    "SOP_DIR": str(ROOT / "sop"),
+    "TASK_DOC_PATH": str(ROOT / "task_instructions.md"),
+    "SESSION_ROOT": str(_TMP / "q-sessions"),
+    "JOBS_DB_PATH": str(_TMP / "jobs.sqlite3"),
+    "TRACE_SPANS_PATH": "",
+    "SPARE_POOL_SIZE": "0",
+    "PREWARM_TOP_N": "0",
+    "SOP_RELOAD_INTERVAL": "0",
+}.items():
+    os.environ.setdefault(_k, _v)
+
+
+@pytest.fixture
+def sample_alert():
+    return json.loads((ROOT / "alerts" / "dev" / "sdn5_cpu.json").read_text(encoding="utf-8"))
+
+
+class FakeClient:
+    """代替 TerminalAPIClient：池与收尾逻辑只调用 shutdown()，流式接口固定输出 ok"""
+    opened = 0
+
+    def __init__(self):
+        FakeClient.opened += 1
+        self.id = FakeClient.opened
+        self.closed = False
+
+    async def shutdown(self):
+        self.closed = True
+
+    async def send_message_stream(self, text, silence_timeout=None):
+        yield {"type": "content", "content": "ok"}
+        yield {"type": "complete", "content": ""}
+
+
+@pytest.fixture
+def gw(monkeypatch, tmp_path):
+    """导入 gateway.app，并把连接池、准入、缓存、单飞等全局状态换成干净的实例。
+    建连改为 FakeClient（不连 ttyd），日志与映射写到 tmp_path。"""
+    import gateway.app as app
+    from gateway.admission import AdmissionQueue
+    from gateway.result_cache import ResultCache
+
+    monkeypatch.setattr(app, "SESSION_ROOT", tmp_path / "q-sessions")
+    monkeypatch.setattr(app, "_PROMPT_LOG_DIR", tmp_path / "logs")
+    monkeypatch.setattr(app, "_INCIDENT_MAP_FILE", tmp_path / "incident_sop_map.jsonl")
+    monkeypatch.setattr(app, "_SOP_POOLS", {})
+    monkeypatch.setattr(app, "_IDLE_LRU", app._IdleLRU())
+    monkeypatch.setattr(app, "_GLOBAL_CONN", 0)
+    monkeypatch.setattr(app, "_INFLIGHT", {})
+    monkeypatch.setattr(app, "_RESULT_CACHE", ResultCache(ttls={"default": 300.0}))
+    monkeypatch.setattr(app, "_ADMISSION", AdmissionQueue(max_active=4, max_queue=4, max_wait=5,
+                                                          default_service_s=1.0))
+
+    async def _open_client(self, ready_timeout=None):
+        await asyncio.sleep(0.01)
+        return FakeClient()
+
+    monkeypatch.setattr(app._QPool, "_open_client", _open_client)
+    # 备用会话默认关闭；需要时测试自行调大 SPARE_POOL_SIZE 并往 _SPARE_POOL 放入连接
+    monkeypatch.setattr(app, "SPARE_POOL_SIZE", 0)
+    monkeypatch.setattr(app, "_SPARE_POOL", app._QPool(app.SPARE_SOP_ID, size=1, evictable=False))
+    monkeypatch.setattr(app, "_SPARE_REFILL_TASK", None)
+    return app
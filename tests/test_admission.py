@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from gateway.admission import AdmissionQueue, AdmissionRejected, parse_priorities
+
+PRIOS = parse_priorities("critical=0,high=1,warning=2,default=2")
+
+
+def test_parse_priorities_skips_bad_items():
+    assert parse_priorities("critical=0, High = 1,bad,x=y") == {"critical": 0, "high": 1}
+
+
+def test_waiters_are_admitted_by_severity_then_arrival():
+    async def main():
+        q = AdmissionQueue(max_active=1, max_queue=10, max_wait=5, priorities=PRIOS)
+        await q.acquire("warning")
+        order = []
+
+        async def waiter(name, sev):
+            await q.acquire(sev)
+            order.append(name)
+            q.release()
+
+        tasks = []
+        for name, sev in (("w1", "warning"), ("c1", "critical"), ("w2", "warning"), ("h1", "high")):
+            tasks.append(asyncio.create_task(waiter(name, sev)))
+            await asyncio.sleep(0)
+        q.release()
+        await asyncio.gather(*tasks)
+        return order, q.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == ["c1", "h1", "w1", "w2"]
+    assert stats["active"] == 0 and stats["admitted"] == 5
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def main():
+        q = AdmissionQueue(max_active=1, max_queue=1, max_wait=5, priorities=PRIOS, default_service_s=10)
+        await q.acquire("critical")
+        queued = asyncio.create_task(q.acquire("critical"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as e:
+            await q.acquire("warning")
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        return e.value, q
+
+    err, q = asyncio.run(main())
+    assert err.reason == "queue full"
+    # 前面 1 个排队、1 个名额：(1 + 1) / 1 轮 * 10 秒
+    assert err.retry_after == 20
+    assert q.rejected["queue full"] == 1
+    assert q.stats()["queued"] == 0
+
+
+def test_higher_severity_preempts_lowest_waiter():
+    async def main():
+        q = AdmissionQueue(max_active=1, max_queue=1, max_wait=5, priorities=PRIOS)
+        await q.acquire("warning")
+        low = asyncio.create_task(q.acquire("warning"))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(q.acquire("critical"))
+        await asyncio.sleep(0)
+        q.release()
+        await high
+        with pytest.raises(AdmissionRejected) as e:
+            await low
+        return e.value
+
+    assert asyncio.run(main()).reason == "preempted by higher severity"
+
+
+def test_wait_timeout_rejects_and_cancelled_waiter_leaves_queue():
+    async def main():
+        q = AdmissionQueue(max_active=1, max_queue=5, max_wait=0.05, priorities=PRIOS)
+        await q.acquire("critical")
+        with pytest.raises(AdmissionRejected) as e:
+            await q.acquire("critical")
+        q.max_wait = 5
+        t = asyncio.create_task(q.acquire("critical"))
+        await asyncio.sleep(0)
+        t.cancel()
+        await asyncio.gather(t, return_exceptions=True)
+        return e.value, q.stats()
+
+    err, stats = asyncio.run(main())
+    assert err.reason == "queue timeout"
+    assert stats["queued"] == 0 and stats["active"] == 1
+
+
+def test_retry_after_uses_slots_and_service_estimate():
+    q = AdmissionQueue(max_active=4, max_queue=0, max_wait=1, default_service_s=10)
+    assert q.retry_after(0) == 3  # 1 / 4 轮
+    assert q.retry_after(3, slots=1) == 40
+    q.release(service_s=20)  # ewma: 0.8 * 10 + 0.2 * 20
+    assert q.retry_after(0, slots=1) == 12
+    err = q.reject("pool queue full", 1, slots=2)
+    assert (err.reason, err.retry_after) == ("pool queue full", 12)
+    assert q.stats()["rejected"] == {"pool queue full": 1}
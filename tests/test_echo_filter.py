@@ -0,0 +1,127 @@
+import json
+import random
+import re
+from pathlib import Path
+
+from gateway.echo_filter import EchoIndex, EchoIndexCache, PromptEchoDetector
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def _looks_like_prompt_echo(content: str, prompt: str) -> bool:
+    """重构前 gateway/app.py 中的实现（原样保留，作为一致性基准）"""
+    try:
+        if not content:
+            return False
+        c = (content or "").strip()
+        if not c:
+            return False
+        head = c[:64].lower()
+        if head.startswith("## task") or head.startswith("## sop") or head.startswith("## alert") or head.startswith("!>"):  # noqa: E501
+            return True
+        p = (prompt or "").lower()
+        cc = c.lower()
+        if len(cc) <= 256 and cc in p:
+            return True
+        words_c = set(re.findall(r"[a-z0-9_\-]+", cc))
+        words_p = set(re.findall(r"[a-z0-9_\-]+", p))
+        if words_c:
+            inter = len(words_c & words_p)
+            if inter / max(1, len(words_c)) >= 0.7 and len(cc) <= 1024:
+                return True
+        return False
+    except Exception:
+        return False
+
+
+def _texts(x):
+    if isinstance(x, str):
+        yield x
+    elif isinstance(x, dict):
+        for v in x.values():
+            yield from _texts(v)
+    elif isinstance(x, list):
+        for v in x:
+            yield from _texts(v)
+
+
+def _transcripts(limit=40):
+    """q-sessions/default 中保存的 Q 会话：(prompt, 模型输出)"""
+    pairs = []
+    for f in sorted((ROOT / "q-sessions" / "default").glob("*")):
+        try:
+            history = json.loads(f.read_text(encoding="utf-8")).get("history", [])
+        except (OSError, ValueError):
+            continue
+        for h in history:
+            content = h.get("user", {}).get("content", {})
+            prompt = content.get("Prompt", {}).get("prompt") if isinstance(content, dict) else None
+            if prompt and len(prompt) > 200:
+                resp = "\n".join(t for t in _texts(h.get("assistant", {})) if len(t) > 3)
+                pairs.append((prompt, resp))
+    return pairs[:limit]
+
+
+def _chunks(prompt, resp, rnd):
+    """模拟流式分片：按行、定长窗口，以及 prompt 自身的切片（回显）"""
+    out = [line for line in resp.split("\n") if line.strip()]
+    for size in (5, 12, 40, 120, 300, 900):
+        out.extend(resp[i:i + size] for i in range(0, min(len(resp), 6000), size * 3))
+        for _ in range(10):
+            j = rnd.randrange(0, max(1, len(prompt) - size))
+            out.append(prompt[j:j + size])
+    out += ["", "   ", "!> ", "## ALERT JSON\n{}", "## sop (x)"]
+    return out
+
+
+def test_parity_with_previous_implementation_on_transcripts():
+    pairs = _transcripts()
+    assert pairs, "q-sessions/default 中没有样例会话"
+    rnd = random.Random(1)
+    total = 0
+    for prompt, resp in pairs:
+        det = PromptEchoDetector(prompt)
+        for c in _chunks(prompt, resp, rnd):
+            assert det.is_echo(c) == _looks_like_prompt_echo(c, prompt), c[:80]
+            total += 1
+    assert total > 1000
+
+
+def test_cached_prefix_index_matches_full_build():
+    rnd = random.Random(2)
+    for prompt, resp in _transcripts(10):
+        cut = prompt.find("\n\n", len(prompt) // 2)
+        if cut < 0:
+            continue
+        base = EchoIndex(prompt[:cut])
+        with_base = PromptEchoDetector(prompt, base)
+        full = PromptEchoDetector(prompt)
+        # 跨越前缀边界的片段
+        chunks = [prompt[max(0, cut - n):cut + n] for n in (4, 8, 30, 100)]
+        chunks += _chunks(prompt, resp, rnd)
+        for c in chunks:
+            assert with_base.is_echo(c) == full.is_echo(c) == _looks_like_prompt_echo(c, prompt), c[:80]
+
+
+def test_base_that_is_not_a_prefix_is_ignored():
+    prompt = "## TASK\nalpha beta gamma\n\n## ALERT JSON\n{\"service\": \"sdn5\"}"
+    det = PromptEchoDetector(prompt, EchoIndex("something else entirely"))
+    assert det.is_echo('{"service": "sdn5"}')
+    assert not det.is_echo("root cause is disk pressure on node-7")
+    # 边界处于词中间时不使用前缀索引（词集合会不同）
+    det = PromptEchoDetector("abc def", EchoIndex("abc d"))
+    assert det.is_echo("def") == _looks_like_prompt_echo("def", "abc def")
+
+
+def test_index_cache_shares_by_key_and_evicts_lru():
+    cache = EchoIndexCache(max_entries=2)
+    a = cache.get("a", "Alpha text")
+    assert cache.get("a", "ignored") is a
+    assert a.text == "alpha text"
+    cache.get("b", "beta")
+    cache.get("a", "")
+    cache.get("c", "gamma")  # 淘汰最久未用的 b
+    assert cache.get("a", "") is a
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 3}
+    cache.get("b", "beta")
+    assert cache.stats()["misses"] == 4
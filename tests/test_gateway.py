@@ -0,0 +1,421 @@
+import asyncio
+import copy
+import json
+import time
+from collections import Counter, OrderedDict
+
+import httpx
+import pytest
+from conftest import FakeClient
+from fastapi import HTTPException
+
+from gateway.admission import AdmissionQueue, AdmissionRejected
+from gateway.purge import PurgeService
+
+
+def _pool(app, sop_id, size):
+    pool = app._QPool(sop_id, size=size)
+    app._SOP_POOLS[sop_id] = pool
+    return pool
+
+
+def test_pool_waiters_are_served_fifo(gw):
+    async def main():
+        pool = _pool(gw, "s1", 1)
+        pc, _ = await pool.acquire()
+        order = []
+
+        async def user(i):
+            got, _ = await pool.acquire()
+            order.append(i)
+            await asyncio.sleep(0)
+            await pool.release(got)
+
+        tasks = []
+        for i in range(4):
+            tasks.append(asyncio.create_task(user(i)))
+            await asyncio.sleep(0)
+        await pool.release(pc)
+        await asyncio.gather(*tasks)
+        return order, pool.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == [0, 1, 2, 3]
+    assert stats["clients"] == 1 and stats["idle"] == 1 and stats["waiters"] == 0
+
+
+def test_pool_creation_is_single_flight(gw, monkeypatch):
+    live = {"now": 0, "max": 0, "opened": 0}
+
+    async def _open_client(self, ready_timeout=None):
+        live["now"] += 1
+        live["opened"] += 1
+        live["max"] = max(live["max"], live["now"])
+        await asyncio.sleep(0.02)
+        live["now"] -= 1
+        return FakeClient()
+
+    monkeypatch.setattr(gw._QPool, "_open_client", _open_client)
+
+    async def main():
+        pool = _pool(gw, "s1", 3)
+
+        async def user():
+            pc, _ = await pool.acquire()
+            await asyncio.sleep(0.05)
+            await pool.release(pc)
+
+        await asyncio.gather(*[user() for _ in range(5)])
+        return pool
+
+    pool = asyncio.run(main())
+    assert live["max"] == 1
+    assert live["opened"] == 3
+    assert len(pool._clients) == 3
+    assert gw._GLOBAL_CONN == 3
+
+
+def _add_spare(app):
+    spare = app._PooledClient(FakeClient())
+    app._SPARE_POOL._clients.append(spare)
+    app._SPARE_POOL._put_idle(spare)
+    return spare
+
+
+def test_concurrent_new_pools_bind_the_only_spare_once(gw, monkeypatch):
+    monkeypatch.setattr(gw, "SPARE_POOL_SIZE", 1)
+    monkeypatch.setattr(gw, "_schedule_spare_refill", lambda: None)
+
+    async def main():
+        spare = _add_spare(gw)
+        a, b = _pool(gw, "a", 1), _pool(gw, "b", 1)
+        (pa, _), (pb, _) = await asyncio.gather(a.acquire(timeout=2), b.acquire(timeout=2))
+        return spare, pa, pb
+
+    spare, pa, pb = asyncio.run(main())
+    assert sorted([pa.origin, pb.origin]) == ["sop", "spare"]
+    assert spare.client in (pa.client, pb.client)
+    assert not gw._SPARE_POOL._clients and not gw._SPARE_POOL._idle
+
+
+def test_spare_is_returned_when_sop_already_has_session_state(gw, monkeypatch):
+    monkeypatch.setattr(gw, "SPARE_POOL_SIZE", 1)
+    (gw.SESSION_ROOT / "old").mkdir(parents=True)
+    (gw.SESSION_ROOT / "old" / "history").write_text("x")
+
+    async def main():
+        spare = _add_spare(gw)
+        pc, _ = await _pool(gw, "old", 1).acquire(timeout=2)
+        return spare, pc
+
+    spare, pc = asyncio.run(main())
+    assert pc.origin == "sop"
+    assert list(gw._SPARE_POOL._idle) == [spare]
+
+
+def test_failed_grow_fails_waiters_instead_of_leaving_them_queued(gw, monkeypatch):
+    async def _boom(sop_id):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(gw, "_bind_spare", _boom)
+
+    async def main():
+        with pytest.raises(HTTPException) as e:
+            await asyncio.wait_for(_pool(gw, "s1", 1).acquire(timeout=30), 2)
+        return e.value
+
+    err = asyncio.run(main())
+    assert err.status_code == 503 and "boom" in err.detail
+
+
+def test_global_cap_evicts_least_recently_used_idle_connection(gw, monkeypatch):
+    monkeypatch.setattr(gw, "QTTY_MAX_CONN", 2)
+    monkeypatch.setattr(gw, "_EVICTIONS", Counter())
+
+    async def main():
+        a = _pool(gw, "a", 2)
+        first, _ = await a.acquire()
+        second, _ = await a.acquire()
+        await a.release(first)
+        await a.release(second)
+        b = _pool(gw, "b", 1)
+        got, _ = await b.acquire()
+        # 全部连接都忙时无法腾出额度：按过载拒绝（429 + Retry-After）
+        again, _ = await a.acquire()
+        c = _pool(gw, "c", 1)
+        with pytest.raises(AdmissionRejected) as e:
+            await c.acquire(timeout=1)
+        return first, second, got, e.value
+
+    first, second, got, err = asyncio.run(main())
+    assert first.client.closed and not second.client.closed
+    assert gw._EVICTIONS == Counter({"lru": 1})
+    assert gw._GLOBAL_CONN == 2
+    assert err.reason == "global cap" and err.retry_after >= 1
+    assert gw._ADMISSION.rejected["global cap"] == 1
+
+
+class _CountingOD(OrderedDict):
+    scanned = 0
+
+    def items(self):
+        for kv in super().items():
+            self.scanned += 1
+            yield kv
+
+
+def test_idle_lru_skips_an_excluded_pool_at_the_head(gw):
+    lru = gw._IdleLRU()
+    lru._od = _CountingOD()
+    a, b = gw._QPool("a", size=3), gw._QPool("b", size=3)
+    a_pcs = [gw._PooledClient(FakeClient(), i) for i in range(3)]
+    b_pcs = [gw._PooledClient(FakeClient(), i) for i in range(2)]
+    for pc in a_pcs + b_pcs:
+        lru.touch(pc, a if pc in a_pcs else b)
+    assert lru.oldest(exclude=a) == (b_pcs[0], b)
+    assert lru._od.scanned == len(a_pcs) + 1  # 只跳过被排除池的空闲连接
+    assert lru.oldest() == (a_pcs[0], a)
+
+    for pc in b_pcs:
+        lru.remove(pc)
+    lru.touch(a_pcs[0], a)  # 重复 touch 不重复计数
+    lru._od.scanned = 0
+    assert lru.oldest(exclude=a) is None
+    assert lru._od.scanned == 0  # 全部空闲连接都属于被排除的池：不扫描
+    for pc in a_pcs:
+        lru.remove(pc)
+    assert lru._per_pool == {} and len(lru) == 0
+
+
+def test_full_pool_queue_is_rejected_fast_with_retry_after(gw, monkeypatch):
+    monkeypatch.setattr(gw, "QTTY_POOL_MAX_WAITERS", 1)
+
+    async def main():
+        pool = _pool(gw, "s1", 1)
+        held, _ = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await pool.acquire()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        with pytest.raises(AdmissionRejected) as too_long:
+            await pool.acquire(timeout=0.5)
+        # 估算等待（至少 1 秒）不超过 timeout 时照常排队，排满 timeout 后拒绝
+        gw._ADMISSION._service_ewma = 0.01
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await pool.acquire(timeout=1.0)
+        return full.value, too_long.value, timed_out.value, pool
+
+    full, too_long, timed_out, pool = asyncio.run(main())
+    # 前面 1 个等待者、池大小 1、平均耗时 1 秒：(1 + 1) / 1 * 1
+    assert (full.reason, full.retry_after) == ("pool queue full", 2)
+    assert too_long.reason == "pool wait too long"
+    assert timed_out.reason == "pool wait timeout"
+    assert not pool._waiters
+
+
+class _FakeQ:
+    """代替 _q_collect：记录调用，可阻塞直到放行"""
+
+    def __init__(self):
+        self.calls = []
+        self.gate = None
+
+    async def __call__(self, sop_id, text, timeout=None, echo_base=None):
+        self.calls.append(sop_id)
+        if self.gate is not None:
+            await self.gate.wait()
+        await asyncio.sleep(0.01)
+        return {"ok": True, "output": '{"root_cause": "cpu throttling"}', "events": [], "error": "",
+                "acquire_wait_ms": 0}
+
+
+def _client(app):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://gw")
+
+
+def test_identical_alerts_coalesce_then_hit_the_cache(gw, monkeypatch, sample_alert):
+    fake = _FakeQ()
+    monkeypatch.setattr(gw, "_q_collect", fake)
+
+    async def main():
+        async with _client(gw) as c:
+            first = await asyncio.gather(*[c.post("/ask_json", json={"alert": sample_alert}) for _ in range(3)])
+            cached = await c.post("/ask_json", json={"alert": sample_alert})
+            bypass = await c.post("/ask_json", json={"alert": sample_alert}, headers={"X-Cache-Bypass": "1"})
+            return [r.json() for r in first], cached.json(), bypass.json()
+
+    first, cached, bypass = asyncio.run(main())
+    assert len(fake.calls) == 2
+    leaders = [o for o in first if not o["coalesced"]]
+    followers = [o for o in first if o["coalesced"]]
+    assert len(leaders) == 1 and len(followers) == 2
+    for o in followers:
+        assert o["timings"]["linked_trace_id"] == leaders[0]["timings"]["trace_id"]
+        assert o["timings"]["spans"] == []
+    assert cached["cached"] and not cached["coalesced"]
+    assert not bypass["cached"]
+
+
+def test_admission_overload_returns_429_with_retry_after(gw, monkeypatch, sample_alert):
+    fake = _FakeQ()
+    monkeypatch.setattr(gw, "_q_collect", fake)
+    monkeypatch.setattr(gw, "_ADMISSION", AdmissionQueue(max_active=1, max_queue=0, max_wait=5,
+                                                         default_service_s=30))
+    other = copy.deepcopy(sample_alert)
+    other["service"] = "sdn6"
+
+    async def main():
+        fake.gate = asyncio.Event()
+        async with _client(gw) as c:
+            busy = asyncio.create_task(c.post("/ask_json", json={"alert": sample_alert}))
+            while not fake.calls:
+                await asyncio.sleep(0.01)
+            rejected = await c.post("/ask_json", json={"alert": other})
+            fake.gate.set()
+            return rejected, await busy
+
+    rejected, ok = asyncio.run(main())
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "30"
+    assert "queue full" in rejected.json()["detail"]
+    assert ok.status_code == 200
+
+
+def test_rule_match_keeps_hashed_session_and_only_picks_prompt_sop(gw, sample_alert):
+    alert = dict(sample_alert, service="vigi-cloud", category="disk")
+    body = {"alert": alert}
+    sop_id, ik, how = gw._prepare_analysis(body)
+    assert sop_id == gw.sop_id_from_incident_key(ik)
+    assert how["method"] == "rules"
+    assert how["prompt_sop_id"] != sop_id
+    assert (gw.SESSION_ROOT / sop_id).is_dir()
+    prompt, _stats = gw._build_prompt_ex(body, sop_id, True, None, how["prompt_sop_id"])
+    assert f"## SOP ({how['prompt_sop_id']})" in prompt
+    assert gw._sop_matcher() is gw._sop_matcher()
+
+
+def test_template_rejector_only_rejects_the_example_root_cause(gw, sample_alert):
+    body = {"alert": sample_alert}
+    prompt, _stats = gw._build_prompt_ex(body, "511470")
+    reject = gw._template_rejector(prompt)
+    example = "string describing the likely root cause based on comprehensive metrics analysis"
+    assert reject({"root_cause": example.upper()}) == "root_cause is the template example"
+    # 告警标题出现在 prompt 中，但不是示例值
+    assert reject({"root_cause": sample_alert["title"]}) is None
+    assert reject({"root_cause": "cpu"}) is None
+
+
+def test_global_cap_on_ask_json_is_429_not_504(gw, monkeypatch, sample_alert):
+    monkeypatch.setattr(gw, "QTTY_MAX_CONN", 1)
+
+    async def main():
+        held, _ = await _pool(gw, "other", 1).acquire()
+        async with _client(gw) as c:
+            return await c.post("/ask_json", json={"alert": sample_alert})
+
+    resp = asyncio.run(main())
+    assert resp.status_code == 429
+    assert "global cap" in resp.json()["detail"] and int(resp.headers["Retry-After"]) >= 1
+
+
+def test_plain_call_stream_is_admitted_before_the_response_starts(gw, monkeypatch, sample_alert):
+    monkeypatch.setattr(gw, "_ADMISSION", AdmissionQueue(max_active=1, max_queue=0, max_wait=5,
+                                                         default_service_s=30))
+
+    async def main():
+        async with _client(gw) as c:
+            ok = await c.post("/call_stream", json={"alert": sample_alert})
+            # 流结束后名额与连接都已归还
+            active_after = gw._ADMISSION.active
+            await gw._ADMISSION.acquire("critical")
+            rejected = await c.post("/call_stream", json={"alert": sample_alert})
+            return ok, active_after, rejected
+
+    ok, active_after, rejected = asyncio.run(main())
+    assert ok.status_code == 200 and ok.text == "ok"
+    assert active_after == 0
+    # 第一条流的耗时已计入平均处理时长估算
+    assert rejected.status_code == 429 and 1 <= int(rejected.headers["Retry-After"]) < 30
+    assert all(pc.busy is False for pool in gw._SOP_POOLS.values() for pc in pool._clients)
+
+
+def test_sse_producer_goes_through_admission(gw, monkeypatch, sample_alert):
+    monkeypatch.setattr(gw, "_ADMISSION", AdmissionQueue(max_active=1, max_queue=0, max_wait=5))
+
+    async def main():
+        await gw._ADMISSION.acquire("critical")
+        stream = gw._start_stream({"alert": sample_alert}, "s1", "prompt")
+        await stream.producer
+        return [e async for e in stream.events(0)]
+
+    events = asyncio.run(main())
+    assert [e[1] for e in events] == ["error"]
+    assert "overloaded: queue full" in json.dumps(events[0][2])
+    assert not gw._SOP_POOLS.get("s1") or not gw._SOP_POOLS["s1"]._clients
+
+
+def test_purge_on_timeout_retires_the_pool_before_killing_its_sessions(gw, monkeypatch, sample_alert):
+    # 目录中的进程查找放慢一点，便于确认清理完成前不会在该目录中建新连接
+    purger = PurgeService(gw.SESSION_ROOT, lambda path: (time.sleep(0.2), [])[1])
+    monkeypatch.setattr(gw, "_PURGER", purger)
+    monkeypatch.setattr(gw, "PURGE_ON_TIMEOUT", True)
+
+    async def _timed_out(body, sop_id, prompt_sop_id):
+        return {"ok": False, "error": "timeout after 1s"}
+
+    monkeypatch.setattr(gw, "_collect_for", _timed_out)
+
+    async def main():
+        (gw.SESSION_ROOT / "s1").mkdir(parents=True)
+        pool = _pool(gw, "s1", 2)
+        (a, _), (b, _) = await asyncio.gather(pool.acquire(), pool.acquire())
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0)
+        out = await gw._analyze_once({"alert": sample_alert}, "s1", None, "s1", True, time.time())
+        fresh = asyncio.create_task(gw._get_pool("s1").acquire(timeout=5))
+        await asyncio.sleep(0.05)
+        created_during_purge = fresh.done()
+        await purger.get(out["purge_id"]).task
+        pc, _ = await fresh
+        with pytest.raises(HTTPException) as e:
+            await waiter
+        # 正在使用旧连接的请求收尾时不会把它们放回任何池
+        await pool.release(a)
+        await pool.discard(b)
+        return pool, (a, b), out, created_during_purge, pc, e.value
+
+    pool, old, out, created_during_purge, pc, err = asyncio.run(main())
+    assert out["purged_on_timeout"]
+    assert pool.retired and not pool._clients and not pool._idle
+    assert all(o.client.closed for o in old)
+    assert gw._SOP_POOLS["s1"] is not pool
+    assert not created_during_purge and pc.client not in [o.client for o in old]
+    assert err.status_code == 503
+    assert gw._GLOBAL_CONN == 1
+
+
+def test_metrics_render_on_the_event_loop(gw):
+    async def main():
+        pool = _pool(gw, "s1", 1)
+        pc, _ = await pool.acquire()
+        async with _client(gw) as c:
+            return await c.get("/metrics")
+
+    resp = asyncio.run(main())
+    assert asyncio.iscoroutinefunction(gw.metrics)
+    assert resp.status_code == 200
+    assert 'q_gateway_pool_connections{sop_id="s1",state="busy"} 1' in resp.text
+
+
+def test_prewarm_warms_hot_sops_from_the_mapping_file(gw, monkeypatch):
+    monkeypatch.setattr(gw, "PREWARM_TOP_N", 2)
+    now = int(time.time())
+    lines = [{"ts": now, "incident_key": f"ik{i}", "sop_id": sop} for i, sop in enumerate(["a", "b", "a", "c", "a", "b"])]
+    gw._INCIDENT_MAP_FILE.write_text("".join(json.dumps(r) + "\n" for r in lines), encoding="utf-8")
+
+    out = asyncio.run(gw._prewarm_once())
+    assert out["hot"] == [("a", 3), ("b", 2)]
+    assert sorted(out["warmed"]) == ["a", "b"]
+    assert (gw.SESSION_ROOT / "a").is_dir() and "c" not in gw._SOP_POOLS
@@ -0,0 +1,48 @@
+import time
+
+from gateway import job_store
+from gateway.job_store import JobStore
+
+
+def test_job_lifecycle(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    store.create("j1", "511470", "ik-1", {"alert": {"service": "sdn5"}})
+    assert store.get("j1")["status"] == job_store.QUEUED
+    assert store.get("missing") is None
+
+    store.update("j1", job_store.RUNNING)
+    store.update("j1", job_store.DONE, {"ok": True, "output": "中文"})
+    job = store.get("j1")
+    assert job["status"] == job_store.DONE
+    assert job["result"] == {"ok": True, "output": "中文"}
+    assert job["error"] == "" and job["incident_key"] == "ik-1"
+    # 之后只改状态/错误时保留已有结果
+    store.update("j1", job_store.FAILED, None, "late failure")
+    job = store.get("j1")
+    assert job["result"] == {"ok": True, "output": "中文"} and job["error"] == "late failure"
+    store.close()
+
+
+def test_unfinished_survives_reopen_in_creation_order(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    store = JobStore(path)
+    for job_id in ("a", "b", "c"):
+        store.create(job_id, "s", None, {"n": job_id})
+    store.update("b", job_store.RUNNING)
+    store.update("c", job_store.REJECTED, None, "overloaded")
+    store.close()
+
+    reopened = JobStore(path)
+    assert [(j["job_id"], j["request"]) for j in reopened.unfinished()] == [("a", {"n": "a"}), ("b", {"n": "b"})]
+    reopened.close()
+
+
+def test_prune_only_removes_finished_jobs(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    store.create("done", "s", None, {})
+    store.create("running", "s", None, {})
+    store.update("done", job_store.DONE, {"ok": True})
+    store.update("running", job_store.RUNNING)
+    assert store.prune(time.time() + 1) == 1
+    assert store.get("done") is None and store.get("running") is not None
+    store.close()
@@ -0,0 +1,76 @@
+import json
+
+from gateway.json_scan import JsonResultScanner, find_result, validate_result
+
+RESULT = {"root_cause": "disk {full} on node \"a\"", "evidence": ["df: 100%", "}{"], "confidence": 0.8}
+
+
+def _feed_all(scanner, text, size):
+    for i in range(0, len(text), size):
+        if scanner.feed(text[i:i + size]):
+            return True
+    return False
+
+
+def test_result_split_across_every_chunk_size():
+    payload = json.dumps(RESULT, ensure_ascii=False)
+    text = "thinking... {not json\n> " + payload + "\n!> "
+    for size in (1, 2, 3, 7, 16, len(text)):
+        scanner = JsonResultScanner()
+        assert _feed_all(scanner, text, size), size
+        assert scanner.result == RESULT
+
+
+def test_escape_split_between_chunks():
+    scanner = JsonResultScanner()
+    assert not scanner.feed('{"root_cause": "quote \\')
+    assert not scanner.feed('" and brace }", "evidence": [], ')
+    assert scanner.feed('"confidence": 1}')
+    assert scanner.result["root_cause"] == 'quote " and brace }'
+
+
+def test_nested_object_inside_noise_is_found_before_outer_closes():
+    scanner = JsonResultScanner()
+    text = '{ noise {"tool_calls": [{"a": 1}], "root_cause": "x", "evidence": ["e"], "confidence": 0.5}'
+    assert _feed_all(scanner, text, 5)
+    assert scanner.result["root_cause"] == "x"
+
+
+def test_invalid_candidates_are_rejected_with_reason():
+    scanner = JsonResultScanner()
+    assert not scanner.feed('{"root_cause": "", "evidence": [], "confidence": 0.5}')
+    assert not scanner.feed('{"root_cause": "x", "evidence": "e", "confidence": 0.5}')
+    assert not scanner.feed('{"root_cause": "x", "evidence": [], "confidence": 3}')
+    assert scanner.rejected == ["root_cause must be a non-empty string", "evidence must be a list",
+                                "confidence out of range"]
+    assert scanner.feed('{"root_cause": "x", "evidence": [], "confidence": "0.5"}')
+
+
+def test_reject_callback_skips_template_and_keeps_scanning():
+    scanner = JsonResultScanner(reject=lambda o: "template" if o["root_cause"] == "string" else None)
+    template = '{"root_cause": "string", "evidence": [], "confidence": 0.85}'
+    assert not scanner.feed(template)
+    assert scanner.rejected == ["template"]
+    assert scanner.feed(json.dumps(RESULT))
+    assert scanner.result == RESULT
+
+
+def test_oversized_candidate_is_dropped_and_scanning_recovers():
+    scanner = JsonResultScanner(max_chars=128)
+    assert not scanner.feed("{" + "x" * 400)
+    assert len(scanner._buf) < 200
+    assert scanner.feed(json.dumps(RESULT))
+
+
+def test_only_first_result_is_reported():
+    scanner = JsonResultScanner()
+    assert scanner.feed(json.dumps(RESULT))
+    assert not scanner.feed(json.dumps(dict(RESULT, root_cause="other")))
+    assert scanner.result == RESULT
+
+
+def test_find_result_and_validate():
+    text = 'prefix {"a": 1} ' + json.dumps(RESULT) + " tail"
+    assert find_result(text) == RESULT
+    assert find_result(text, reject=lambda o: "no") is None
+    assert validate_result({"root_cause": "x"}, ("root_cause", "evidence")) == "missing evidence"
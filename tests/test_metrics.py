@@ -0,0 +1,29 @@
+from gateway.metrics import Registry
+
+
+def test_counter_and_histogram_render():
+    reg = Registry()
+    c = reg.counter("reqs_total", "Requests", ["result"])
+    c.inc(result="ok")
+    c.inc(2, result="ok")
+    h = reg.histogram("lat_seconds", "Latency", buckets=(0.1, 1.0))
+    h.observe(0.5)
+    text = reg.render()
+    assert 'reqs_total{result="ok"} 3' in text
+    assert 'lat_seconds_bucket{le="0.1"} 0' in text and 'lat_seconds_bucket{le="1"} 1' in text
+    assert "lat_seconds_count 1" in text
+
+
+def test_failing_collector_keeps_earlier_families_and_logs(capsys):
+    reg = Registry()
+
+    def broken():
+        yield ("up", "gauge", "Up", [({}, 1)])
+        raise RuntimeError("dictionary changed size during iteration")
+
+    reg.add_collector(broken)
+    reg.add_collector(lambda: [("other", "gauge", "Other", [({"k": "v"}, 2)])])
+    text = reg.render()
+    assert "up 1" in text and 'other{k="v"} 2' in text
+    out = capsys.readouterr().out
+    assert "[metrics] collector broken failed after=up" in out and "dictionary changed size" in out
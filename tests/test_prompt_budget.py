@@ -0,0 +1,63 @@
+import json
+
+from gateway import prompt_budget as pb
+
+
+def test_approx_tokens_counts_ascii_and_cjk():
+    assert pb.approx_tokens("") == 0
+    assert pb.approx_tokens("abcd" * 10) == 10
+    assert pb.approx_tokens("中文") == 2
+
+
+def test_compact_alert_drops_empty_and_duplicate_metadata(sample_alert):
+    alert = dict(sample_alert)
+    alert["metadata"] = dict(sample_alert["metadata"], service=alert["service"], empty="",
+                             alertname=alert["title"].upper())
+    out, dropped = pb.compact_alert(alert)
+    assert "metadata.service" in dropped
+    assert "metadata.empty" in dropped
+    assert "metadata.alertname" in dropped  # 与顶层 title 同义且取值相同（忽略大小写）
+    assert "alertname" not in out["metadata"]
+    assert out["service"] == alert["service"]
+    assert len(pb.to_json(out)) < len(json.dumps(alert, ensure_ascii=False))
+    assert alert["metadata"]["service"] == alert["service"]  # 不修改原对象
+
+
+def test_fit_sections_keeps_text_within_budget():
+    sections = [pb.Section("a", "alpha " * 10)]
+    text, report = pb.fit_sections(sections, 1000)
+    assert text == "alpha " * 10
+    assert report["dropped_sections"] == [] and report["truncated_sections"] == []
+
+
+def test_fit_sections_drops_low_priority_then_truncates():
+    md = "intro line\n## Output\nkeep json format\n## Logs\n" + "log line\n" * 200 + "## Metrics\n" + "m\n" * 50
+    sections = pb.sections_from_markdown(md, "## SOP (x)", [("output", 1), ("metric", 3), ("log", 4)], 3, "sop")
+    sections.append(pb.Section("policy", "## POLICY\n" + "rule\n" * 5, priority=0, required=True))
+    text, report = pb.fit_sections(sections, 30)
+    assert report["tokens_before"] > 30 >= report["tokens"]
+    assert report["dropped_sections"] == ["sop:Logs", "sop:Metrics"]
+    assert text.startswith("## SOP (x)\nintro line")
+    assert "keep json format" in text and "## POLICY" in text
+
+    big = [pb.Section("req", "## REQ\n" + "line of text\n" * 100, priority=3, required=True)]
+    text, report = pb.fit_sections(big, 50)
+    assert report["truncated_sections"] == ["req"]
+    assert text.endswith("...(trimmed)\n")
+    assert report["tokens"] < report["tokens_before"]
+
+
+def test_split_markdown_roundtrip():
+    md = "pre\n# A\nx\n## B\ny\n### C\nz\n"
+    parts = pb.split_markdown(md)
+    assert [n for n, _ in parts] == ["", "A", "B", "C"]
+    assert "".join(c for _, c in parts) == md
+
+
+def test_alert_section_truncates_long_fields_only_when_over_budget():
+    payload = {"log": "x" * 500, "service": "sdn5"}
+    text, rep = pb.alert_section("## ALERT JSON", payload, True, 1000, 50)
+    assert rep["truncated_fields"] == 0 and "x" * 500 in text
+    text, rep = pb.alert_section("## ALERT JSON", payload, True, 20, 50)
+    assert rep["truncated_fields"] == 1
+    assert json.loads(text.split("\n", 1)[1])["log"] == "x" * 50 + "..."
@@ -0,0 +1,51 @@
+import time
+
+from gateway.result_cache import ResultCache, parse_ttls
+
+
+def test_parse_ttls():
+    assert parse_ttls("critical=120, warning = 600,bad", 300) == {"default": 300, "critical": 120, "warning": 600}
+
+
+def test_ttl_expiry_and_hit_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = ResultCache(ttls=parse_ttls("critical=10", 60))
+    cache.put("k", {"ok": True}, cache.ttl_for("CRITICAL"))
+    now[0] += 4
+    value, age = cache.get("k")
+    assert value == {"ok": True} and age == 4
+    now[0] += 7
+    assert cache.get("k") is None
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 1, "misses": 1}
+    cache.put("zero", {}, 0)
+    assert cache.get("zero") is None
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", {"v": 1}, 60)
+    cache.put("b", {"v": 2}, 60)
+    cache.get("a")  # a 变为最近使用
+    cache.put("c", {"v": 3}, 60)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+    small = ResultCache(max_bytes=40)
+    small.put("x", {"v": "a" * 20}, 60)
+    small.put("y", {"v": "b" * 20}, 60)
+    assert small.get("x") is None and small.get("y") is not None
+    small.put("huge", {"v": "c" * 100}, 60)
+    assert small.get("huge") is None
+
+
+def test_persist_roundtrip(tmp_path):
+    path = tmp_path / "cache.jsonl"
+    cache = ResultCache(persist_path=path)
+    cache.put("live", {"ok": True}, 60)
+    cache.put("gone", {"ok": False}, 60)
+    cache._od["gone"] = (time.time() - 1,) + cache._od["gone"][1:]
+    assert cache.save() == 1
+    fresh = ResultCache(persist_path=path)
+    assert fresh.load() == 1
+    assert fresh.get("live")[0] == {"ok": True}
@@ -0,0 +1,54 @@
+from gateway.sop_matcher import SopMatcher, alert_value, parse_key
+
+
+def _matcher(*records):
+    return SopMatcher(records, generation=7)
+
+
+def test_parse_key_kinds():
+    assert parse_key("svc:omada-*") == ("svc", "prefix", "omada-")
+    assert parse_key("cat:CPU") == ("cat", "exact", "cpu")
+    assert parse_key("sev:*") == ("sev", "any", "")
+    assert parse_key("svc:*-gw") == ("svc", "glob", "*-gw")
+    assert parse_key("nocolon") is None
+    assert parse_key("svc:") is None
+
+
+def test_exact_match_beats_prefix():
+    m = _matcher(("prefix", {"keys": ["svc:omada-*", "cat:cpu"]}),
+                 ("exact", {"keys": ["svc:omada-gw", "cat:cpu"]}))
+    best = m.match({"service": "omada-gw", "category": "cpu"})
+    assert best["sop_id"] == "exact"
+    assert best["runners_up"] == ["prefix"]
+    assert best["matched_keys"]["svc"] == {"key": "svc:omada-gw", "kind": "exact", "value": "omada-gw"}
+
+
+def test_prefix_match_uses_longest_specificity_and_all_dims():
+    m = _matcher(("short", {"keys": ["svc:om*"]}),
+                 ("long", {"keys": ["svc:omada-*"]}),
+                 ("other-cat", {"keys": ["svc:omada-*", "cat:disk"]}))
+    best = m.match({"service": "omada-device-gateway", "category": "cpu"})
+    assert best["sop_id"] == "long"
+    assert best["candidates"] == 2
+    assert m.match({"service": "vigi", "category": "cpu"}) is None
+
+
+def test_priority_ranks_before_specificity():
+    m = _matcher(("specific-low", {"keys": ["svc:omada-gw"], "priority": "LOW"}),
+                 ("broad-high", {"keys": ["svc:omada-*"], "priority": "HIGH"}))
+    assert m.match({"service": "omada-gw"})["sop_id"] == "broad-high"
+
+
+def test_wildcard_only_rule_matches_everything_and_glob_is_supported():
+    m = _matcher(("any", {"keys": ["sev:*"]}), ("glob", {"keys": ["svc:*-gw"]}))
+    assert m.match({"service": "x"})["sop_id"] == "any"
+    assert [r.sop_id for r in m.candidates({"service": "omada-gw"})] == ["glob", "any"]
+
+
+def test_metadata_fallback_and_skipped_records():
+    m = _matcher(("svc", {"keys": ["svc:sdn5"]}), ("bad", {"keys": "svc:sdn5"}), ("none", {}))
+    alert = {"metadata": {"service_name": "SDN5"}}
+    assert alert_value(alert, "svc") == "sdn5"
+    assert m.match(alert)["sop_id"] == "svc"
+    assert m.stats()["rules"] == 1
+    assert m.stats()["generation"] == 7
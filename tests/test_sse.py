@@ -0,0 +1,82 @@
+import asyncio
+
+from gateway.sse import SSEStream, StreamRegistry, format_event
+
+
+def _collect(stream, last_id=0):
+    async def main():
+        return [e async for e in stream.events(last_id)]
+    return asyncio.run(main())
+
+
+def _closed_stream(n, max_events=100):
+    async def main():
+        s = SSEStream("s", max_events=max_events)
+        for i in range(n):
+            s.publish("content", {"i": i})
+        s.close()
+        return s
+    return asyncio.run(main())
+
+
+def test_format_event_multiline():
+    assert format_event(3, "content", "a\nb") == "id: 3\nevent: content\ndata: a\ndata: b\n\n"
+    assert format_event(1, "complete", {"x": "中"}) == 'id: 1\nevent: complete\ndata: {"x": "中"}\n\n'
+
+
+def test_replay_after_last_event_id():
+    s = _closed_stream(5)
+    assert [e[0] for e in _collect(s)] == [1, 2, 3, 4, 5]
+    assert [e[0] for e in _collect(s, 3)] == [4, 5]
+    assert _collect(s, 5) == []
+
+
+def test_gap_older_than_buffer_emits_reset():
+    s = _closed_stream(6, max_events=3)
+    events = _collect(s, 1)
+    assert events[0] == (3, "reset", {"reason": "replay_gap", "last_event_id": 1, "oldest_event_id": 4,
+                                      "missed": 2})
+    assert [e[0] for e in events[1:]] == [4, 5, 6]
+    # 断点正好在缓冲起点之前：没有缺口
+    assert [e[1] for e in _collect(s, 3)] == ["content"] * 3
+
+
+def test_follow_resumes_live_stream_and_pings_when_idle():
+    async def main():
+        s = SSEStream("s")
+        s.publish("content", "a")
+        out = []
+
+        async def reader():
+            async for text in s.follow(last_event_id=1, ping_s=0.02):
+                out.append(text)
+
+        task = asyncio.create_task(reader())
+        await asyncio.sleep(0.05)
+        s.publish("content", "b")
+        s.publish("complete", "c")
+        s.close()
+        await asyncio.wait_for(task, 1)
+        return out
+
+    out = asyncio.run(main())
+    assert out[0].startswith(": ping")
+    assert [t for t in out if not t.startswith(":")] == ["id: 2\nevent: content\ndata: b\n\n",
+                                                       "id: 3\nevent: complete\ndata: c\n\n"]
+
+
+def test_registry_latest_and_prune(monkeypatch):
+    async def main():
+        reg = StreamRegistry(ttl_s=10)
+        old = reg.create("ik")
+        old.close()
+        live = reg.create("ik")
+        assert reg.latest("ik") is live
+        live.close()
+        old.finished_at -= 60
+        assert reg.prune() == 1
+        return reg, old, live
+
+    reg, old, live = asyncio.run(main())
+    assert reg.get(old.stream_id) is None and reg.get(live.stream_id) is live
+    assert reg.stats() == {"streams": 1, "live": 0}